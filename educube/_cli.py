@@ -1,12 +1,24 @@
 #!/usr/bin/env python
 import logging
+import os
+import time
 
 import click
 import serial
 import serial.tools.list_ports
 
 from educube import __version__
-from educube.connection import configure_connection
+from educube.connection import (configure_connection,
+                                 configure_connection_manager,
+                                 EduCubeReplayConnection, load_simulator)
+from educube.telemetry_log import (FSYNC_NEVER, FSYNC_ON_FLUSH,
+                                   FSYNC_ON_CLOSE, LOG_FORMAT_RAW,
+                                   LOG_FORMAT_SEGMENTS, CODEC_NONE, CODEC_ZLIB,
+                                   CODEC_LZMA, is_segment_file,
+                                   raw_to_segments, segments_to_raw,
+                                   segments_match_raw,
+                                   first_timestamp)
+from educube.telemetry_columns import convert_logs
 from educube.web import server as webserver
 from educube.util import (configure_logging, verify_serial_connection, 
                           suggest_serial, suggest_baud) 
@@ -34,13 +46,64 @@ def version():
 
 
 
+def telemetry_log_options(command):
+    """Add the options controlling the telemetry log to a command."""
+    options = (
+        click.option('--echo', is_flag=True, default=False,
+                     help="Print telemetry and commands as they are logged"),
+        click.option('--rotate-mb', type=float, default=None,
+                     help="Start a new telemetry log file after this size"),
+        click.option('--rotate-hours', type=float, default=None,
+                     help="Start a new telemetry log file after this time"),
+        click.option('--fsync', default=FSYNC_NEVER,
+                     type=click.Choice((FSYNC_NEVER, FSYNC_ON_FLUSH,
+                                        FSYNC_ON_CLOSE)),
+                     help="When to force the telemetry log to disk"),
+        click.option('--log-format', default=LOG_FORMAT_RAW,
+                     type=click.Choice((LOG_FORMAT_RAW, LOG_FORMAT_SEGMENTS)),
+                     help="Text log, or compressed segments"),
+    )
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def ws_compression_option(command):
+    """Add the option compressing the WebSocket messages to a command."""
+    return click.option(
+        '--ws-compression', type=click.IntRange(0, 9), default=None,
+        help="Compress WebSocket messages at this zlib level"
+    )(command)
+
+
+def make_log_options(echo, rotate_mb, rotate_hours, fsync, log_format):
+    """Convert the telemetry log options to TelemetryLogWriter arguments."""
+    return {
+        'log_format'        : log_format,
+        'echo'              : echo,
+        'rotate_bytes'      : (None if rotate_mb is None
+                               else int(rotate_mb * 1e6)),
+        'rotate_interval_s' : (None if rotate_hours is None
+                               else rotate_hours * 3600),
+        'fsync'             : fsync,
+    }
+
+
 @cli.command()
 @click.option('-s', '--serial', default=suggest_serial, prompt=True)
 @click.option('-b', '--baud', default=suggest_baud, prompt=True)
 @click.option('-e', '--board', default='CDH')
 @click.option('-p', '--port', default=DEFAULT_PORT)
 @click.option('--fake', is_flag=True, default=False, help="Fake the serial")
-def start(serial, baud, board, fake, port):
+@click.option('--asyncio', 'use_asyncio', is_flag=True, default=False,
+              help="Run the serial connection on the web server event loop")
+@click.option('-r', '--telem-rate', default=None,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Target telemetry requests per second for each board")
+@ws_compression_option
+@telemetry_log_options
+def start(serial, baud, board, fake, port, use_asyncio, telem_rate,
+          ws_compression, echo, rotate_mb, rotate_hours, fsync, log_format):
     """Starts the EduCube web interface""" 
 
     logger.info("""Running EduCube connection with settings:
@@ -59,6 +122,10 @@ def start(serial, baud, board, fake, port):
         "baud": baud,
         "board": board,
         "fake": fake,
+        "use_asyncio": use_asyncio,
+        "telem_request_rate_hz": telem_rate,
+        "log_options": make_log_options(echo, rotate_mb, rotate_hours, fsync,
+                                        log_format),
         }
 
     with configure_connection(**connection_params) as conn:
@@ -72,13 +139,249 @@ def start(serial, baud, board, fake, port):
         click.prompt("Press any key to continue",
                      default=True, show_default=False)
 
-        webserver.run(conn, port)
+        webserver.run(conn, port, compression_level=ws_compression)
 
     click.secho("EduCube Connection Closed.", fg='green')
     click.secho("Telemetry is saved to '{path}'"\
                 .format(path=telemetry_path), fg='green')
 
 
+def parse_device(ctx, param, value):
+    """Convert a sequence of 'ID=SERIAL' strings into a dict."""
+    devices = dict()
+    for _device in value:
+        device_id, sep, serial = _device.partition('=')
+        if not (device_id and sep and serial):
+            errmsg = f"Expected ID=SERIAL, got '{_device}'"
+            raise click.BadParameter(errmsg)
+        if device_id in devices:
+            raise click.BadParameter(f"Duplicate device ID '{device_id}'")
+        devices[device_id] = serial
+    return devices
+
+
+@cli.command()
+@click.option('-d', '--device', 'devices', multiple=True, required=True,
+              callback=parse_device,
+              help="EduCube as ID=SERIAL (repeat for each EduCube)")
+@click.option('-b', '--baud', default=9600)
+@click.option('-e', '--board', default='CDH')
+@click.option('-p', '--port', default=DEFAULT_PORT)
+@click.option('-r', '--telem-rate', default=None,
+              type=click.FloatRange(min=0, min_open=True),
+              help="Target telemetry requests per second for each board")
+@ws_compression_option
+@telemetry_log_options
+def bench(devices, baud, board, port, telem_rate, ws_compression,
+          echo, rotate_mb, rotate_hours, fsync, log_format):
+    """Starts the web interface for several EduCubes"""
+
+    logger.info("""Running EduCube connections with settings:
+        Serial: {devices}
+        Baudrate: {baud}
+        EduCube board: {board}
+        Websocket Port : {port}
+    """.format(devices=devices, baud=baud, board=board, port=port))
+
+    for serial in devices.values():
+        verify_serial_connection(serial, baud)
+
+    log_options = make_log_options(echo, rotate_mb, rotate_hours, fsync,
+                                   log_format)
+    with configure_connection_manager(
+            devices, board, baud, telem_request_rate_hz=telem_rate,
+            log_options=log_options
+            ) as manager:
+        telemetry_paths = manager.output_paths
+
+        for device in manager.devices:
+            edu_url = "http://localhost:{port}/?device={device}"\
+                .format(port=port, device=device)
+            click.secho("EduCube {device} will be available at {url}"\
+                        .format(device=device, url=edu_url), fg='green')
+            click.secho("    Telemetry will be stored at '{path}'"\
+                        .format(path=telemetry_paths[device]), fg='green')
+
+        click.prompt("Press any key to continue",
+                     default=True, show_default=False)
+
+        webserver.run(manager, port, compression_level=ws_compression)
+
+    click.secho("EduCube Connections Closed.", fg='green')
+    for device, path in telemetry_paths.items():
+        click.secho("Telemetry for {device} is saved to '{path}'"\
+                    .format(device=device, path=path), fg='green')
+
+
+@cli.command()
+@click.option('-e', '--board', default='CDH')
+@click.option('-b', '--baud', default=9600,
+              help="Baud rate whose transmission time is simulated (0: none)")
+@click.option('-r', '--rate', type=float, default=None,
+              help="Unsolicited telemetry packets per second")
+@click.option('--latency', type=float, default=0.0,
+              help="Delay in seconds before answering telemetry requests")
+@click.option('--exp-truncation', type=float, default=0.0,
+              help="Probability of truncating EXP panel 2 telemetry")
+@click.option('--garble', type=float, default=0.0,
+              help="Probability of corrupting characters in a packet")
+@click.option('--drop', type=float, default=0.0,
+              help="Probability of not answering a telemetry request")
+@click.option('--seed', type=int, default=None)
+def simulate(board, baud, rate, latency, exp_truncation, garble, drop, seed):
+    """Runs a simulated EduCube on a pseudo-terminal"""
+
+    # POSIX only: raises EduCubeConnectionError on other systems
+    EduCubeSimulator = load_simulator()
+    simulator = EduCubeSimulator(
+        board=board, baud=baud, rate_hz=rate, latency_s=latency,
+        exp_truncation=exp_truncation, garble=garble, drop=drop, seed=seed
+    )
+
+    with simulator:
+        click.secho("Simulated EduCube {board} on serial port '{port}'"\
+                    .format(board=board, port=simulator.port), fg='green')
+        click.secho("Press Ctrl-C to stop", fg='green')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+    click.secho("Simulator stopped: {stats}"\
+                .format(stats=simulator.stats()), fg='green')
+
+
+@cli.command()
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('-p', '--port', default=DEFAULT_PORT)
+@click.option('-x', '--speed', type=float, default=1.0,
+              help="Playback speed (e.g. 10 for 10x; 0 for as fast as "
+                   "possible)")
+@click.option('--start', type=float, default=None,
+              help="Start this many seconds into the recording")
+@click.option('--loop', is_flag=True, default=False,
+              help="Start again after the end of the recording")
+@ws_compression_option
+def replay(paths, port, speed, start, loop, ws_compression):
+    """Replays recorded telemetry logs in the web interface
+
+    Several logs (e.g., rotated files) are replayed one after another.
+    """
+    _start = None
+    if start is not None:
+        _first = first_timestamp(paths[0])
+        if _first is not None:
+            _start = _first + int(start * 1000)
+
+    conn = EduCubeReplayConnection(paths, speed=speed, start=_start, loop=loop)
+    with conn:
+        edu_url = "http://localhost:{port}".format(port=port)
+        click.secho("Replay will be available at {url}".format(url=edu_url),
+                    fg='green')
+
+        webserver.run(conn, port, compression_level=ws_compression)
+
+    _stats = conn.stats()
+    click.secho(
+        "Replayed {packets} packets ({bytes} bytes) in {elapsed:.1f} s: "
+        "{pps:.1f} packets/s, {bps:.0f} bytes/s".format(
+            packets=_stats.packets, bytes=_stats.bytes,
+            elapsed=_stats.elapsed_s, pps=_stats.packets_per_s,
+            bps=_stats.bytes_per_s
+        ), fg='green'
+    )
+
+
+@cli.command()
+@click.argument('inputs', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--codec', default=CODEC_ZLIB,
+              type=click.Choice((CODEC_ZLIB, CODEC_LZMA, CODEC_NONE)))
+@click.option('--verify', is_flag=True, default=False,
+              help="Check that the recording holds exactly the .raw lines")
+def transcode(inputs, output, codec, verify):
+    """Converts telemetry logs between .raw and compressed segments
+
+    Several .raw logs (e.g., rotated files) are combined into one recording.
+    A segment recording is converted back to a single .raw log.
+    """
+    if is_segment_file(inputs[0]):
+        if len(inputs) > 1:
+            raise click.BadParameter("Only one segment recording at a time")
+        _n = segments_to_raw(inputs[0], output)
+        click.secho(f"Wrote {_n} lines to '{output}'", fg='green')
+        return
+
+    writer = raw_to_segments(inputs, output, codec=codec)
+
+    _size = os.path.getsize(output)
+    click.secho(
+        "Wrote {lines} lines in {segments} segments to '{output}': "
+        "{raw} -> {size} bytes ({ratio:.1f}x)".format(
+            lines=writer.lines, segments=writer.segments, output=output,
+            raw=writer.raw_bytes, size=_size,
+            ratio=writer.raw_bytes / max(_size, 1)
+        ), fg='green'
+    )
+
+    if verify:
+        if not segments_match_raw(output, inputs):
+            raise click.ClickException(
+                f"'{output}' does not hold the lines of the .raw logs"
+            )
+        click.secho("Verified: the recording holds the lines of the .raw "
+                    "logs", fg='green')
+
+
+@cli.command()
+@click.argument('inputs', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('-o', '--output', default=None,
+              type=click.Path(file_okay=False),
+              help="Output directory (one log only; default: <log>.columns)")
+@click.option('-j', '--workers', type=int, default=None,
+              help="Number of worker processes (default: number of CPUs)")
+@click.option('--chunk-mb', type=float, default=8.0,
+              help="Size in MB of the chunks of a .raw log")
+@click.option('-f', '--force', is_flag=True, default=False,
+              help="Convert logs even if their columns are up to date")
+def convert(inputs, output, workers, chunk_mb, force):
+    """Converts telemetry logs to typed columns for analysis
+
+    The fields of each board are written to <log>.columns/<BOARD>.npz, which
+    can be read with numpy.load. Logs that are unchanged since their last
+    conversion are skipped.
+    """
+    if output is not None and len(inputs) > 1:
+        raise click.BadParameter("--output can only be used with one log")
+
+    results = convert_logs(
+        inputs, output_dirs=None if output is None else [output],
+        workers=workers, chunk_bytes=max(1, int(chunk_mb * 1024 * 1024)),
+        force=force
+    )
+
+    for _result in results:
+        _rows = ', '.join(f'{_board}: {_n}'
+                          for _board, _n in sorted(_result.rows.items()))
+        if _result.cached:
+            click.secho("'{path}' is up to date in '{output}' ({rows})"\
+                        .format(path=_result.path, output=_result.output_dir,
+                                rows=_rows), fg='green')
+        else:
+            click.secho(
+                "Converted '{path}' to '{output}' in {elapsed:.1f} s "
+                "({rows}; {failed} unparseable packets)".format(
+                    path=_result.path, output=_result.output_dir,
+                    elapsed=_result.elapsed_s, rows=_rows,
+                    failed=_result.failed
+                ), fg='green'
+            )
+
+
 ##############################
 # MAIN
 ##############################
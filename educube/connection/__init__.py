@@ -1,22 +1,37 @@
-from ._connection import EduCubeConnection
-#from ._fake_connection import FakeEduCubeConnection 
+from ._connection import (EduCubeConnection, FakeEduCubeConnection,
+                          EduCubeConnectionError, load_simulator)
+from ._async_connection import EduCubeAsyncConnection
+from ._manager import EduCubeConnectionManager, configure_connection_manager
+from ._replay import EduCubeReplayConnection
 
 
-def configure_connection(port, board, baud, fake=False, **kwargs):
+def configure_connection(port, board, baud, fake=False, use_asyncio=False,
+                         type='serial', **kwargs):
     """
     Creates the appropriate EduCube connection object.
 
+    If fake is True, the connection is to a simulated EduCube, and port is
+    ignored. If use_asyncio is True, the connection runs on the Tornado IOLoop
+    rather than in its own thread (POSIX only). The connection type is
+    currently always 'serial'. Any other keyword arguments are passed to the
+    connection constructor.
+
     """
 #    logger.info("Creating educube connection")
 
     if fake:
         educube_connection = FakeEduCubeConnection(
-            port, board, baud=baud
+            port, board, baud=baud, **kwargs
+        )
+
+    elif use_asyncio:
+        educube_connection = EduCubeAsyncConnection(
+            port, board, baud=baud, **kwargs
         )
 
     else:
         educube_connection = EduCubeConnection(
-            port, board, baud=baud,
+            port, board, baud=baud, **kwargs
         )
 
     return educube_connection
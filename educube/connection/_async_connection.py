@@ -0,0 +1,292 @@
+"""
+_async_connection.py
+
+EduCube connection that runs on the Tornado IOLoop instead of a dedicated
+thread.
+
+The serial port file descriptor is registered with the IOLoop, so received
+data is framed as soon as it arrives and telemetry listeners are called
+without any thread handoff. Telemetry requests are sent from a timed callback
+whenever the request scheduler says one is due, and commands are written
+without blocking the loop, so no separate writer thread is needed. A
+command's future is resolved (and the command logged as sent) only once all
+its bytes have been written to the port, or failed if writing them fails.
+
+This relies on the IOLoop being able to watch the serial port, which is only
+possible on POSIX systems.
+
+"""
+# standard library imports
+from collections import deque
+import logging
+import os
+import time
+
+# third party imports
+import serial
+import tornado.ioloop
+
+# local imports
+from ._connection import EduCubeConnection, EduCubeConnectionError
+from ._framing import FrameSplitter, DEFAULT_EOL, DEFAULT_MAX_FRAME_LENGTH
+
+logger = logging.getLogger(__name__)
+
+READ = tornado.ioloop.IOLoop.READ
+WRITE = tornado.ioloop.IOLoop.WRITE
+
+
+class EduCubeAsyncConnection(EduCubeConnection):
+    """
+    Serial interface to an EduCube driven by IOLoop callbacks.
+
+    """
+    runs_on_ioloop = True
+
+    def __init__(self, portname, board, baud=9600, ioloop=None,
+                 eol=DEFAULT_EOL, max_frame_length=DEFAULT_MAX_FRAME_LENGTH,
+                 **kwargs):
+        """
+        Constructor. Sets up the EduCubeAsyncConnection object.
+
+        Parameters
+        ----------
+        portname : str
+            The serial port that EduCube is connected to.
+        board : str
+            The EduCube board
+        baud : int
+            The baud rate for serial communications
+        ioloop : tornado.ioloop.IOLoop
+            The IOLoop to run on. Defaults to the current IOLoop when the
+            connection is started.
+        eol : bytes
+            Byte character sequence denoting end-of-line
+        max_frame_length : int
+            Maximum length in bytes of a single message.
+
+        All other keyword arguments are passed to EduCubeConnection. The
+        serial timeout is always zero, as reads must never block the loop.
+
+        """
+        kwargs['timeout'] = 0
+        super().__init__(portname, board, baud=baud, **kwargs)
+
+        self.ioloop = ioloop
+        self.frames = FrameSplitter(eol, max_frame_length=max_frame_length)
+
+        self._fd = None
+        self._write_buffer = bytearray()
+        self._unwritten = deque()   # [bytes left to write, QueuedCommand]
+        self._telem_request_timer = None
+        self._command_timer = None
+
+    ################
+    # context manager
+    ################
+
+    def __enter__(self):
+        self.setup_connections()
+        self.start_reader()
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.stop_reader()
+        self.teardown_connections()
+        return False
+
+    ################
+    # IOLoop management
+    ################
+
+    def start_reader(self):
+        logger.debug("STARTUP : Registering serial port with IOLoop")
+
+        try:
+            self._fd = self.connection.fileno()
+        except (AttributeError, NotImplementedError):
+            errmsg = ('EduCubeAsyncConnection requires a serial port with a '
+                      'file descriptor (POSIX only)')
+            raise EduCubeConnectionError(errmsg)
+
+        if self.ioloop is None:
+            self.ioloop = tornado.ioloop.IOLoop.current()
+
+        self.ioloop.add_handler(self._fd, self._on_serial_event, READ)
+
+        self.running = True
+        self._schedule_telem_request(0)
+
+    def stop_reader(self):
+        logger.debug("SHUTDOWN : Removing serial port from IOLoop")
+        self.running = False
+
+        if self._telem_request_timer is not None:
+            self.ioloop.remove_timeout(self._telem_request_timer)
+            self._telem_request_timer = None
+
+        if self._command_timer is not None:
+            self.ioloop.remove_timeout(self._command_timer)
+            self._command_timer = None
+
+        if self._fd is not None:
+            self.ioloop.remove_handler(self._fd)
+            self._fd = None
+
+        # anything still waiting to be written is sent with a blocking write
+        # -- the loop is no longer being served by this connection.
+        if self._write_buffer:
+            try:
+                os.set_blocking(self.connection.fileno(), True)
+                self.connection.write(bytes(self._write_buffer))
+            except Exception as exc:
+                errmsg = "Encountered Error while sending queued commands"
+                logger.exception(errmsg, exc_info=True)
+                self._write_failed(exc)
+            else:
+                self._bytes_written(len(self._write_buffer))
+            self._write_buffer.clear()
+
+        self.command_queue.clear()
+
+    # ******************************
+    # IOLoop callbacks
+    # ******************************
+
+    def _on_serial_event(self, fd, events):
+        """Handler called by the IOLoop when the serial port is ready."""
+        if events & READ:
+            self._read_available()
+
+        if events & WRITE:
+            self._write_available()
+
+    def _read_available(self):
+        """Read and process everything waiting on the serial port."""
+        try:
+            _data = self.connection.read(max(self.connection.in_waiting, 1))
+        except serial.SerialException:
+            errmsg = "Encountered Error while reading from serial port"
+            logger.exception(errmsg, exc_info=True)
+            return
+
+        _new_telemetry = False
+        for _msg in self.frames.feed(_data):
+            _new_telemetry |= self._process_message(_msg)
+
+        if _new_telemetry:
+            self._notify_telemetry_listeners()
+            # a response may allow the next request to be sent sooner
+            self._schedule_telem_request(0)
+
+    def _schedule_telem_request(self, delay):
+        """(Re)arm the timer that sends telemetry requests."""
+        if self._telem_request_timer is not None:
+            self.ioloop.remove_timeout(self._telem_request_timer)
+
+        self._telem_request_timer = self.ioloop.call_later(
+            delay, self._on_telem_request_timer
+        )
+
+    def _on_telem_request_timer(self):
+        self._telem_request_timer = None
+        if self.running:
+            self._schedule_telem_request(self._request_telemetry_if_due())
+
+    def _write_available(self):
+        """Handle the serial port becoming writable."""
+        self._send_buffered()
+
+        if not self._write_buffer:
+            self.ioloop.update_handler(self._fd, READ)
+
+    def _send_buffered(self):
+        """Write as much of the pending output as the port will accept."""
+        try:
+            _n = os.write(self._fd, self._write_buffer)
+        except BlockingIOError:
+            return
+        except OSError as exc:
+            errmsg = "Encountered Error while writing to serial port"
+            logger.exception(errmsg, exc_info=True)
+            self._write_buffer.clear()
+            self._write_failed(exc)
+            return
+
+        del self._write_buffer[:_n]
+        self._bytes_written(_n)
+
+    def _bytes_written(self, n):
+        """Resolve the commands whose last bytes are among n bytes written."""
+        while n and self._unwritten:
+            _unwritten = self._unwritten[0]
+            _written = min(n, _unwritten[0])
+            _unwritten[0] -= _written
+            n -= _written
+
+            if not _unwritten[0]:
+                _queued = self._unwritten.popleft()[1]
+                self._command_sent(_queued.command)
+                _queued.set_result(_queued.command)
+
+    def _write_failed(self, exc):
+        """Fail every command that has not been completely written."""
+        _failed, self._unwritten = self._unwritten, deque()
+        for _bytes, _queued in _failed:
+            _queued.set_exception(exc)
+
+    ################
+    # basic commands
+    ################
+
+    def _command_queued(self):
+        """Transmit the queued command from the IOLoop."""
+        if self.running:
+            # add_callback may be called from any thread
+            self.ioloop.add_callback(self._drain_commands)
+
+    def _drain_commands(self):
+        """Transmit queued commands, waiting on the IOLoop for the link."""
+        if self._command_timer is not None:
+            self.ioloop.remove_timeout(self._command_timer)
+            self._command_timer = None
+
+        if not self.running:
+            return
+
+        _wait = self._transmit_queued()
+        if _wait is not None:
+            self._command_timer = self.ioloop.call_later(
+                _wait, self._drain_commands
+            )
+
+    def _transmit_queued(self):
+        """
+        Queue commands to be written when the serial port is ready, as fast
+        as the link allows. Returns the time in seconds until the next
+        command may be sent, or None if the queue is empty.
+
+        The futures of the commands are resolved as their bytes are written
+        (see _bytes_written and _write_failed).
+
+        """
+        if self._fd is None:
+            return super()._transmit_queued()
+
+        _pending = bool(self._write_buffer)
+        while True:
+            _queued, wait = self.command_queue.pop_ready(time.monotonic())
+            if _queued is None:
+                break
+
+            logger.info(f"Writing command: '{_queued.command}'")
+            _data = str.encode(_queued.command)
+            self._write_buffer += _data
+            self._unwritten.append([len(_data), _queued])
+
+        if self._write_buffer and not _pending:
+            self._send_buffered()
+            if self._write_buffer:
+                self.ioloop.update_handler(self._fd, READ | WRITE)
+
+        return wait
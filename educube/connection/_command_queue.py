@@ -0,0 +1,159 @@
+"""
+_command_queue.py
+
+Queue of commands waiting to be transmitted to EduCube.
+
+Commands are transmitted in the order they are queued, but no faster than the
+serial link can carry them. A command may be given a key identifying the
+setting it controls (e.g., the reaction wheel, or thermal panel 1). If a
+command with the same key is still waiting when a new one is queued, the
+waiting command is replaced with the new one, keeping its place in the queue.
+Dragging a slider in the web interface therefore sends the latest setpoint as
+soon as the link allows, rather than every intermediate value.
+
+Queuing a command returns a concurrent.futures.Future, which is resolved with
+the command actually transmitted (for a replaced command, the command that
+replaced it), or with the exception raised while transmitting it.
+
+"""
+# standard library imports
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from threading import Lock
+
+CommandQueueStats = namedtuple(
+    'CommandQueueStats', ('depth', 'queued', 'coalesced', 'sent')
+)
+
+
+class QueuedCommand():
+    """A command waiting to be transmitted, and the futures awaiting it."""
+    __slots__ = ('command', 'key', 'futures')
+
+    def __init__(self, command, key):
+        self.command = command
+        self.key = key
+        self.futures = []
+
+    def set_result(self, result):
+        for future in self.futures:
+            if future.set_running_or_notify_cancel():
+                future.set_result(result)
+
+    def set_exception(self, exception):
+        for future in self.futures:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(exception)
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+
+class CommandQueue():
+    """Thread-safe command queue with coalescing and link-rate pacing."""
+    def __init__(self, baud, link_utilisation=0.8):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        baud : int
+            The baud rate of the serial link
+        link_utilisation : float
+            Fraction of the serial link capacity that commands may use
+
+        """
+        # serial frames are 10 bits per byte (start + 8 data + stop)
+        self.bytes_per_s = int(baud) / 10 * link_utilisation
+
+        self._queue = deque()
+        self._pending = dict()      # key -> QueuedCommand
+        self._next_send = 0.0
+        self._lock = Lock()
+
+        self.queued = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, command, key=None):
+        """
+        Add a command to the queue.
+
+        Parameters
+        ----------
+        command : str
+            The complete command to transmit (e.g., '[C|CDH|T]')
+        key : hashable
+            Identifies the setting the command controls. A waiting command
+            with the same key is replaced by this one.
+
+        Returns a tuple (future, coalesced). future is resolved once the
+        command is transmitted. coalesced is True if the command replaced a
+        waiting command.
+
+        """
+        future = Future()
+
+        with self._lock:
+            self.queued += 1
+
+            if key is not None:
+                _waiting = self._pending.get(key)
+                if _waiting is not None:
+                    _waiting.command = command
+                    _waiting.futures.append(future)
+                    self.coalesced += 1
+                    return future, True
+
+            _queued = QueuedCommand(command, key)
+            _queued.futures.append(future)
+            self._queue.append(_queued)
+            if key is not None:
+                self._pending[key] = _queued
+            return future, False
+
+    def pop_ready(self, now):
+        """
+        Remove and return the next command if the link is free at time now.
+
+        Returns a tuple (queued, wait). queued is the next QueuedCommand, or
+        None if no command may be sent yet, in which case wait is the time in
+        seconds until one may be sent, or None if the queue is empty.
+
+        """
+        with self._lock:
+            if not self._queue:
+                return None, None
+
+            if now < self._next_send:
+                return None, self._next_send - now
+
+            _queued = self._queue.popleft()
+            if _queued.key is not None:
+                del self._pending[_queued.key]
+
+            self._next_send = (max(self._next_send, now)
+                               + len(_queued.command) / self.bytes_per_s)
+            self.sent += 1
+            return _queued, 0.0
+
+    def clear(self):
+        """Discard all waiting commands, cancelling their futures."""
+        with self._lock:
+            _queue, self._queue = self._queue, deque()
+            self._pending.clear()
+
+        for _queued in _queue:
+            _queued.cancel()
+
+    def stats(self):
+        """Return the current queue statistics as a CommandQueueStats."""
+        with self._lock:
+            return CommandQueueStats(depth     = len(self._queue),
+                                     queued    = self.queued     ,
+                                     coalesced = self.coalesced  ,
+                                     sent      = self.sent        )
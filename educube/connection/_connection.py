@@ -11,14 +11,22 @@ import tempfile
 import time
 
 #from math import fabs
-from threading import Thread, Lock
+from threading import Thread
 
 # third party imports
 import serial
 
 # local imports
 from educube.util import millis
-from educube.telemetry_parser import parse_educube_telemetry
+from educube.telemetry_parser import (parse_educube_telemetry,
+                                      parse_educube_telemetry_lazy)
+from educube.telemetry_log import (TelemetryLogWriter, LOG_FORMAT_RAW,
+                                   SEGMENT_EXTENSION)
+from ._framing import FrameSplitter, DEFAULT_EOL, DEFAULT_MAX_FRAME_LENGTH
+from ._ringbuffer import TelemetryRingBuffer, DROP_OLDEST
+from ._scheduler import TelemetryRequestScheduler
+from ._command_queue import CommandQueue
+from ._writer import EduCubeCommandWriter
 
 logger = logging.getLogger(__name__)
 
@@ -26,9 +34,26 @@ class EduCubeConnectionError(Exception):
     """Exception to be raised for errors when communicating with EduCube."""
 
 
+def load_simulator():
+    """
+    Return the EduCubeSimulator class. The simulator is only imported when
+    it is used, as it needs pseudo-terminals, which are POSIX only: raises
+    EduCubeConnectionError on other systems (e.g., Windows).
+
+    """
+    try:
+        from educube.simulator import EduCubeSimulator
+    except ImportError as e:
+        errmsg = ("The EduCube simulator is not available on this system: "
+                  "it needs POSIX pseudo-terminals ({e})".format(e=e))
+        raise EduCubeConnectionError(errmsg) from e
+    return EduCubeSimulator
+
+
 class EduCubeConnectionThread(Thread):
     """Thread that records and requests telemetry on serial port."""
-    def __init__(self, master, eol=b'\r\n'):
+    def __init__(self, master, eol=DEFAULT_EOL,
+                 max_frame_length=DEFAULT_MAX_FRAME_LENGTH):
         """
         Constructor
 
@@ -38,56 +63,41 @@ class EduCubeConnectionThread(Thread):
             The controlling interface to the EduCube 
         eol : bytes
             Byte character sequence denoting end-of-line
+        max_frame_length : int
+            Maximum length in bytes of a single message. Longer data without
+            an end-of-line is discarded.
 
         """
         self.master = master
         self.eol = eol
+        self.frames = FrameSplitter(eol, max_frame_length=max_frame_length)
 
         super().__init__()
 
     def run(self): 
         """Thread loop to listen for messages from EduCube."""
-        _buffer = bytearray()
+        connection = self.master.connection
 
         while self.master.running:
-            # check whether there is any telemetry to pick up
-            if self.master.connection.in_waiting:
-                _buffer.extend(self.master.connection.read())
-                # the line terminator can be a multi-character sequence. Check
-                # the current buffer against this termination sequence, and
-                # process the buffer if line is complete
-                if _buffer.endswith(self.eol):
-                    self._process_message(bytes(_buffer))
-                    _buffer = bytearray()
-
-            # check whether it is time to ask for more telemetry
-            if (time.time() - self.master.last_telem_request 
-                    > self.master.telem_request_interval_s  ):
-                self.master.send_request_telem()
-
-        logger.info("EduCubeConnectionThread.run has ended")
+            # block until at least one byte arrives (or the serial timeout
+            # expires), then pick up everything else that is already waiting
+            # in a single read. 
+            _data = connection.read(max(connection.in_waiting, 1))
 
-    def _process_message(self, msg):
-        """Logs all received complete messages, and stores telemetry."""
-        if is_telemetry(msg):
-            time = millis()
-            telem = (time, msg)
+            # the line terminator can be a multi-character sequence, and one
+            # read may contain several complete messages.
+            if _data:
+                _new_telemetry = False
+                for _msg in self.frames.feed(_data):
+                    _new_telemetry |= self.master._process_message(_msg)
 
-            self.master.telemetry_buffer.append(telem)
-            logger.debug(f"Received telemetry: {time} : {msg}")
+                if _new_telemetry:
+                    self.master._notify_telemetry_listeners()
 
-        elif is_debug(msg):
-            logmsg = ("Received {board} DEBUG message:\n"
-                      "        ==> {msg}"
-                      ).format(board=self.master.board_id,
-                               msg=msg)
-            logger.debug(logmsg)
+            # check whether it is time to ask for more telemetry
+            self.master._request_telemetry_if_due()
 
-        else:
-            logmsg = ("Received unrecognised message\n"
-                      "        ==> {msg}"
-                      ).format(msg=msg)
-            logger.warning(logmsg)
+        logger.info("EduCubeConnectionThread.run has ended")
         
 
 def is_telemetry(msg):
@@ -96,6 +106,11 @@ def is_telemetry(msg):
 def is_debug(msg):
     return msg.lstrip().startswith(b'DEBUG|')
 
+def telemetry_board(msg):
+    """Return the board identifier from a telemetry message."""
+    _, _board, *_ = msg.lstrip().split(b'|', 2)
+    return _board.decode('ascii', errors='replace')
+
 
 
 class EduCubeConnection():
@@ -115,14 +130,19 @@ class EduCubeConnection():
     last_telem_request = 0
     telem_log_format = "{timestamp}\t{telemetry}\n"
 
-    telemetry_buffer = []
+    # True if received telemetry is processed on the Tornado IOLoop, so that
+    # telemetry listeners may send it on directly
+    runs_on_ioloop = False
 
     _conn_type = 'data'    # this is almost unnecessary -- it is only included
                            # so that, in principle, fake connections can
                            # easily be given a different default name.
 
-    def __init__(self, portname, board, baud=9600, timeout=5,
-                 output_path=None, telem_request_interval_s=5):
+    def __init__(self, portname, board, baud=9600, timeout=0.1,
+                 write_timeout=1.0, output_path=None, log_options=None,
+                 telem_request_interval_s=5, telemetry_buffer_size=1024,
+                 telemetry_overflow=DROP_OLDEST, device_id=None,
+                 request_boards=None, telem_request_rate_hz=None):
         """
         Constructor. Sets up the EduCubeConnection object. 
 
@@ -134,17 +154,44 @@ class EduCubeConnection():
             The EduCube board 
         baud : int
             The baud rate for serial communications
-        timeout : int
-            The serial port timeout (in seconds)
+        timeout : float
+            The serial port read timeout (in seconds). This is the longest
+            the connection thread blocks waiting for data, so it also sets
+            how promptly telemetry requests are sent and the thread stops.
+        write_timeout : float
+            The serial port write timeout (in seconds). A command that cannot
+            be written within this time fails.
         output_path : str
             Filepath to be used to save telemetry and command logs
+        log_options : dict
+            Keyword arguments for the TelemetryLogWriter that saves the log
+            (e.g., rotate_bytes, fsync, echo)
         telem_request_interval_s : int 
-            Time in seconds between requests for telemetry updates 
+            Time in seconds between requests for telemetry updates from each
+            board, unless telem_request_rate_hz is given
+        telemetry_buffer_size : int
+            Maximum number of received telemetry packets held until they are
+            read with read_telemetry_buffer
+        telemetry_overflow : str
+            Which packets to drop when the telemetry buffer is full:
+            'drop_oldest' or 'drop_newest'
+        device_id : str
+            Identifier for this EduCube, used to tag its telemetry when
+            several EduCubes are connected at once (optional)
+        request_boards : sequence of str
+            Boards to request telemetry from, in turn. Defaults to all boards
+            when connected to the CDH (which relays requests to the other
+            boards), and otherwise to board alone.
+        telem_request_rate_hz : float or dict
+            Target telemetry requests per second, either for every board or
+            as a dict with a rate per board. Requests back off automatically
+            when responses lag, and are limited to what the baud rate allows.
 
         """
         self.portname = portname
         self.baud = baud
         self.serial_timeout = timeout
+        self.write_timeout = write_timeout
 
         if board in self.board_ids:
             self.board_id = board
@@ -152,18 +199,50 @@ class EduCubeConnection():
             errmsg = f'Invalid board identifier {board}'
             raise EduCubeConnectionError(errmsg)
 
+        self.device_id = device_id
+
+        self.log_options = dict(log_options or {})
 
         # file to save telemetry
         if output_path:
             self.output_path = output_path
         else:
-            outfile = ("educube_telemetry_{type}_{time}.raw"\
-                       .format(type=self._conn_type, time=millis()))
+            _type = (self._conn_type if device_id is None
+                     else f'{self._conn_type}_{device_id}')
+            _ext = ('.raw' if self.log_options.get('log_format',
+                                                   LOG_FORMAT_RAW)
+                    == LOG_FORMAT_RAW else SEGMENT_EXTENSION)
+            outfile = ("educube_telemetry_{type}_{time}{ext}"\
+                       .format(type=_type, time=millis(), ext=_ext))
             self.output_path = os.path.join( tempfile.gettempdir(), outfile )
 
+        self.telemetry_log = None
+
         self.telem_request_interval_s = telem_request_interval_s
+
+        if request_boards is None:
+            request_boards = (self.board_ids if board == 'CDH' else (board,))
+        if telem_request_rate_hz is None:
+            telem_request_rate_hz = 1/telem_request_interval_s
+
+        self.scheduler = TelemetryRequestScheduler(
+            request_boards, baud, rate_hz=telem_request_rate_hz
+        )
+        self.command_queue = CommandQueue(baud)
+        self.writer = None
+
         self.running = False
 
+        self.telemetry_buffer = TelemetryRingBuffer(
+            telemetry_buffer_size, overflow=telemetry_overflow
+        )
+        self._telemetry_listeners = []
+
+    @property
+    def devices(self):
+        """Identifiers of the EduCubes served by this connection."""
+        return () if self.device_id is None else (self.device_id,)
+
     ################
     # context manager
     ################
@@ -185,11 +264,16 @@ class EduCubeConnection():
     def setup_connections(self):
         logger.info("STARTUP : Setting up EduCube connections")
 
-        self.output_file = open(self.output_path, 'a')
+        self.telemetry_log = TelemetryLogWriter(
+            self.output_path, line_format=self.telem_log_format,
+            **self.log_options
+        )
+        self.telemetry_log.start()
         logger.info(f"STARTUP : Telemetry will be saved to {self.output_path}")
 
         self.connection = serial.Serial(
-            self.portname, self.baud, timeout=self.serial_timeout
+            self.portname, self.baud, timeout=self.serial_timeout,
+            write_timeout=self.write_timeout
         )
         logger.info(f"STARTUP : Opened Serial connection: {self.connection!r}")
 
@@ -199,10 +283,18 @@ class EduCubeConnection():
         self.connection.close()
         logger.info("SHUTDOWN : Closed Serial connection")
 
-        self.output_file.close()
+        self.telemetry_log.close()
+        logger.info(
+            f"SHUTDOWN : Closed telemetry save file {self.output_path} "
+            f"{self.telemetry_log.stats()}"
+        )
+
         logger.info(
-            f"SHUTDOWN : Closed telemetry save file {self.output_path}"
+            f"SHUTDOWN : Telemetry buffer {self.telemetry_buffer.stats()}"
         )
+        for _stats in self.scheduler.stats():
+            logger.info(f"SHUTDOWN : Telemetry requests {_stats}")
+        logger.info(f"SHUTDOWN : Command queue {self.command_queue.stats()}")
 
     ################
     # thread management
@@ -213,21 +305,34 @@ class EduCubeConnection():
         self.thread = EduCubeConnectionThread(self)
         self.running = True
         self.thread.start()
-        self.lock = Lock()
+
+        logger.debug("STARTUP : Starting EduCubeCommandWriter")
+        self.writer = EduCubeCommandWriter((self,))
+        self.writer.start()
 
     def stop_thread(self):
         logger.debug("SHUTDOWN : Stopping EduCubeConnectionThread")
         self.running = False
         self.thread.join()
 
+        logger.debug("SHUTDOWN : Stopping EduCubeCommandWriter")
+        self.writer.stop()
+        self.writer = None
+        self.command_queue.clear()
+
     # ******************************
     # Telemetry & command callbacks
     # ******************************
     # ultimately, the arguments here should probably be changed to something
     # more flexible.  We would then be able to send user input from the UI to
     # do things like change playback rate???
-    def process_command(self, board=None, command=None, settings=None):
+    def process_command(self, board=None, command=None, settings=None,
+                        device=None):
         """."""
+        if device is not None and device != self.device_id:
+            errmsg = f'Command for unknown EduCube {device}'
+            raise EduCubeConnectionError(errmsg)
+
         if command == 'T':
             return self.send_request_telem(board=board)
     
@@ -255,14 +360,24 @@ class EduCubeConnection():
     # basic commands
     ################
 
-    def send_command(self, cmd):
+    def send_command(self, cmd, key=None):
         """
-        Formats and transmits a command to EduCube
+        Formats and queues a command to be transmitted to EduCube
 
         Parameters
         ----------
         cmd : str
             The command to be sent (e.g., C|CDH|T)
+        key : tuple
+            Identifies the setting the command controls. A queued command
+            with the same key that has not yet been transmitted is replaced
+            by this one.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolved with the transmitted command string once it has been
+            written, or with the exception raised while writing it.
 
         """
         cmd_structure = ('{cmd_start}{cmd}{cmd_end}'\
@@ -270,24 +385,66 @@ class EduCubeConnection():
                                  cmd_end=str(self.syntax_command_end)    ,
                                  cmd=str(cmd)                             ))
 
+        future, coalesced = self.command_queue.put(cmd_structure, key=key)
+        if coalesced:
+            logger.debug(f"Replaced queued command with: '{cmd_structure}'")
+        else:
+            logger.debug(f"Queued command: '{cmd_structure}'")
+
+        self._command_queued()
+        return future
+
+    def _command_queued(self):
+        """Called after a command is queued, to wake the writer."""
+        if self.writer is not None:
+            self.writer.wake()
+
+    def _transmit_queued(self):
+        """
+        Transmit queued commands as fast as the link allows. Returns the time
+        in seconds until the next command may be sent, or None if the queue
+        is empty.
+
+        """
+        while True:
+            _queued, wait = self.command_queue.pop_ready(time.monotonic())
+            if _queued is None:
+                return wait
+
+            try:
+                self._transmit_command(_queued.command)
+            except Exception as exc:
+                _queued.set_exception(exc)
+            else:
+                _queued.set_result(_queued.command)
+
+    def _transmit_command(self, cmd_structure):
+        """
+        Transmits a formatted command to EduCube and logs it to file. Raises
+        an exception if the command could not be written.
+
+        """
         logger.info("Writing command: '{cmd}'".format(cmd=cmd_structure))
 
         try:
-            self.connection.write(str.encode(cmd_structure))
-            self.connection.flush()
+            self._write(str.encode(cmd_structure))
         except:
-            errmsg = "Encountered Error while sending command", 
+            errmsg = "Encountered Error while sending command"
             logger.exception(errmsg, exc_info=True)
+            raise
 
-        _cmd_string = self.telem_log_format\
-            .format(timestamp=millis(),
-                    telemetry="COMMAND_SENT: {cmd}".format(cmd=cmd_structure))
-        try:
-            self.output_file.write(_cmd_string)
-            print(_cmd_string)
-        except:
-            errmsg = "Encountered Error while logging sent command to file"
-            logger.exception(errmsg, exc_info=True)
+        self._command_sent(cmd_structure)
+
+    def _command_sent(self, cmd_structure):
+        """Logs a command that has been written to EduCube to file."""
+        self.telemetry_log.write(
+            millis(), "COMMAND_SENT: {cmd}".format(cmd=cmd_structure)
+        )
+
+    def _write(self, data):
+        """Transmit raw bytes over the serial connection."""
+        self.connection.write(data)
+        self.connection.flush()
 
     ################
     # specific commands
@@ -313,17 +470,31 @@ class EduCubeConnection():
         logger.debug(f"Requesting telemetry from board {board}")
 
         cmd = f'C|{board}|T'
-        self.send_command(cmd)
+        future = self.send_command(cmd, key=(board, 'T'))
 
         # update last_telem_request time
         self.last_telem_request = time.time()
+        self.scheduler.request_sent(board, time.monotonic())
+        return future
+
+    def _request_telemetry_if_due(self):
+        """
+        Send a telemetry request if the scheduler says one is due. Returns the
+        time in seconds until the next request may be due.
+
+        """
+        _board = self.scheduler.next_request(time.monotonic())
+        if _board is not None:
+            self.send_request_telem(board=_board)
+
+        return self.scheduler.time_until_next(time.monotonic())
 
     def send_set_blinky(self):
         """
         Light EduCube up like a Christmas Tree!
         """
         cmd = 'C|CDH|BLINKY'
-        self.send_command(cmd)
+        return self.send_command(cmd)
 
     def send_set_magtorquer(self, axis, sign):
         """
@@ -357,7 +528,7 @@ class EduCubeConnection():
             raise EduCubeConnectionError(errmsg)
 
         cmd = 'C|ADC|MAG|{axis}|{sign}'.format(axis=axis.upper(),sign=sign)
-        self.send_command(cmd)
+        return self.send_command(cmd, key=('ADC', 'MAG', axis.upper()))
 
     def send_set_reaction_wheel(self, val):
         """
@@ -377,7 +548,7 @@ class EduCubeConnection():
         _mag = int(abs(val))
 
         cmd = f'C|ADC|REACT|{_sgn}|{_mag}'
-        self.send_command(cmd)
+        return self.send_command(cmd, key=('ADC', 'REACT'))
 
     def send_set_thermal_panel(self, panel, val):
         """
@@ -406,7 +577,7 @@ class EduCubeConnection():
             raise EduCubeConnectionError(errmsg)
 
         cmd = f'C|EXP|HEAT|{panel}|{val}'
-        self.send_command(cmd)
+        return self.send_command(cmd, key=('EXP', 'HEAT', panel))
 
     def send_set_chip_power_on(self, command_id):
         """
@@ -419,7 +590,7 @@ class EduCubeConnection():
 
         """
         cmd = f'C|EPS|PWR_ON|{command_id}'
-        self.send_command(cmd)
+        return self.send_command(cmd, key=('EPS', 'PWR', command_id))
 
     def send_set_chip_power_off(self, command_id):
         """
@@ -432,45 +603,117 @@ class EduCubeConnection():
 
         """
         cmd = f'C|EPS|PWR_OFF|{command_id}'
-        self.send_command(cmd)
+        return self.send_command(cmd, key=('EPS', 'PWR', command_id))
 
 
+    ################
+    # received messages
+    ################
+
+    def _process_message(self, msg):
+        """
+        Logs all received complete messages, and stores telemetry.
+
+        Returns True if the message was telemetry.
+
+        """
+        if is_telemetry(msg):
+            timestamp = millis()
+            telem = (timestamp, msg)
+
+            self.telemetry_buffer.append(telem)
+            logger.debug(f"Received telemetry: {timestamp} : {msg}")
+
+            self.scheduler.response_received(
+                telemetry_board(msg), time.monotonic(), len(msg)
+            )
+            return True
+
+        if is_debug(msg):
+            logmsg = ("Received {board} DEBUG message:\n"
+                      "        ==> {msg}"
+                      ).format(board=self.board_id,
+                               msg=msg)
+            logger.debug(logmsg)
+
+        else:
+            logmsg = ("Received unrecognised message\n"
+                      "        ==> {msg}"
+                      ).format(msg=msg)
+            logger.warning(logmsg)
+
+        return False
+
+    def add_telemetry_listener(self, callback):
+        """
+        Register a function to be called when new telemetry is buffered.
+
+        The callback takes no arguments. It is called from whichever thread
+        receives the telemetry, so it should do no more than schedule the
+        buffer to be read (e.g., with IOLoop.add_callback).
+
+        """
+        self._telemetry_listeners.append(callback)
+
+    def remove_telemetry_listener(self, callback):
+        """Unregister a function added with add_telemetry_listener."""
+        self._telemetry_listeners.remove(callback)
+
+    def _notify_telemetry_listeners(self):
+        for callback in self._telemetry_listeners:
+            try:
+                callback()
+            except:
+                errmsg = "Encountered Error in telemetry listener"
+                logger.exception(errmsg, exc_info=True)
+
     ################
     # methods to return telemetry
     ################
 
     def read_telemetry_buffer(self):
-        """."""
-
-        with self.lock:   # is this lock needed???
-            raw_telemetry = self.telemetry_buffer[:]
-            self.telemetry_buffer = []
+        """Remove and return all buffered (timestamp, bytes) telemetry."""
+        raw_telemetry = self.telemetry_buffer.drain()
 
         self._write_telemetry_to_file(raw_telemetry)
         return raw_telemetry
 
-    # NEED TO HANDLE DECODING ERRORS ROBUSTLY???       
     def _write_telemetry_to_file(self, telemetry_buffer):
-        """."""
-        for _timestamp, _telemetry_bytes in telemetry_buffer:
-            _telemetry_str = self.telem_log_format.format(
-                timestamp = _timestamp                              ,
-                telemetry = _telemetry_bytes.decode('utf-8').strip() 
-            )
-
-            self.output_file.write(_telemetry_str)
-            print(_telemetry_str) # THIS IS A TEMPORARY MEASURE TO ALLOW
-                                  # IMMEDIATE VIEWING.
+        """Queue (timestamp, bytes) telemetry to be saved to the log."""
+        self.telemetry_log.extend(telemetry_buffer)
 
     # WHAT ABOUT UNCAUGHT PARSING ERRORS???
-    def parse_telemetry(self):
-        """."""
+    def parse_telemetry(self, lazy=False):
+        """
+        Parse all buffered telemetry.
+
+        Parameters
+        ----------
+        lazy : bool
+            Return LazyTelemetry, whose data is only parsed when it is read,
+            rather than Telemetry
+
+        Returns a list of telemetry, with None for packets that could not be
+        parsed.
+
+        """
         _raw_telemetry = self.read_telemetry_buffer()
 
+        if lazy:
+            return [
+                parse_educube_telemetry_lazy(
+                    _timestamp,
+                    _telemetry_bytes,
+                    device = self.device_id
+                )
+                for _timestamp, _telemetry_bytes in _raw_telemetry
+            ]
+
         parsed_telemetry = [
             parse_educube_telemetry(
                 _timestamp                      ,
-                _telemetry_bytes.decode('utf-8')
+                _telemetry_bytes.decode('utf-8'),
+                device = self.device_id
             )
             for _timestamp, _telemetry_bytes in _raw_telemetry
         ]
@@ -482,20 +725,56 @@ class EduCubeConnection():
 ##############################################################################
 
 class FakeEduCubeConnection(EduCubeConnection):
+    """
+    EduCubeConnection to a simulated EduCube.
+
+    An EduCubeSimulator is started on a pseudo-terminal, and the connection
+    opens it like any other serial port, so telemetry is requested, received
+    and logged as for real hardware. The portname is ignored.
+
+    """
+    _conn_type = 'fake'
+
+    def __init__(self, portname, board, baud=9600, simulator_options=None,
+                 **kwargs):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        simulator_options : dict
+            Keyword arguments for EduCubeSimulator (e.g., rate_hz,
+            exp_truncation). The simulated board and baud rate are those of
+            the connection.
+
+        All other arguments are as for EduCubeConnection. Raises
+        EduCubeConnectionError if the simulator is not available on this
+        system.
+
+        """
+        self._simulator_class = load_simulator()
+        super().__init__(portname, board, baud=baud, **kwargs)
+
+        self.simulator_options = dict(simulator_options or {})
+        self.simulator_options.setdefault('board', board)
+        self.simulator_options.setdefault('baud', baud)
+        self.simulator = None
 
     def setup_connections(self):
         logger.info("Setting up FAKE EduCube connections")
 
-        self.output_file = open(self.output_path, 'a')
-        fd, filename = tempfile.mkstemp()
-        self.connection = os.fdopen(fd, "w")
-        logger.debug(f"Using fake serial connection to: {filename}")
+        self.simulator = self._simulator_class(**self.simulator_options)
+        self.simulator.start()
+        self.portname = self.simulator.port
+
+        super().setup_connections()
 
     def teardown_connections(self):
         logger.info("Tearing down FAKE EduCube connections")
 
-    def send_request_telem(self):
-        logger.info("Fake connection: ignoring telem request")
+        super().teardown_connections()
+        self.simulator.stop()
+        self.simulator = None
 
 
 ##############################################################################
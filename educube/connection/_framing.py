@@ -0,0 +1,142 @@
+"""
+_framing.py
+
+Splits the byte stream received from EduCube into complete messages.
+
+EduCube terminates each message with a (possibly multi-byte) end-of-line
+sequence. Serial reads return arbitrary chunks of the stream, so a single read
+may contain several messages, or only part of one. FrameSplitter accumulates
+the chunks and returns each message as soon as its terminator arrives.
+
+"""
+# standard library imports
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EOL = b'\r\n'
+DEFAULT_MAX_FRAME_LENGTH = 4096
+
+
+class FrameSplitter():
+    """Incremental splitter for end-of-line terminated messages."""
+    def __init__(self, eol=DEFAULT_EOL,
+                 max_frame_length=DEFAULT_MAX_FRAME_LENGTH):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        eol : bytes
+            Byte character sequence denoting end-of-line
+        max_frame_length : int
+            Maximum length in bytes (including eol) of a single message. Data
+            that exceeds this without a terminator is discarded.
+
+        """
+        if not eol:
+            raise ValueError('eol must be a non-empty byte sequence')
+
+        if max_frame_length < len(eol):
+            errmsg = f'max_frame_length {max_frame_length} shorter than eol'
+            raise ValueError(errmsg)
+
+        self.eol = bytes(eol)
+        self.max_frame_length = max_frame_length
+
+        self._buffer = bytearray()
+        # position in _buffer from which to resume searching for eol. Bytes
+        # before this are known not to contain the start of a terminator.
+        self._search_start = 0
+        # set while discarding the remainder of an oversized frame
+        self._discarding = False
+
+        self.frames = 0
+        self.discarded_frames = 0
+        self.discarded_bytes = 0
+
+    def __len__(self):
+        """Number of buffered bytes not yet part of a complete frame."""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+        Add received data and return any messages it completes.
+
+        Parameters
+        ----------
+        data : bytes-like
+            The bytes most recently read from the serial port
+
+        Returns
+        -------
+        list of bytes
+            Complete messages, each including its eol terminator
+
+        """
+        buf = self._buffer
+        buf += data
+
+        eol = self.eol
+        eol_len = len(eol)
+        max_len = self.max_frame_length
+
+        frames = []
+        start = 0
+        pos = buf.find(eol, self._search_start)
+
+        # a single memoryview is used to slice out frames, so that each
+        # frame is copied exactly once. It must be released before the
+        # buffer is resized.
+        with memoryview(buf) as view:
+            while pos >= 0:
+                end = pos + eol_len
+
+                if self._discarding:
+                    # tail end of an oversized frame -- drop it
+                    self._discarding = False
+                    self.discarded_bytes += end - start
+                elif end - start > max_len:
+                    self._discard_frame(end - start)
+                else:
+                    frames.append(bytes(view[start:end]))
+
+                start = end
+                pos = buf.find(eol, start)
+
+        if start:
+            del buf[:start]
+
+        # garbage without a terminator: keep only enough to complete a
+        # terminator split across reads, and drop everything up to the next
+        # eol
+        if len(buf) > max_len:
+            keep = eol_len - 1
+            self._discard_frame(len(buf) - keep, partial=True)
+            del buf[:len(buf) - keep]
+
+        # any terminator must start at least eol_len-1 bytes before the end
+        self._search_start = max(len(buf) - eol_len + 1, 0)
+
+        self.frames += len(frames)
+        return frames
+
+    def _discard_frame(self, nbytes, partial=False):
+        """Account for and log a discarded oversized frame."""
+        self.discarded_bytes += nbytes
+
+        if partial:
+            if self._discarding:
+                return
+            self._discarding = True
+
+        self.discarded_frames += 1
+        logmsg = ("Discarding {n} bytes without end-of-line (maximum frame "
+                  "length {m})").format(n=nbytes, m=self.max_frame_length)
+        logger.warning(logmsg)
+
+    def reset(self):
+        """Discard any partially received message."""
+        self._buffer.clear()
+        self._search_start = 0
+        self._discarding = False
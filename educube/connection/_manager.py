@@ -0,0 +1,258 @@
+"""
+_manager.py
+
+Serves several EduCubes from a single process.
+
+EduCubeConnectionManager owns one EduCubeConnection per EduCube, but instead
+of starting threads for each, it runs a single thread that waits on all of
+the serial ports at once with a selector, and a single thread that transmits
+queued commands to all of them. Each connection keeps its own
+telemetry buffer and log file, and tags its telemetry with its device_id.
+
+The manager provides the same interface to the web server as a single
+EduCubeConnection: telemetry from all devices is returned together, and
+commands are routed by their device identifier.
+
+Waiting on serial ports with a selector is only possible on POSIX systems.
+
+"""
+# standard library imports
+import logging
+import selectors
+
+from threading import Thread
+
+# local imports
+from ._connection import EduCubeConnection, EduCubeConnectionError
+from ._framing import FrameSplitter, DEFAULT_EOL, DEFAULT_MAX_FRAME_LENGTH
+from ._writer import EduCubeCommandWriter
+
+logger = logging.getLogger(__name__)
+
+
+class EduCubeManagerThread(Thread):
+    """Thread that records and requests telemetry on several serial ports."""
+    def __init__(self, manager, eol=DEFAULT_EOL,
+                 max_frame_length=DEFAULT_MAX_FRAME_LENGTH, poll_interval=0.1):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        manager : EduCubeConnectionManager
+            The controlling interface to the EduCubes
+        eol : bytes
+            Byte character sequence denoting end-of-line
+        max_frame_length : int
+            Maximum length in bytes of a single message.
+        poll_interval : float
+            Longest time in seconds to wait for data before checking whether
+            the thread should stop.
+
+        """
+        self.manager = manager
+        self.eol = eol
+        self.max_frame_length = max_frame_length
+        self.poll_interval = poll_interval
+
+        super().__init__()
+
+    def run(self):
+        """Thread loop to listen for messages from all EduCubes."""
+        with selectors.DefaultSelector() as selector:
+            for conn in self.manager.connections.values():
+                frames = FrameSplitter(
+                    self.eol, max_frame_length=self.max_frame_length
+                )
+                selector.register(
+                    conn.connection, selectors.EVENT_READ, (conn, frames)
+                )
+
+            while self.manager.running:
+                # queue requests that are due, then wait until data arrives
+                # on any port, or until the next request is due
+                _wait = self.poll_interval
+                for conn in self.manager.connections.values():
+                    _wait = min(_wait, conn._request_telemetry_if_due())
+
+                _ready = selector.select(timeout=max(_wait, 0))
+                for key, _ in _ready:
+                    conn, frames = key.data
+                    self._read_connection(conn, frames)
+
+        logger.info("EduCubeManagerThread.run has ended")
+
+    def _read_connection(self, conn, frames):
+        """Read and process everything waiting on one serial port."""
+        try:
+            _data = conn.connection.read(max(conn.connection.in_waiting, 1))
+        except:
+            errmsg = ("Encountered Error while reading from EduCube "
+                      f"{conn.device_id}")
+            logger.exception(errmsg, exc_info=True)
+            return
+
+        _new_telemetry = False
+        for _msg in frames.feed(_data):
+            _new_telemetry |= conn._process_message(_msg)
+
+        if _new_telemetry:
+            conn._notify_telemetry_listeners()
+
+
+class EduCubeConnectionManager():
+    """
+    Interface to send commands to and receive telemetry from several EduCubes.
+
+    """
+    # telemetry is received on the manager thread, not the IOLoop
+    runs_on_ioloop = False
+
+    def __init__(self, connections):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        connections : iterable of EduCubeConnection
+            The connections to manage. Each must have a unique device_id.
+
+        """
+        self.connections = dict()
+        for conn in connections:
+            if conn.device_id is None or conn.device_id in self.connections:
+                errmsg = f'Invalid or duplicate device_id {conn.device_id!r}'
+                raise EduCubeConnectionError(errmsg)
+            self.connections[conn.device_id] = conn
+
+        self.running = False
+
+    @property
+    def devices(self):
+        """Identifiers of the managed EduCubes."""
+        return tuple(self.connections)
+
+    @property
+    def output_paths(self):
+        """Telemetry log file for each managed EduCube."""
+        return {device: conn.output_path
+                for device, conn in self.connections.items()}
+
+    def __getitem__(self, device):
+        try:
+            return self.connections[device]
+        except KeyError:
+            errmsg = f'Unknown EduCube {device!r}'
+            raise EduCubeConnectionError(errmsg)
+
+    ################
+    # context manager
+    ################
+
+    def __enter__(self):
+        self.setup_connections()
+        self.start_thread()
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.stop_thread()
+        self.teardown_connections()
+        return False
+
+    ################
+    # setup/teardown
+    ################
+
+    def setup_connections(self):
+        for conn in self.connections.values():
+            conn.setup_connections()
+
+    def teardown_connections(self):
+        for conn in self.connections.values():
+            try:
+                conn.teardown_connections()
+            except:
+                errmsg = ("Encountered Error while closing EduCube "
+                          f"{conn.device_id}")
+                logger.exception(errmsg, exc_info=True)
+
+    ################
+    # thread management
+    ################
+
+    def start_thread(self):
+        logger.debug("STARTUP : Starting EduCubeManagerThread")
+        self.thread = EduCubeManagerThread(self)
+        self.running = True
+        for conn in self.connections.values():
+            conn.running = True
+        self.thread.start()
+
+        logger.debug("STARTUP : Starting EduCubeCommandWriter")
+        self.writer = EduCubeCommandWriter(self.connections.values())
+        for conn in self.connections.values():
+            conn.writer = self.writer
+        self.writer.start()
+
+    def stop_thread(self):
+        logger.debug("SHUTDOWN : Stopping EduCubeManagerThread")
+        self.running = False
+        self.thread.join()
+        for conn in self.connections.values():
+            conn.running = False
+
+        logger.debug("SHUTDOWN : Stopping EduCubeCommandWriter")
+        self.writer.stop()
+        for conn in self.connections.values():
+            conn.writer = None
+            conn.command_queue.clear()
+
+    # ******************************
+    # Telemetry & command callbacks
+    # ******************************
+
+    def process_command(self, device=None, **kwargs):
+        """Pass a command to the EduCube identified by device."""
+        if device is None and len(self.connections) == 1:
+            device, = self.connections
+
+        return self[device].process_command(device=device, **kwargs)
+
+    def add_telemetry_listener(self, callback):
+        """Register callback with every managed connection."""
+        for conn in self.connections.values():
+            conn.add_telemetry_listener(callback)
+
+    def remove_telemetry_listener(self, callback):
+        for conn in self.connections.values():
+            conn.remove_telemetry_listener(callback)
+
+    def parse_telemetry(self, lazy=False):
+        """Parse the buffered telemetry from all managed EduCubes."""
+        parsed_telemetry = []
+        for conn in self.connections.values():
+            parsed_telemetry.extend(conn.parse_telemetry(lazy=lazy))
+        return parsed_telemetry
+
+
+def configure_connection_manager(ports, board, baud, **kwargs):
+    """
+    Creates an EduCubeConnectionManager for several EduCubes.
+
+    Parameters
+    ----------
+    ports : dict
+        Mapping of device identifier to serial port name
+    board : str
+        The EduCube board each serial port is connected to
+    baud : int
+        The baud rate for serial communications
+
+    All other keyword arguments are passed to each EduCubeConnection.
+
+    """
+    connections = [
+        EduCubeConnection(port, board, baud=baud, device_id=device, **kwargs)
+        for device, port in ports.items()
+    ]
+    return EduCubeConnectionManager(connections)
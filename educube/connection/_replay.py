@@ -0,0 +1,299 @@
+"""
+_replay.py
+
+Replays a recorded telemetry log in place of a live EduCube.
+
+EduCubeReplayConnection stands in for EduCubeConnection: the web server reads
+replayed telemetry from it exactly as it would from a serial port. The log is
+streamed from disk, never loaded whole, and its packets are released with
+their original spacing scaled by the playback speed, or as fast as they are
+consumed. Playback can be paused, resumed, re-timed and moved to another
+point of the recording while it runs, including from the web interface with
+'REPLAY' commands:
+
+    { 'board' : 'REPLAY', 'command' : 'PAUSE'  , 'settings' : {} }
+    { 'board' : 'REPLAY', 'command' : 'RESUME' , 'settings' : {} }
+    { 'board' : 'REPLAY', 'command' : 'SPEED'  , 'settings' : {'speed': 4} }
+    { 'board' : 'REPLAY', 'command' : 'SEEK'   , 'settings' : {'time': ms} }
+
+Only telemetry is replayed; the commands recorded in the log are skipped.
+
+"""
+# standard library imports
+import logging
+import time
+
+from collections import namedtuple
+from concurrent.futures import Future
+from threading import Thread, Event
+
+# local imports
+from educube.telemetry_log import iter_log
+from ._connection import EduCubeConnection, EduCubeConnectionError
+
+logger = logging.getLogger(__name__)
+
+# longest time the replay thread waits before checking whether to stop
+POLL_INTERVAL_S = 0.1
+
+# when replaying as fast as possible, at most this fraction of the telemetry
+# buffer is filled before waiting for it to be read
+FAST_BUFFER_FILL = 0.5
+
+ReplayStats = namedtuple(
+    'ReplayStats',
+    ('packets', 'bytes', 'skipped', 'elapsed_s', 'packets_per_s',
+     'bytes_per_s', 'position', 'finished')
+)
+
+
+class EduCubeReplayThread(Thread):
+    """Thread that releases recorded telemetry with its original timing."""
+    def __init__(self, master):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        master : EduCubeReplayConnection
+            The connection to replay telemetry into
+
+        """
+        self.master = master
+        super().__init__()
+
+    def run(self):
+        """Thread loop to replay the recording until stopped."""
+        master = self.master
+
+        while master.running:
+            _seek_to, master._seek_to = master._seek_to, None
+            _packets = master.packets
+            self._play(_seek_to)
+
+            if master._seek_to is None and master.running:
+                # stop at the end, unless looping over a non-empty replay
+                if not master.loop or master.packets == _packets:
+                    master.finished = True
+                    # wait for a seek, or to be stopped
+                    while master.running and master._seek_to is None:
+                        master._wake.wait(POLL_INTERVAL_S)
+                        master._wake.clear()
+                    master.finished = False
+
+        logger.info("EduCubeReplayThread.run has ended")
+
+    def _play(self, t_start):
+        """Replay from time t_start, until the end or a seek."""
+        master = self.master
+        buffer = master.telemetry_buffer
+        _fill_limit = max(1, int(buffer.capacity * FAST_BUFFER_FILL))
+
+        _base_ts = None
+        _base_wall = None
+        _unnotified = 0
+
+        for path in master.paths:
+            for _timestamp, _telemetry in iter_log(path, t_start=t_start):
+                if not _telemetry.startswith('T|'):
+                    master.skipped += 1
+                    continue
+
+                # wait until the packet is due (or, at full speed, until
+                # there is space for it), checking for control changes
+                while True:
+                    if not master.running or master._seek_to is not None:
+                        return
+
+                    if master._rebase:
+                        master._rebase = False
+                        _base_ts = None
+
+                    if master.paused:
+                        _wait = POLL_INTERVAL_S
+                    elif not master.speed:
+                        if len(buffer) < _fill_limit:
+                            break
+                        _wait = 0.005
+                    else:
+                        if _base_ts is None:
+                            _base_ts = _timestamp
+                            _base_wall = time.monotonic()
+                        _due = _base_wall + ((_timestamp - _base_ts)
+                                             / 1000 / master.speed)
+                        _wait = _due - time.monotonic()
+                        if _wait <= 0:
+                            break
+
+                    if _unnotified:
+                        master._notify_telemetry_listeners()
+                        _unnotified = 0
+                    master._wake.wait(min(_wait, POLL_INTERVAL_S))
+                    master._wake.clear()
+
+                _data = _telemetry.encode('utf-8')
+                buffer.append((_timestamp, _data))
+                master.position = _timestamp
+                master.packets += 1
+                master.bytes += len(_data)
+                _unnotified += 1
+
+            t_start = None
+
+        if _unnotified:
+            master._notify_telemetry_listeners()
+
+
+class EduCubeReplayConnection(EduCubeConnection):
+    """
+    Replays recorded telemetry logs through the EduCubeConnection interface.
+
+    """
+    _conn_type = 'replay'
+
+    def __init__(self, paths, speed=1.0, start=None, loop=False, **kwargs):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        paths : str or sequence of str
+            The recorded .raw logs or segment recordings, replayed in order
+            (e.g., the files of a rotated log)
+        speed : float
+            Playback speed relative to the original timing. None or 0 replays
+            as fast as the telemetry is read.
+        start : int
+            Timestamp (UNIX time in ms) from which to start the replay.
+            Defaults to the start of the recording.
+        loop : bool
+            Start again from the beginning after the last packet
+
+        All other keyword arguments are passed to EduCubeConnection (e.g.,
+        telemetry_buffer_size, device_id).
+
+        """
+        if isinstance(paths, str):
+            paths = (paths,)
+        self.paths = tuple(paths)
+
+        kwargs.setdefault('output_path', self.paths[0])
+        super().__init__(self.paths[0], 'CDH', **kwargs)
+
+        self.speed = speed
+        self.loop = loop
+        self.paused = False
+        self.finished = False
+        self.position = None
+
+        self._seek_to = start
+        self._rebase = False
+        self._wake = Event()
+
+        self.packets = 0
+        self.bytes = 0
+        self.skipped = 0
+        self._started = None
+
+    ################
+    # setup/teardown
+    ################
+
+    def setup_connections(self):
+        logger.info(f"STARTUP : Replaying {', '.join(self.paths)}")
+
+    def teardown_connections(self):
+        logger.info(f"SHUTDOWN : Replay {self.stats()}")
+
+    ################
+    # thread management
+    ################
+
+    def start_thread(self):
+        logger.debug("STARTUP : Starting EduCubeReplayThread")
+        self.thread = EduCubeReplayThread(self)
+        self.running = True
+        self._started = time.monotonic()
+        self.thread.start()
+
+    def stop_thread(self):
+        logger.debug("SHUTDOWN : Stopping EduCubeReplayThread")
+        self.running = False
+        self._wake.set()
+        self.thread.join()
+
+    # ******************************
+    # playback control
+    # ******************************
+    def pause(self):
+        self.paused = True
+        self._wake.set()
+
+    def resume(self):
+        self.paused = False
+        self._rebase = True
+        self._wake.set()
+
+    def set_speed(self, speed):
+        """Set the playback speed (None or 0: as fast as possible)."""
+        if speed is not None and speed < 0:
+            raise EduCubeConnectionError(f'Invalid replay speed {speed}')
+        self.speed = speed
+        self._rebase = True
+        self._wake.set()
+
+    def seek(self, timestamp):
+        """Continue the replay from timestamp (UNIX time in ms)."""
+        self._seek_to = int(timestamp)
+        self._wake.set()
+
+    def stats(self):
+        """Return the replay throughput as a ReplayStats."""
+        _elapsed = (0.0 if self._started is None
+                    else time.monotonic() - self._started)
+        _per_s = 1 / _elapsed if _elapsed > 0 else 0.0
+        return ReplayStats(packets       = self.packets          ,
+                           bytes         = self.bytes            ,
+                           skipped       = self.skipped          ,
+                           elapsed_s     = _elapsed              ,
+                           packets_per_s = self.packets * _per_s ,
+                           bytes_per_s   = self.bytes * _per_s   ,
+                           position      = self.position         ,
+                           finished      = self.finished          )
+
+    # ******************************
+    # Telemetry & command callbacks
+    # ******************************
+    def process_command(self, board=None, command=None, settings=None,
+                        device=None):
+        """Handle a REPLAY playback command. Returns a completed Future."""
+        if device is not None and device != self.device_id:
+            errmsg = f'Command for unknown EduCube {device}'
+            raise EduCubeConnectionError(errmsg)
+
+        if board != 'REPLAY':
+            errmsg = 'Commands cannot be sent to a replayed recording'
+            raise EduCubeConnectionError(errmsg)
+
+        settings = settings or {}
+        if command == 'PAUSE':
+            self.pause()
+        elif command == 'RESUME':
+            self.resume()
+        elif command == 'SPEED':
+            self.set_speed(settings.get('speed'))
+        elif command == 'SEEK':
+            self.seek(settings['time'])
+        else:
+            return None
+
+        future = Future()
+        future.set_result(f'REPLAY|{command}')
+        return future
+
+    def send_command(self, cmd, key=None):
+        errmsg = 'Commands cannot be sent to a replayed recording'
+        raise EduCubeConnectionError(errmsg)
+
+    def _write_telemetry_to_file(self, telemetry_buffer):
+        """Replayed telemetry is already recorded."""
@@ -0,0 +1,140 @@
+"""
+_ringbuffer.py
+
+Fixed-capacity buffer used to pass received telemetry from the thread that
+reads the serial port to the code that consumes it.
+
+TelemetryRingBuffer supports exactly one producer and one consumer, which may
+be running in different threads. Neither side takes a lock: the producer only
+ever advances the write count and the consumer only ever advances the read
+count. Each of these is a single attribute assignment, which is atomic. Slots
+store (count, item) pairs, so that the consumer can tell whether a slot has
+been overwritten by the producer while it was being read.
+
+"""
+# standard library imports
+from collections import namedtuple
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+RingBufferStats = namedtuple(
+    'RingBufferStats',
+    ('capacity', 'size', 'enqueued', 'dropped', 'high_water')
+)
+
+
+class TelemetryRingBuffer():
+    """Bounded single-producer, single-consumer queue with drop accounting."""
+    def __init__(self, capacity=1024, overflow=DROP_OLDEST):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        capacity : int
+            Maximum number of items held at once
+        overflow : str
+            What to do when an item is added to a full buffer: 'drop_oldest'
+            discards the oldest unread item, 'drop_newest' discards the item
+            being added.
+
+        """
+        if capacity < 1:
+            raise ValueError(f'Invalid ring buffer capacity {capacity}')
+
+        if overflow not in OVERFLOW_POLICIES:
+            errmsg = (f'Invalid overflow policy {overflow!r} '
+                      f'(must be one of {OVERFLOW_POLICIES})')
+            raise ValueError(errmsg)
+
+        self.capacity = capacity
+        self.overflow = overflow
+
+        self._slots = [None] * capacity
+        self._written = 0       # only modified by the producer
+        self._read = 0          # only modified by the consumer
+
+        # counters. dropped is modified by the producer under 'drop_newest',
+        # and by the consumer under 'drop_oldest'
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        """Number of unread items (never more than capacity)."""
+        return min(self._written - self._read, self.capacity)
+
+    # ******************************
+    # producer
+    # ******************************
+    def append(self, item):
+        """
+        Add an item to the buffer. Must only be called by the producer.
+
+        Returns False if the item was dropped because the buffer was full.
+
+        """
+        _written = self._written
+        _size = _written - self._read
+
+        if _size >= self.capacity:
+            if self.overflow == DROP_NEWEST:
+                self.dropped += 1
+                return False
+            # DROP_OLDEST: overwrite the oldest slot. The consumer notices
+            # that it has been lapped and accounts for the dropped items.
+            _size = self.capacity - 1
+
+        self._slots[_written % self.capacity] = (_written, item)
+        self._written = _written + 1
+
+        self.enqueued += 1
+        if _size + 1 > self.high_water:
+            self.high_water = _size + 1
+        return True
+
+    # ******************************
+    # consumer
+    # ******************************
+    def drain(self):
+        """
+        Remove and return all unread items, oldest first. Must only be called
+        by the consumer.
+
+        """
+        _read = self._read
+        _written = self._written
+        if _written == _read:
+            return []
+
+        capacity = self.capacity
+        _start = max(_read, _written - capacity)
+
+        _first = _start % capacity
+        _last = _written % capacity
+        if _first < _last:
+            items = self._slots[_first:_last]
+        else:
+            items = self._slots[_first:] + self._slots[:_last]
+
+        # under 'drop_oldest' the producer may have overwritten some of the
+        # slots just read with newer items. These are left for the next
+        # drain, and the items they replaced are counted as dropped.
+        items = [item for count, item in items if count < _written]
+
+        if self.overflow == DROP_OLDEST:
+            self.dropped += (_written - _read) - len(items)
+
+        self._read = _written
+        return items
+
+    def stats(self):
+        """Return the current buffer statistics as a RingBufferStats."""
+        return RingBufferStats(capacity   = self.capacity  ,
+                               size       = len(self)      ,
+                               enqueued   = self.enqueued  ,
+                               dropped    = self.dropped   ,
+                               high_water = self.high_water )
@@ -0,0 +1,279 @@
+"""
+_scheduler.py
+
+Decides when to request telemetry from each EduCube board.
+
+Telemetry requests are sent round-robin to a set of boards, each with its own
+target request rate. The time between a request and the matching telemetry
+packet is measured for each board: when responses lag, or do not arrive at
+all, requests to that board back off, and recover again once responses are
+prompt.
+
+Requests are also limited to what the serial link can carry. Each request
+reserves the time needed to transmit it and its expected response at the
+configured baud rate, and no more than max_outstanding requests are left
+unanswered at once, so that the CDH is never asked for more than it can
+relay.
+
+"""
+# standard library imports
+from collections import namedtuple
+from threading import Lock
+
+# approximate telemetry packet lengths in bytes, used for each board until
+# its packets have been measured
+EXPECTED_RESPONSE_BYTES = {
+    'ADC' : 110,
+    'CDH' :  70,
+    'EPS' : 330,
+    'EXP' : 130,
+}
+DEFAULT_RESPONSE_BYTES = 200
+
+# length of a request '[C|XXX|T]'
+REQUEST_BYTES = 9
+
+# target number of requests per second to each board, unless given
+DEFAULT_RATE_HZ = 0.2
+
+# weight given to each new measurement in the moving averages
+EWMA_WEIGHT = 0.25
+
+BoardRequestStats = namedtuple(
+    'BoardRequestStats',
+    ('board', 'interval_s', 'backoff', 'latency_s', 'response_bytes',
+     'requests', 'responses', 'timeouts')
+)
+
+
+class _BoardSchedule():
+    """Request state for a single board."""
+    __slots__ = ('board', 'interval_s', 'backoff', 'next_due',
+                 'outstanding_since', 'latency_s', 'response_bytes',
+                 'requests', 'responses', 'timeouts')
+
+    def __init__(self, board, interval_s):
+        self.board = board
+        self.interval_s = interval_s
+        self.backoff = 1.0
+        self.next_due = 0.0
+        self.outstanding_since = None
+        self.latency_s = None
+        self.response_bytes = EXPECTED_RESPONSE_BYTES.get(
+            board, DEFAULT_RESPONSE_BYTES
+        )
+        self.requests = 0
+        self.responses = 0
+        self.timeouts = 0
+
+
+class TelemetryRequestScheduler():
+    """Round-robin, rate-limited scheduler for telemetry requests."""
+    def __init__(self, boards, baud, rate_hz=DEFAULT_RATE_HZ,
+                 response_timeout_s=2.0,
+                 max_outstanding=1, link_utilisation=0.8, lag_s=0.5,
+                 max_backoff=64.0):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        boards : sequence of str
+            The boards to request telemetry from, in round-robin order
+        baud : int
+            The baud rate of the serial link
+        rate_hz : float or dict
+            Target number of requests per second for each board. Either a
+            single value for all boards, or a dict with a value per board
+            (boards left out of the dict are requested at DEFAULT_RATE_HZ).
+            Raises ValueError if a rate is not positive.
+        response_timeout_s : float
+            Longest time after which an unanswered request is abandoned. The
+            timeout for each board is shortened to a few times its measured
+            response time, so that a board that has stopped answering does
+            not hold up requests to the others for long.
+        max_outstanding : int
+            Maximum number of unanswered requests at any time
+        link_utilisation : float
+            Fraction of the serial link capacity that requests and their
+            responses may use
+        lag_s : float
+            Allowed delay beyond the expected transmission time before a
+            response is considered to be lagging
+        max_backoff : float
+            Largest factor by which a board's request interval is stretched
+
+        """
+        if isinstance(rate_hz, dict):
+            rates = {board: rate_hz.get(board, DEFAULT_RATE_HZ)
+                     for board in boards}
+        else:
+            rates = {board: rate_hz for board in boards}
+        for board, rate in rates.items():
+            if not rate > 0:
+                raise ValueError(f"Telemetry request rate of {board} must be "
+                                 f"positive, not {rate!r}")
+
+        self.boards = tuple(boards)
+        self._schedules = {
+            board: _BoardSchedule(board, 1/rates[board]) for board in boards
+        }
+
+        # serial frames are 10 bits per byte (start + 8 data + stop)
+        self.bytes_per_s = int(baud) / 10
+        self.response_timeout_s = response_timeout_s
+        self.max_outstanding = max_outstanding
+        self.link_utilisation = link_utilisation
+        self.lag_s = lag_s
+        self.max_backoff = max_backoff
+
+        self._link_free_at = 0.0
+        self._last_index = -1
+        self._lock = Lock()
+
+    # ******************************
+    # scheduling
+    # ******************************
+    def next_request(self, now):
+        """
+        Return the board that should be sent a telemetry request now, or None
+        if no request should be sent yet.
+
+        """
+        with self._lock:
+            self._expire_outstanding(now)
+
+            if (now < self._link_free_at
+                    or self._n_outstanding() >= self.max_outstanding):
+                return None
+
+            # round-robin, starting with the board after the last requested
+            n = len(self.boards)
+            for i in range(1, n+1):
+                index = (self._last_index + i) % n
+                schedule = self._schedules[self.boards[index]]
+                if (schedule.outstanding_since is None
+                        and schedule.next_due <= now):
+                    self._last_index = index
+                    return schedule.board
+
+            return None
+
+    def time_until_next(self, now):
+        """Return the time in seconds until a request may next be due."""
+        with self._lock:
+            # an outstanding request can next change the schedule when it
+            # times out. While max_outstanding requests are unanswered, no
+            # other board can be due.
+            times = [
+                schedule.outstanding_since + self._timeout(schedule)
+                for schedule in self._schedules.values()
+                if schedule.outstanding_since is not None
+            ]
+            if len(times) < self.max_outstanding:
+                times.extend(
+                    schedule.next_due
+                    for schedule in self._schedules.values()
+                    if schedule.outstanding_since is None
+                )
+
+            _next = max(min(times, default=now), self._link_free_at)
+            return max(_next - now, 0.0)
+
+    def request_sent(self, board, now):
+        """Record that a telemetry request was sent to board."""
+        with self._lock:
+            schedule = self._schedules.get(board)
+            if schedule is None:
+                return
+
+            schedule.requests += 1
+            schedule.outstanding_since = now
+            schedule.next_due = now + schedule.interval_s * schedule.backoff
+
+            # reserve the link for the request and the expected response
+            _link_time = ((REQUEST_BYTES + schedule.response_bytes)
+                          / (self.bytes_per_s * self.link_utilisation))
+            self._link_free_at = max(self._link_free_at, now) + _link_time
+
+    def response_received(self, board, now, nbytes):
+        """Record that a telemetry packet of nbytes was received from board."""
+        with self._lock:
+            schedule = self._schedules.get(board)
+            if schedule is None:
+                return
+
+            schedule.responses += 1
+            schedule.response_bytes += (EWMA_WEIGHT
+                                        * (nbytes - schedule.response_bytes))
+
+            if schedule.outstanding_since is None:
+                # unsolicited, or arrived after the request timed out
+                return
+
+            _since = schedule.outstanding_since
+            latency = now - _since
+            schedule.outstanding_since = None
+
+            # the response is complete, so the rest of the link time reserved
+            # for it is free again
+            self._link_free_at = min(self._link_free_at, now)
+            schedule.latency_s = (
+                latency if schedule.latency_s is None
+                else schedule.latency_s
+                     + EWMA_WEIGHT * (latency - schedule.latency_s)
+            )
+
+            if latency > self._expected_latency(schedule) + self.lag_s:
+                self._back_off(schedule, 1.5, _since)
+            else:
+                schedule.backoff = max(1.0, schedule.backoff * 0.8)
+
+    def _expected_latency(self, schedule):
+        """Time to transmit a request and its response over the link."""
+        return (REQUEST_BYTES + schedule.response_bytes) / self.bytes_per_s
+
+    def _timeout(self, schedule):
+        """Time after which a request to this board is abandoned."""
+        _typical = (schedule.latency_s if schedule.latency_s is not None
+                    else self._expected_latency(schedule))
+        return min(self.response_timeout_s, 4 * _typical + self.lag_s)
+
+    def _expire_outstanding(self, now):
+        for schedule in self._schedules.values():
+            _since = schedule.outstanding_since
+            if _since is not None and now - _since > self._timeout(schedule):
+                schedule.outstanding_since = None
+                schedule.timeouts += 1
+                self._back_off(schedule, 2.0, _since)
+
+    def _back_off(self, schedule, factor, since):
+        """Stretch the interval after the request sent at time since."""
+        schedule.backoff = min(schedule.backoff * factor, self.max_backoff)
+        schedule.next_due = max(
+            schedule.next_due, since + schedule.interval_s * schedule.backoff
+        )
+
+    def _n_outstanding(self):
+        return sum(schedule.outstanding_since is not None
+                   for schedule in self._schedules.values())
+
+    # ******************************
+    # statistics
+    # ******************************
+    def stats(self):
+        """Return a BoardRequestStats for each board."""
+        with self._lock:
+            return [
+                BoardRequestStats(
+                    board          = schedule.board            ,
+                    interval_s     = schedule.interval_s       ,
+                    backoff        = schedule.backoff          ,
+                    latency_s      = schedule.latency_s        ,
+                    response_bytes = schedule.response_bytes   ,
+                    requests       = schedule.requests         ,
+                    responses      = schedule.responses        ,
+                    timeouts       = schedule.timeouts         ,
+                )
+                for schedule in self._schedules.values()
+            ]
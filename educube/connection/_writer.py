@@ -0,0 +1,74 @@
+"""
+_writer.py
+
+Thread that transmits queued commands to one or more EduCubes.
+
+Commands are queued by the web server and transmitted here, so that a slow or
+unresponsive serial port never blocks the Tornado IOLoop, or the thread that
+reads telemetry. Each write is limited by the serial port write timeout, and
+its outcome is reported through the future returned when the command was
+queued.
+
+"""
+# standard library imports
+import logging
+
+from threading import Thread, Event
+
+logger = logging.getLogger(__name__)
+
+
+class EduCubeCommandWriter(Thread):
+    """Thread that transmits queued commands on serial port(s)."""
+    def __init__(self, connections, poll_interval=0.5):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        connections : sequence of EduCubeConnection
+            The connections whose queued commands are transmitted
+        poll_interval : float
+            Longest time in seconds to wait before checking whether the
+            thread should stop.
+
+        """
+        self.connections = tuple(connections)
+        self.poll_interval = poll_interval
+        self.running = False
+
+        self._wake = Event()
+
+        super().__init__()
+
+    def start(self):
+        self.running = True
+        super().start()
+
+    def stop(self):
+        """Stop the thread, and wait for the current write to finish."""
+        self.running = False
+        self._wake.set()
+        self.join()
+
+    def wake(self):
+        """Signal that a command has been queued. Safe to call from any
+        thread."""
+        self._wake.set()
+
+    def run(self):
+        """Thread loop to transmit commands as they are queued."""
+        while self.running:
+            # clear before transmitting: a command queued while writing sets
+            # the event again, so it is not missed
+            self._wake.clear()
+
+            _wait = self.poll_interval
+            for conn in self.connections:
+                _command_wait = conn._transmit_queued()
+                if _command_wait is not None:
+                    _wait = min(_wait, _command_wait)
+
+            self._wake.wait(_wait)
+
+        logger.info("EduCubeCommandWriter.run has ended")
@@ -0,0 +1,2 @@
+from ._simulator import EduCubeSimulator
+from ._firmware import SimulatedEduCube
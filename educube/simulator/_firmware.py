@@ -0,0 +1,262 @@
+"""
+_firmware.py
+
+Simulated EduCube board state, and the telemetry strings it produces.
+
+The telemetry strings follow the formats read by the telemetry_parser
+modules. Values drift over time so that plots in the web interface move, and
+the commands sent from the web interface change the state they control:
+magnetorquers, reaction wheel, thermal panel heaters and EPS switches.
+
+"""
+# standard library imports
+import math
+import random
+import time
+
+# local imports
+from educube.telemetry_parser._eps_parser import EPS_INA_COMMAND_ID
+from educube.telemetry_parser._exp_parser import EXP_INA_NAME
+
+BOARD_IDS = ('ADC', 'CDH', 'EPS', 'EXP')
+
+# EPS INA chips in the order the firmware reports them, with their nominal
+# bus voltage and current draw
+EPS_INA_NOMINAL = (
+    ('66', 6.58,  17.0),
+    ('67', 4.95, 118.2),
+    ('73', 3.30,  40.5),
+    ('68', 4.95,  62.4),
+    ('69', 4.95,  53.1),
+    ('72', 3.30,  12.0),
+    ('70', 4.96,  22.3),
+    ('74', 3.30,   8.0),
+    ('71', 4.96,   0.2),
+    ('75', 3.30,   0.1),
+    ('65', 6.62,   0.2),
+    ('64', 1.11,  -0.1),
+)
+
+# ground track of the simulated GPS fix
+ORBIT_PERIOD_S = 5400
+ORBIT_INCLINATION_DEG = 51.6
+
+AMBIENT_TEMP_C = 18.5
+# temperature rise of a thermal panel at full heater power, and the time
+# constant with which it approaches it
+HEATER_RISE_C = 40.0
+HEATER_TIME_CONSTANT_S = 60.0
+
+
+class SimulatedEduCube():
+    """State of the four boards of a simulated EduCube."""
+    def __init__(self, rng=None, clock=time.time):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        rng : random.Random
+            Source of random noise. Pass a seeded generator for repeatable
+            telemetry.
+        clock : callable
+            Returns the current time in seconds
+
+        """
+        self.rng = random.Random() if rng is None else rng
+        self.clock = clock
+        self.t_start = clock()
+
+        # ADC
+        self.magnetorquer = {'X': 0, 'Y': 0}
+        self.reaction_wheel = 0
+
+        # EPS: switched rails, keyed by command_id
+        self.switch_on = {command_id: True
+                          for command_id in EPS_INA_COMMAND_ID.values()}
+
+        # EXP: heater power (%) and temperature of each panel
+        self.heater = {1: 0, 2: 0}
+        self.panel_temp = {1: AMBIENT_TEMP_C, 2: AMBIENT_TEMP_C}
+        self._panel_temp_time = self.t_start
+
+        self._generators = {
+            'ADC' : self.adc_telemetry,
+            'CDH' : self.cdh_telemetry,
+            'EPS' : self.eps_telemetry,
+            'EXP' : self.exp_telemetry,
+        }
+
+    def _noise(self, scale):
+        return self.rng.gauss(0, scale)
+
+    # ******************************
+    # commands
+    # ******************************
+    def apply_command(self, board, command, args):
+        """
+        Update the state for a command, e.g. ('ADC', 'REACT', ['+', '50']).
+
+        Returns False if the command is not recognised.
+
+        """
+        try:
+            if board == 'ADC' and command == 'MAG':
+                axis, sign = args
+                self.magnetorquer[axis] = {'+': 1, '0': 0, '-': -1}[sign]
+            elif board == 'ADC' and command == 'REACT':
+                sign, magnitude = args
+                self.reaction_wheel = int(magnitude) * (-1 if sign == '-'
+                                                        else 1)
+            elif board == 'EXP' and command == 'HEAT':
+                panel, val = args
+                self._update_panel_temperatures()
+                self.heater[int(panel)] = int(val)
+            elif board == 'EPS' and command in ('PWR_ON', 'PWR_OFF'):
+                command_id, = args
+                self.switch_on[command_id] = (command == 'PWR_ON')
+            elif board == 'CDH' and command == 'BLINKY':
+                pass
+            else:
+                return False
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    # ******************************
+    # telemetry
+    # ******************************
+    def telemetry(self, board):
+        """Return a telemetry string for board, without line terminator."""
+        return 'T|{board}|{telem}'.format(
+            board=board, telem=self._generators[board]()
+        )
+
+    def adc_telemetry(self):
+        t = self.clock() - self.t_start
+        spin = math.radians((t * 6) % 360)
+
+        sun = [max(0, int(8 * math.cos(spin - phase) + self._noise(0.5)))
+               for phase in (0, math.pi, math.pi/2, -math.pi/2)]
+
+        mag = []
+        for axis in ('X', 'Y'):
+            mag.extend((int(self.magnetorquer[axis] > 0),
+                        int(self.magnetorquer[axis] < 0)))
+
+        parts = [
+            'SOL,{},{},{},{}'.format(*sun),
+            'ANG,{}'.format(int(math.degrees(spin)) - 180),
+            'MAG,{},{},{},{}'.format(*mag),
+            'WHL,{}'.format(self.reaction_wheel),
+            'MPU,ACC,{:.2f},{:.2f},{:.2f}'.format(
+                self._noise(5), self._noise(5), 995 + self._noise(2)),
+            'MPU,GYR,{:.2f},{:.2f},{:.2f}'.format(
+                self._noise(0.2), self._noise(0.2),
+                0.06 * self.reaction_wheel + self._noise(0.1)),
+            'MPU,MAG,{:.2f},{:.2f},{:.2f}'.format(
+                -6000 * math.cos(spin) + self._noise(50),
+                -6000 * math.sin(spin) + self._noise(50),
+                -2045 + self._noise(20)),
+        ]
+        return '|'.join(parts)
+
+    def cdh_telemetry(self):
+        now = self.clock()
+        phase = 2 * math.pi * ((now - self.t_start) / ORBIT_PERIOD_S)
+
+        lat = ORBIT_INCLINATION_DEG * math.sin(phase)
+        lon = (math.degrees(phase) - 6.5 + 180) % 360 - 180
+
+        parts = [
+            'GPS,{date},{lat},{lon},{hdop},{alt},{status}'.format(
+                date   = time.strftime('%y/%m/%dT%H:%M:%S', time.gmtime(now)),
+                lat    = int(lat * 1e7),
+                lon    = int(lon * 1e7),
+                hdop   = int(120 + abs(self._noise(20))),
+                alt    = int(40000000 + self._noise(5000)),
+                status = 3),
+            'SEP,1,0,0,0,1',
+        ]
+        return '|'.join(parts)
+
+    def eps_telemetry(self):
+        parts = []
+        for address, bus_V, current_mA in EPS_INA_NOMINAL:
+            command_id = EPS_INA_COMMAND_ID.get(address)
+            if command_id is not None and not self.switch_on[command_id]:
+                current_mA = 0.0
+            elif current_mA > 1:
+                current_mA += self._noise(current_mA * 0.02)
+            parts.append('I,{},{:.2f},{:.2f}'.format(
+                address, bus_V + self._noise(0.01), current_mA
+            ))
+
+        charging = int((self.clock() - self.t_start) % ORBIT_PERIOD_S
+                       < ORBIT_PERIOD_S * 0.6)
+        parts.extend((
+            'DA,{:.2f},{:.2f},{:.2f}'.format(
+                25.7 + self._noise(0.1), 6.93 + self._noise(0.01),
+                975 + self._noise(5)),
+            'DB,{:.2f}'.format(24.1 + self._noise(0.1)),
+            'DC,{:.2f}'.format(23.8 + self._noise(0.1)),
+            'C,{}'.format(charging),
+        ))
+        return '|'.join(parts)
+
+    def exp_telemetry(self):
+        self._update_panel_temperatures()
+
+        parts = ['THERM_P{},{}'.format(panel, int(self.heater[panel] > 0))
+                 for panel in (1, 2)]
+
+        for address, name in sorted(EXP_INA_NAME.items()):
+            panel = int(name[1])
+            current_mA = 1.5 * self.heater[panel] + self._noise(0.1)
+            bus_V = 5.0 if self.heater[panel] else 0.0
+            parts.append('I,{},{:.2f},{:.2f},{:.2f}'.format(
+                address, current_mA * 0.05, bus_V, current_mA
+            ))
+
+        for panel in (1, 2):
+            for sensor in ('A', 'B', 'C'):
+                parts.append('P{}{},{:.2f}'.format(
+                    panel, sensor, self.panel_temp[panel] + self._noise(0.05)
+                ))
+        return '|'.join(parts)
+
+    def _update_panel_temperatures(self):
+        """Advance the first-order thermal model of the heated panels."""
+        now = self.clock()
+        decay = math.exp(-(now - self._panel_temp_time)
+                         / HEATER_TIME_CONSTANT_S)
+        self._panel_temp_time = now
+
+        for panel, power in self.heater.items():
+            target = AMBIENT_TEMP_C + HEATER_RISE_C * power / 100
+            self.panel_temp[panel] = (target
+                                      + (self.panel_temp[panel] - target)
+                                      * decay)
+
+
+# ******************************
+# corruption
+# ******************************
+def truncate_exp_panel2(telemetry, rng):
+    """
+    Truncate an EXP telemetry string somewhere in the panel 2 temperatures,
+    as happens when the CDH relays it (see _exp_parser.py).
+
+    """
+    start = telemetry.find('|P2A')
+    if start < 0:
+        return telemetry
+    return telemetry[:rng.randint(start + 1, len(telemetry) - 1)]
+
+
+def garble(telemetry, rng, nbytes=3):
+    """Replace a few characters of a telemetry string with noise."""
+    chars = list(telemetry)
+    for _ in range(nbytes):
+        chars[rng.randrange(len(chars))] = chr(rng.randint(0x21, 0x7e))
+    return ''.join(chars)
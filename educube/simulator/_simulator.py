@@ -0,0 +1,307 @@
+"""
+_simulator.py
+
+Simulates EduCube firmware on a pseudo-terminal.
+
+EduCubeSimulator creates a pty pair with os.openpty and serves the master
+side from its own thread. The slave side is an ordinary serial device (e.g.
+/dev/pts/3), which EduCubeConnection opens with serial.Serial exactly as it
+would a USB serial adapter, so the complete receive and transmit paths are
+exercised.
+
+The simulator answers telemetry requests ('[C|<board>|T]') and applies the
+other commands to the simulated board state. It can also send unsolicited
+telemetry at a fixed rate, pace its output to a given baud rate, delay its
+responses, and corrupt or drop telemetry, so that the client can be
+soak-tested far beyond the rates real hardware produces.
+
+Pseudo-terminals are only available on POSIX systems.
+
+"""
+# standard library imports
+import heapq
+import logging
+import os
+import random
+import selectors
+import time
+import tty
+
+from collections import namedtuple
+from itertools import count
+from threading import Thread
+
+# local imports
+from ._firmware import (SimulatedEduCube, BOARD_IDS, truncate_exp_panel2,
+                        garble)
+
+logger = logging.getLogger(__name__)
+
+EOL = b'\r\n'
+
+# longest time the simulator thread waits before checking whether to stop
+POLL_INTERVAL_S = 0.1
+
+SimulatorStats = namedtuple(
+    'SimulatorStats',
+    ('requests', 'commands', 'invalid', 'packets', 'bytes', 'truncated',
+     'garbled', 'dropped')
+)
+
+
+class EduCubeSimulator(Thread):
+    """Simulated EduCube firmware serving a pseudo-terminal."""
+    def __init__(self, board='CDH', baud=None, rate_hz=None, latency_s=0.0,
+                 exp_truncation=0.0, garble=0.0, drop=0.0, seed=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        board : str
+            The board the simulated serial port is connected to. The CDH
+            answers requests for every board; any other board only answers
+            for itself.
+        baud : int
+            Baud rate whose transmission time is simulated. Output is paced
+            to baud/10 bytes per second. If None, output is not paced.
+        rate_hz : float
+            Rate at which unsolicited telemetry packets are sent, taking the
+            boards in turn. If None, telemetry is only sent on request.
+        latency_s : float
+            Delay between receiving a telemetry request and answering it
+        exp_truncation : float
+            Probability that an EXP packet is truncated in the panel 2
+            temperatures
+        garble : float
+            Probability that a packet has some of its characters replaced
+        drop : float
+            Probability that a requested packet is never sent
+        seed : int
+            Seed for the random number generator, for repeatable runs
+
+        """
+        if board not in BOARD_IDS:
+            raise ValueError(f'Invalid board identifier {board}')
+
+        self.board = board
+        self.boards = BOARD_IDS if board == 'CDH' else (board,)
+        self.bytes_per_s = None if not baud else int(baud) / 10
+        self.rate_hz = rate_hz
+        self.latency_s = latency_s
+        self.exp_truncation = exp_truncation
+        self.garble = garble
+        self.drop = drop
+
+        self.rng = random.Random(seed)
+        self.educube = SimulatedEduCube(rng=self.rng)
+
+        self.port = None
+        self.running = False
+
+        self._master = None
+        self._slave = None
+        self._selector = None
+        self._input = bytearray()
+        self._output = bytearray()
+        self._pending = []          # heap of (due, seq, board)
+        self._seq = count()
+        self._link_free_at = 0.0
+        self._next_stream = None
+        self._stream_index = 0
+
+        self.requests = 0
+        self.commands = 0
+        self.invalid = 0
+        self.packets = 0
+        self.bytes = 0
+        self.truncated = 0
+        self.garbled = 0
+        self.dropped = 0
+
+        super().__init__(daemon=True)
+
+    ################
+    # context manager
+    ################
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.stop()
+        return False
+
+    ################
+    # thread management
+    ################
+
+    def start(self):
+        """Create the pseudo-terminal and start serving it."""
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        logger.info(f"STARTUP : Simulated EduCube on {self.port}")
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._master, selectors.EVENT_READ)
+
+        if self.rate_hz:
+            self._next_stream = time.monotonic()
+
+        self.running = True
+        super().start()
+
+    def stop(self):
+        """Stop the thread and close the pseudo-terminal."""
+        self.running = False
+        self.join()
+
+        self._selector.close()
+        for fd in (self._master, self._slave):
+            os.close(fd)
+        logger.info(f"SHUTDOWN : Simulator {self.stats()}")
+
+    def stats(self):
+        """Return the simulator counters as a SimulatorStats."""
+        return SimulatorStats(requests  = self.requests ,
+                              commands  = self.commands ,
+                              invalid   = self.invalid  ,
+                              packets   = self.packets  ,
+                              bytes     = self.bytes    ,
+                              truncated = self.truncated,
+                              garbled   = self.garbled  ,
+                              dropped   = self.dropped   )
+
+    def run(self):
+        """Thread loop to answer commands and send telemetry."""
+        while self.running:
+            _events = self._selector.select(timeout=self._time_until_due())
+            for key, mask in _events:
+                if mask & selectors.EVENT_READ:
+                    self._read_commands()
+                if mask & selectors.EVENT_WRITE:
+                    self._flush_output()
+
+            self._send_due(time.monotonic())
+
+        logger.info("EduCubeSimulator.run has ended")
+
+    # ******************************
+    # input
+    # ******************************
+    def _read_commands(self):
+        try:
+            self._input += os.read(self._master, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # raised on Linux while no process has the slave side open
+            return
+
+        while True:
+            _start = self._input.find(b'[')
+            _end = self._input.find(b']', _start)
+            if _start < 0 or _end < 0:
+                # keep only a partial command
+                if _start < 0:
+                    self._input.clear()
+                else:
+                    del self._input[:_start]
+                return
+
+            _command = bytes(self._input[_start+1:_end])
+            del self._input[:_end+1]
+            self._handle_command(_command.decode('ascii', errors='replace'))
+
+    def _handle_command(self, command):
+        """Handle a command with its brackets removed, e.g. 'C|ADC|T'."""
+        logger.debug(f"Simulator received command: {command!r}")
+
+        _type, _board, _command, *_args = command.split('|') + ['', '']
+        _args = [arg for arg in _args if arg]
+
+        if _type != 'C' or _board not in self.boards:
+            self.invalid += 1
+            return
+
+        if _command == 'T':
+            self.requests += 1
+            heapq.heappush(
+                self._pending,
+                (time.monotonic() + self.latency_s, next(self._seq), _board)
+            )
+        elif self.educube.apply_command(_board, _command, _args):
+            self.commands += 1
+        else:
+            self.invalid += 1
+
+    # ******************************
+    # output
+    # ******************************
+    def _time_until_due(self):
+        """Time in seconds until the next packet is due to be sent."""
+        if self._output:
+            return POLL_INTERVAL_S
+
+        _due = [POLL_INTERVAL_S + time.monotonic()]
+        if self._pending:
+            _due.append(max(self._pending[0][0], self._link_free_at))
+        if self._next_stream is not None:
+            _due.append(max(self._next_stream, self._link_free_at))
+        return max(min(_due) - time.monotonic(), 0)
+
+    def _send_due(self, now):
+        """Send every packet that is due, as far as the link allows."""
+        while now >= self._link_free_at and not self._output:
+            if self._pending and self._pending[0][0] <= now:
+                _, _, _board = heapq.heappop(self._pending)
+                if self.rng.random() < self.drop:
+                    self.dropped += 1
+                    continue
+            elif self._next_stream is not None and self._next_stream <= now:
+                _board = self.boards[self._stream_index % len(self.boards)]
+                self._stream_index += 1
+                self._next_stream = max(self._next_stream + 1/self.rate_hz,
+                                        now - 1.0)
+            else:
+                return
+
+            self._send_telemetry(_board, now)
+
+    def _send_telemetry(self, board, now):
+        _telemetry = self.educube.telemetry(board)
+
+        if board == 'EXP' and self.rng.random() < self.exp_truncation:
+            _telemetry = truncate_exp_panel2(_telemetry, self.rng)
+            self.truncated += 1
+        if self.rng.random() < self.garble:
+            _telemetry = garble(_telemetry, self.rng)
+            self.garbled += 1
+
+        _data = _telemetry.encode('ascii') + EOL
+        self._output += _data
+        self.packets += 1
+        self.bytes += len(_data)
+
+        if self.bytes_per_s is not None:
+            self._link_free_at = (max(self._link_free_at, now)
+                                  + len(_data) / self.bytes_per_s)
+
+        self._flush_output()
+
+    def _flush_output(self):
+        """Write as much output as the pty accepts, waiting for the rest."""
+        try:
+            _n = os.write(self._master, self._output)
+        except (BlockingIOError, InterruptedError):
+            _n = 0
+        del self._output[:_n]
+
+        _events = selectors.EVENT_READ
+        if self._output:
+            _events |= selectors.EVENT_WRITE
+        self._selector.modify(self._master, _events)
@@ -0,0 +1,5 @@
+from ._convert import (convert_log, convert_logs, load_columns, is_converted,
+                       read_manifest, columns_dir, ConvertResult,
+                       COLUMNS_EXTENSION)
+from ._npy import (write_npz, read_npz, NpyFormatError, DTYPE_INT,
+                   DTYPE_FLOAT, DTYPE_BOOL, DTYPE_STR)
@@ -0,0 +1,311 @@
+"""
+_convert.py
+
+Converts recorded telemetry logs into typed columns, one .npz archive per
+board.
+
+The telemetry is parsed with parse_educube_telemetry_batch, so the columns
+are those of its board schemas: numeric fields as float64 (NaN where
+missing) and text fields as strings, named by their path in the parsed
+telemetry (e.g., 'MPU_GYR.X', 'panel1.temperature.A', 'INA.66.bus_V'). Each
+archive also holds the packet timestamps ('time') and the validity mask
+('valid'); corrupted packets keep their row and are marked as invalid.
+
+Logs are split into chunks -- byte ranges of a .raw log, or groups of
+segments of a segment recording -- that are parsed in parallel by a pool of
+processes. The columns of a log are written to a directory (by default
+'<log>.columns') with a manifest recording the size and modification time of
+the log; a log that has not changed since it was converted is not converted
+again.
+
+"""
+# standard library imports
+import json
+import logging
+import os
+import time
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+# local imports
+from educube.telemetry_log import (SegmentReader, is_segment_file,
+                                   parse_raw_line)
+from educube.telemetry_parser import parse_educube_telemetry_batch
+from ._npy import write_npz, read_npz, column_dtype
+
+logger = logging.getLogger(__name__)
+
+# version of the column layout; bumping it invalidates converted logs
+COLUMNS_VERSION = 2
+
+COLUMNS_EXTENSION = '.columns'
+MANIFEST_NAME = 'manifest.json'
+
+DEFAULT_CHUNK_BYTES = 8 * 1024 * 1024
+
+# number of segments of a segment recording parsed per chunk
+DEFAULT_CHUNK_SEGMENTS = 64
+
+TIME_COLUMN = 'time'
+VALID_COLUMN = 'valid'
+
+ConvertResult = namedtuple(
+    'ConvertResult',
+    ('path', 'output_dir', 'cached', 'rows', 'failed', 'elapsed_s')
+)
+
+
+def columns_dir(path):
+    """Return the default output directory for the columns of a log."""
+    return path + COLUMNS_EXTENSION
+
+
+# ****************************************************************************
+# parsing (in the worker processes)
+# ****************************************************************************
+def _parse_lines(lines):
+    """Parse the telemetry among (timestamp, line) lines into batches."""
+    _timestamps = []
+    _telemetry = []
+    for _timestamp, _line in lines:
+        if _line.startswith('T|'):
+            _timestamps.append(_timestamp)
+            _telemetry.append(_line)
+
+    _batches = parse_educube_telemetry_batch(_timestamps, _telemetry,
+                                             use_numpy=False)
+    # telemetry of unknown boards is counted as failed
+    _unknown = _batches.pop('', None)
+    _failed = 0 if _unknown is None else len(_unknown.index)
+
+    return {
+        _board: (_batch.time, _batch.valid, _batch.columns)
+        for _board, _batch in _batches.items()
+    }, _failed
+
+
+def _raw_chunk_lines(path, start, end):
+    """Yield the lines of a .raw log that start in [start, end)."""
+    with open(path, 'rb') as f:
+        if start > 0:
+            # skip the line that started before this chunk
+            f.seek(start - 1)
+            f.readline()
+
+        _offset = f.tell()
+        while _offset < end:
+            _line = f.readline()
+            if not _line.endswith(b'\n'):
+                break
+            _offset += len(_line)
+            _parsed = parse_raw_line(_line)
+            if _parsed is not None:
+                yield (_parsed[0],
+                       _parsed[1].decode('utf-8', errors='replace'))
+
+
+def _segment_chunk_lines(path, first, last):
+    """Yield the lines of segments first..last-1 of a segment recording."""
+    with SegmentReader(path) as reader:
+        for _segment in reader.segments[first:last]:
+            yield from reader.read_segment(_segment)
+
+
+def _convert_chunk(kind, path, start, end):
+    """Worker task: parse one chunk of a log."""
+    if kind == 'segments':
+        _lines = _segment_chunk_lines(path, start, end)
+    else:
+        _lines = _raw_chunk_lines(path, start, end)
+    return _parse_lines(_lines)
+
+
+# ****************************************************************************
+# columns
+# ****************************************************************************
+def _merge_chunks(results):
+    """Concatenate the columns of each board over the chunks, in order."""
+    merged = dict()
+    _failed = 0
+    for _boards, _chunk_failed in results:
+        _failed += _chunk_failed
+        for _board, (_time, _valid, _columns) in _boards.items():
+            _merged = merged.get(_board)
+            if _merged is None:
+                merged[_board] = (_time, _valid, _columns)
+                continue
+            _merged[0].extend(_time)
+            _merged[1].extend(_valid)
+            for _name, _column in _columns.items():
+                _merged[2][_name].extend(_column)
+
+    for _board, (_, _valid, _) in merged.items():
+        _failed += len(_valid) - sum(_valid)
+    return merged, _failed
+
+
+# ****************************************************************************
+# cache
+# ****************************************************************************
+def _source_info(path):
+    _stat = os.stat(path)
+    return {'path'     : os.path.abspath(path),
+            'size'     : _stat.st_size     ,
+            'mtime_ns' : _stat.st_mtime_ns  }
+
+
+def read_manifest(output_dir):
+    """Return the manifest of a converted log, or None."""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_converted(path, output_dir=None):
+    """Return True if the columns of path are up to date."""
+    _manifest = read_manifest(output_dir or columns_dir(path))
+    if _manifest is None or _manifest.get('version') != COLUMNS_VERSION:
+        return False
+    _source = _manifest.get('source', {})
+    _current = _source_info(path)
+    return (_source.get('size') == _current['size']
+            and _source.get('mtime_ns') == _current['mtime_ns'])
+
+
+def _write_columns(output_dir, source, merged, failed):
+    os.makedirs(output_dir, exist_ok=True)
+
+    # the manifest is written last, so an interrupted conversion is redone
+    _manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    _previous = read_manifest(output_dir) or {}
+    if os.path.exists(_manifest_path):
+        os.remove(_manifest_path)
+
+    for _board in _previous.get('boards', {}):
+        if _board not in merged:
+            _stale = os.path.join(output_dir, f'{_board}.npz')
+            if os.path.exists(_stale):
+                os.remove(_stale)
+
+    _boards = dict()
+    for _board, (_time, _valid, _values) in sorted(merged.items()):
+        _columns = {TIME_COLUMN: _time, VALID_COLUMN: _valid}
+        _columns.update(_values)
+        write_npz(os.path.join(output_dir, f'{_board}.npz'), _columns)
+        _boards[_board] = {
+            'rows'    : len(_time),
+            'columns' : {_name: column_dtype(_column)
+                         for _name, _column in _columns.items()},
+        }
+
+    _manifest = {'version': COLUMNS_VERSION, 'source': source,
+                 'boards': _boards, 'failed': failed}
+    _tmp = _manifest_path + '.tmp'
+    with open(_tmp, 'w') as f:
+        json.dump(_manifest, f, indent=1)
+    os.replace(_tmp, _manifest_path)
+
+
+# ****************************************************************************
+# conversion
+# ****************************************************************************
+def _chunks(path, size, chunk_bytes, chunk_segments):
+    """Return the (kind, path, start, end) chunks of a log."""
+    if is_segment_file(path):
+        with SegmentReader(path) as reader:
+            _n = len(reader.segments)
+        return [('segments', path, _first, min(_first + chunk_segments, _n))
+                for _first in range(0, _n, chunk_segments)]
+
+    return [('raw', path, _start, min(_start + chunk_bytes, size))
+            for _start in range(0, size, chunk_bytes)]
+
+
+def convert_logs(paths, output_dirs=None, workers=None,
+                 chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 chunk_segments=DEFAULT_CHUNK_SEGMENTS, force=False):
+    """
+    Convert telemetry logs to columns, parsing their chunks in parallel.
+
+    Parameters
+    ----------
+    paths : sequence of str
+        The .raw logs or segment recordings
+    output_dirs : sequence of str
+        Output directory for each log (default: '<log>.columns')
+    workers : int
+        Number of worker processes (default: the number of CPUs)
+    chunk_bytes : int
+        Size of the chunks of a .raw log
+    chunk_segments : int
+        Number of segments in each chunk of a segment recording
+    force : bool
+        Convert logs even if their columns are up to date
+
+    Returns a ConvertResult for each log.
+
+    """
+    _started = time.monotonic()
+    if output_dirs is None:
+        output_dirs = [columns_dir(_path) for _path in paths]
+
+    _pending = []
+    results = [None] * len(paths)
+    for _i, (_path, _output_dir) in enumerate(zip(paths, output_dirs)):
+        if not force and is_converted(_path, _output_dir):
+            _manifest = read_manifest(_output_dir)
+            _rows = {_board: _info['rows']
+                     for _board, _info in _manifest['boards'].items()}
+            results[_i] = ConvertResult(_path, _output_dir, True, _rows,
+                                        _manifest['failed'], 0.0)
+            logger.info(f"Columns of {_path} are up to date")
+        else:
+            _pending.append(_i)
+
+    if not _pending:
+        return results
+
+    # the size is recorded before chunking, so that lines appended during
+    # the conversion are converted next time
+    _sources = {_i: _source_info(paths[_i]) for _i in _pending}
+    _tasks = {_i: _chunks(paths[_i], _sources[_i]['size'], chunk_bytes,
+                          chunk_segments)
+              for _i in _pending}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        _futures = {_i: [executor.submit(_convert_chunk, *_task)
+                         for _task in _tasks[_i]]
+                    for _i in _pending}
+
+        for _i in _pending:
+            merged, _failed = _merge_chunks(
+                _future.result() for _future in _futures[_i]
+            )
+            _write_columns(output_dirs[_i], _sources[_i], merged, _failed)
+            _rows = {_board: len(_time)
+                     for _board, (_time, _, _) in merged.items()}
+            results[_i] = ConvertResult(paths[_i], output_dirs[_i], False,
+                                        _rows, _failed,
+                                        time.monotonic() - _started)
+            logger.info(f"Converted {paths[_i]}: {results[_i]}")
+
+    return results
+
+
+def convert_log(path, output_dir=None, **kwargs):
+    """Convert one telemetry log to columns (see convert_logs)."""
+    _output_dirs = None if output_dir is None else [output_dir]
+    return convert_logs([path], output_dirs=_output_dirs, **kwargs)[0]
+
+
+def load_columns(output_dir, board, names=None):
+    """
+    Return the columns of a board of a converted log as a dict of name to
+    array.array (or list of str). With NumPy installed, the .npz archives can
+    also be read with numpy.load.
+
+    """
+    return read_npz(os.path.join(output_dir, f'{board}.npz'), names=names)
@@ -0,0 +1,152 @@
+"""
+_npy.py
+
+Reads and writes columns as NumPy .npy arrays and .npz archives, without
+requiring NumPy.
+
+Only one-dimensional arrays of the types used for telemetry columns are
+supported:
+
+    int64    'i8'   array.array('q')
+    float64  'f8'   array.array('d')
+    bool     'b1'   array.array('b') of 0/1
+    str      'U<n>' list of str, stored as fixed width UTF-32
+
+An .npz archive is a zip file holding one '<name>.npy' per column, as written
+by numpy.savez_compressed, so the files can be opened with numpy.load.
+
+"""
+# standard library imports
+import ast
+import struct
+import sys
+import zipfile
+
+from array import array
+
+NPY_MAGIC = b'\x93NUMPY'
+NPY_ALIGNMENT = 64
+
+# column types
+DTYPE_INT = 'int'
+DTYPE_FLOAT = 'float'
+DTYPE_BOOL = 'bool'
+DTYPE_STR = 'str'
+
+_ENDIAN = '<' if sys.byteorder == 'little' else '>'
+
+# column type -> (array typecode, .npy descr)
+_ARRAY_TYPES = {
+    DTYPE_INT   : ('q', f'{_ENDIAN}i8'),
+    DTYPE_FLOAT : ('d', f'{_ENDIAN}f8'),
+    DTYPE_BOOL  : ('b', '|b1'),
+}
+
+
+class NpyFormatError(Exception):
+    """An exception raised for .npy data that cannot be read."""
+
+
+def column_dtype(column):
+    """Return the column type of an array.array or list of str."""
+    if isinstance(column, array):
+        for _dtype, (_typecode, _) in _ARRAY_TYPES.items():
+            if column.typecode == _typecode:
+                return _dtype
+        raise TypeError(f'Unsupported array typecode {column.typecode!r}')
+    return DTYPE_STR
+
+
+def npy_bytes(column):
+    """Return the .npy file contents of a column."""
+    _dtype = column_dtype(column)
+    if _dtype == DTYPE_STR:
+        _width = max((len(_s) for _s in column), default=0) or 1
+        _descr = f'<U{_width}'
+        _data = b''.join(
+            _s.encode('utf-32-le').ljust(_width * 4, b'\0') for _s in column
+        )
+    else:
+        _descr = _ARRAY_TYPES[_dtype][1]
+        _data = column.tobytes()
+
+    _header = repr({'descr': _descr, 'fortran_order': False,
+                    'shape': (len(column),)})
+    # pad so that the data starts at a multiple of NPY_ALIGNMENT
+    _unpadded = len(NPY_MAGIC) + 2 + 2 + len(_header) + 1
+    _header += ' ' * (-_unpadded % NPY_ALIGNMENT) + '\n'
+
+    return b''.join((NPY_MAGIC, b'\x01\x00',
+                     struct.pack('<H', len(_header)),
+                     _header.encode('latin1'), _data))
+
+
+def read_npy(data):
+    """Return the column stored in .npy file contents."""
+    if not data.startswith(NPY_MAGIC):
+        raise NpyFormatError('Not a .npy array')
+
+    _major = data[6]
+    if _major == 1:
+        _length, = struct.unpack_from('<H', data, 8)
+        _start = 10
+    else:
+        _length, = struct.unpack_from('<I', data, 8)
+        _start = 12
+
+    _header = ast.literal_eval(data[_start:_start + _length].decode('latin1'))
+    _data = data[_start + _length:]
+    _descr = _header['descr']
+    if _header['fortran_order'] or len(_header['shape']) != 1:
+        raise NpyFormatError('Only one-dimensional arrays are supported')
+    _n, = _header['shape']
+
+    if _descr[1] == 'U':
+        _width = int(_descr[2:])
+        _text = _data.decode('utf-32-be' if _descr[0] == '>' else 'utf-32-le')
+        return [_text[_i * _width:(_i + 1) * _width].rstrip('\0')
+                for _i in range(_n)]
+
+    for _typecode, _dtype_descr in _ARRAY_TYPES.values():
+        if _descr[1:] == _dtype_descr[1:]:
+            _column = array(_typecode)
+            _column.frombytes(_data[:_n * _column.itemsize])
+            if _descr[0] not in ('|', _ENDIAN):
+                _column.byteswap()
+            return _column
+
+    raise NpyFormatError(f'Unsupported array type {_descr!r}')
+
+
+def write_npz(path, columns, compress=True):
+    """
+    Write columns (a mapping of name to column) to an .npz archive.
+
+    """
+    _compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(path, 'w', compression=_compression,
+                         allowZip64=True) as zf:
+        for _name, _column in columns.items():
+            zf.writestr(f'{_name}.npy', npy_bytes(_column))
+
+
+def read_npz(path, names=None):
+    """
+    Read the columns of an .npz archive as a dict of name to column.
+
+    Parameters
+    ----------
+    path : str
+        The .npz archive
+    names : iterable of str
+        Only read these columns (default: all)
+
+    """
+    _columns = dict()
+    with zipfile.ZipFile(path) as zf:
+        for _entry in zf.namelist():
+            _name = _entry[:-len('.npy')]
+            if names is not None and _name not in names:
+                continue
+            _columns[_name] = read_npy(zf.read(_entry))
+    return _columns
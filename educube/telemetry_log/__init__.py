@@ -0,0 +1,10 @@
+from ._writer import (TelemetryLogWriter, rotated_path, FSYNC_NEVER,
+                      FSYNC_ON_FLUSH, FSYNC_ON_CLOSE, LOG_FORMAT_RAW,
+                      LOG_FORMAT_SEGMENTS)
+from ._raw import (iter_raw_log, parse_raw_line, RawLogReader,
+                   INDEX_EXTENSION)
+from ._segments import (SegmentWriter, SegmentReader, SegmentFormatError,
+                        is_segment_file, raw_to_segments, segments_to_raw,
+                        segments_match_raw,
+                        SEGMENT_EXTENSION, CODEC_NONE, CODEC_ZLIB, CODEC_LZMA)
+from ._reader import iter_log, first_timestamp
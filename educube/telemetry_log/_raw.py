@@ -0,0 +1,342 @@
+"""
+_raw.py
+
+Reads the text telemetry log ('.raw') written by EduCubeConnection.
+
+Each line of a .raw log is "{timestamp}\t{telemetry}\n", where timestamp is
+the UNIX time in milliseconds at which the line was received (or the command
+sent). Lines that do not follow this format -- e.g., a partially written last
+line -- are skipped.
+
+RawLogReader memory-maps a .raw log and finds lines by time with a sparse
+index: the timestamp of the first line after every `stride` bytes. Building
+the index reads one line per stride, not the whole file, and it is saved
+next to the log (path + '.tidx') for later opens. While the log is still
+being written, the index is extended to cover the new data. Locating a time
+then takes a binary search over the index and a scan of at most one stride.
+
+Timestamps are only approximately in order (they come from the system clock
+of the recording machine), so the index stores their running maximum and
+range reads filter each line by its own timestamp. A line more than a stride
+out of order may be missed by a read starting after it.
+
+"""
+# standard library imports
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+INDEX_EXTENSION = '.tidx'
+INDEX_MAGIC = b'EDUCTIDX'
+INDEX_VERSION = 1
+# magic, version, stride, indexed size, next boundary, entries, head crc32
+INDEX_HEADER = struct.Struct('<8sHIQQQI')
+
+# bytes at the start of the log whose checksum identifies it
+HEAD_BYTES = 4096
+
+DEFAULT_STRIDE = 65536
+
+
+def parse_raw_line(line):
+    """
+    Split a line of a .raw log into (timestamp, telemetry).
+
+    line may be str or bytes; telemetry is returned as the same type. Returns
+    None if the line is not a valid log line.
+
+    """
+    _sep = '\t' if isinstance(line, str) else b'\t'
+    _timestamp, sep, _telemetry = line.partition(_sep)
+    if not sep:
+        return None
+
+    try:
+        _timestamp = int(_timestamp)
+    except ValueError:
+        return None
+
+    return _timestamp, _telemetry.rstrip()
+
+
+def iter_raw_log(path):
+    """Yield the (timestamp, telemetry) lines of a .raw log in file order."""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for _line in f:
+            if not _line.endswith('\n'):
+                # partially written last line
+                break
+
+            _parsed = parse_raw_line(_line)
+            if _parsed is None:
+                logger.debug(f"Skipping invalid log line: {_line!r}")
+                continue
+            yield _parsed
+
+
+def telemetry_board(telemetry):
+    """Return the board of a telemetry line, or '' if it is not telemetry."""
+    _type, sep, _rest = telemetry.partition('|')
+    if _type != 'T' or not sep:
+        return ''
+    return _rest.partition('|')[0]
+
+
+class RawLogReader():
+    """Memory-mapped .raw log with a persistent, sparse timestamp index."""
+    def __init__(self, path, stride=DEFAULT_STRIDE, save_index=True):
+        """
+        Constructor. Maps the log at path and loads, extends or builds its
+        index.
+
+        Parameters
+        ----------
+        path : str
+            The .raw log
+        stride : int
+            Bytes of log between index entries. Smaller strides make the
+            index larger and lookups scan fewer lines. Ignored if a saved
+            index is loaded.
+        save_index : bool
+            Save the index next to the log when it is built or extended
+
+        """
+        self.path = path
+        self.stride = stride
+        self.save_index = save_index
+
+        self._file = open(path, 'rb')
+        self._mm = None
+        self._size = 0          # size of the mapped log up to its last '\n'
+
+        # index: timestamps are the running maximum up to each offset
+        self._timestamps = array('q')
+        self._offsets = array('q')
+        self._next_boundary = 0
+
+        self._map()
+        if not self._load_index():
+            self._timestamps = array('q')
+            self._offsets = array('q')
+            self._next_boundary = 0
+        self._extend_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self._mm = None
+        self._file.close()
+
+    def __iter__(self):
+        return self.read()
+
+    # ******************************
+    # reading
+    # ******************************
+    def refresh(self):
+        """Map and index any complete lines appended since the last call."""
+        if os.fstat(self._file.fileno()).st_size > self._size:
+            self._map()
+            self._extend_index()
+
+    @property
+    def t_start(self):
+        """Timestamp of the first line, or None if the log is empty."""
+        for _timestamp, _ in self._iter_from(0):
+            return _timestamp
+        return None
+
+    @property
+    def t_end(self):
+        """Timestamp of the last complete line, or None."""
+        for _timestamp, _ in self.tail(1):
+            return _timestamp
+        return None
+
+    def offset_of(self, timestamp):
+        """
+        Return the offset of a line at or before the first line with a
+        timestamp >= timestamp. Reading from there finds every such line.
+
+        """
+        _i = bisect_left(self._timestamps, timestamp)
+        return self._offsets[_i - 1] if _i > 0 else 0
+
+    def read(self, t_start=None, t_end=None):
+        """
+        Yield (timestamp, telemetry) lines with t_start <= timestamp <= t_end
+        (in ms), in file order.
+
+        """
+        self.refresh()
+        _offset = 0 if t_start is None else self.offset_of(t_start)
+
+        for _timestamp, _telemetry in self._iter_from(_offset):
+            if t_start is not None and _timestamp < t_start:
+                continue
+            if t_end is not None and _timestamp > t_end:
+                break
+            yield _timestamp, _telemetry
+
+    def read_from(self, offset):
+        """Yield the lines starting at byte offset (a line boundary)."""
+        self.refresh()
+        return self._iter_from(offset)
+
+    def tail(self, n=10):
+        """Return the last n lines, oldest first."""
+        self.refresh()
+        if self._mm is None:
+            return []
+
+        _mm = self._mm
+        _start = self._size
+        _lines = []
+        while len(_lines) < n and _start > 0:
+            _prev = _mm.rfind(b'\n', 0, _start - 1) + 1
+            _parsed = self._parse(_mm[_prev:_start])
+            if _parsed is not None:
+                _lines.append(_parsed)
+            _start = _prev
+        _lines.reverse()
+        return _lines
+
+    def _iter_from(self, offset):
+        _mm = self._mm
+        if _mm is None:
+            return
+
+        _size = self._size
+        while offset < _size:
+            _end = _mm.find(b'\n', offset, _size)
+            if _end < 0:
+                return
+            _parsed = self._parse(_mm[offset:_end])
+            offset = _end + 1
+            if _parsed is not None:
+                yield _parsed
+
+    @staticmethod
+    def _parse(line):
+        _parsed = parse_raw_line(line)
+        if _parsed is None:
+            return None
+        _timestamp, _telemetry = _parsed
+        return _timestamp, _telemetry.decode('utf-8', errors='replace')
+
+    # ******************************
+    # index
+    # ******************************
+    @property
+    def index_path(self):
+        return self.path + INDEX_EXTENSION
+
+    def _map(self):
+        _size = os.fstat(self._file.fileno()).st_size
+        if _size == 0:
+            self._mm = None
+            self._size = 0
+            return
+
+        # earlier mappings are left to the garbage collector, as iterators
+        # may still be reading them
+        _mm = mmap.mmap(self._file.fileno(), _size, access=mmap.ACCESS_READ)
+        self._mm = _mm
+        self._size = _mm.rfind(b'\n') + 1
+
+    def _head_crc(self):
+        if self._mm is None:
+            return 0
+        return zlib.crc32(self._mm[:HEAD_BYTES])
+
+    def _extend_index(self):
+        """Add index entries for the boundaries now followed by a line."""
+        _mm = self._mm
+        if _mm is None:
+            return
+
+        _n_before = len(self._offsets)
+        _last = self._timestamps[-1] if self._timestamps else None
+        _boundary = self._next_boundary
+
+        while _boundary < self._size:
+            _offset = 0 if _boundary == 0 else (
+                _mm.find(b'\n', _boundary - 1, self._size) + 1
+            )
+            if _offset <= 0 and _boundary > 0:
+                break
+
+            # use the first valid line after the boundary
+            _entry = None
+            for _timestamp, _ in self._iter_from(_offset):
+                _entry = _timestamp
+                break
+            if _entry is None:
+                break
+
+            _last = _entry if _last is None else max(_last, _entry)
+            if not self._offsets or _offset > self._offsets[-1]:
+                self._timestamps.append(_last)
+                self._offsets.append(_offset)
+            _boundary = max(_boundary + self.stride,
+                            _offset - _offset % self.stride + self.stride)
+
+        self._next_boundary = _boundary
+        if len(self._offsets) > _n_before and self.save_index:
+            self._save_index()
+
+    def _load_index(self):
+        """Load the saved index if it belongs to this log. Returns True if
+        it was loaded."""
+        try:
+            with open(self.index_path, 'rb') as f:
+                _header = f.read(INDEX_HEADER.size)
+                (_magic, _version, _stride, _indexed, _next_boundary,
+                 _entries, _crc) = INDEX_HEADER.unpack(_header)
+                if _magic != INDEX_MAGIC or _version != INDEX_VERSION:
+                    return False
+
+                _timestamps = array('q')
+                _offsets = array('q')
+                _timestamps.fromfile(f, _entries)
+                _offsets.fromfile(f, _entries)
+        except (OSError, EOFError, struct.error):
+            return False
+
+        # the log must not have shrunk or been replaced
+        if _indexed > self._size or _crc != self._head_crc():
+            logger.info(f"Rebuilding out of date index {self.index_path}")
+            return False
+
+        self.stride = _stride
+        self._timestamps = _timestamps
+        self._offsets = _offsets
+        self._next_boundary = _next_boundary
+        return True
+
+    def _save_index(self):
+        _tmp = f'{self.index_path}.{os.getpid()}.tmp'
+        try:
+            with open(_tmp, 'wb') as f:
+                f.write(INDEX_HEADER.pack(
+                    INDEX_MAGIC, INDEX_VERSION, self.stride, self._size,
+                    self._next_boundary, len(self._offsets), self._head_crc()
+                ))
+                self._timestamps.tofile(f)
+                self._offsets.tofile(f)
+            os.replace(_tmp, self.index_path)
+        except OSError:
+            errmsg = f"Could not save log index {self.index_path}"
+            logger.exception(errmsg, exc_info=True)
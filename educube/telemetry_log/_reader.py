@@ -0,0 +1,35 @@
+"""
+_reader.py
+
+Reads recorded telemetry logs in either format.
+
+"""
+# local imports
+from ._raw import RawLogReader
+from ._segments import SegmentReader, is_segment_file
+
+
+def iter_log(path, t_start=None, t_end=None):
+    """
+    Yield the (timestamp, telemetry) lines of a .raw log or segment
+    recording, streaming from the file rather than loading it.
+
+    Only lines with t_start <= timestamp <= t_end (in ms) are returned; both
+    formats are indexed, so reading from t_start does not scan the lines
+    before it.
+
+    """
+    if is_segment_file(path):
+        with SegmentReader(path) as reader:
+            yield from reader.read(t_start=t_start, t_end=t_end)
+        return
+
+    with RawLogReader(path) as reader:
+        yield from reader.read(t_start=t_start, t_end=t_end)
+
+
+def first_timestamp(path):
+    """Return the first timestamp of a log, or None if it is empty."""
+    for _timestamp, _ in iter_log(path):
+        return _timestamp
+    return None
@@ -0,0 +1,648 @@
+"""
+_segments.py
+
+Compressed, indexed recording format for telemetry ('.ecs').
+
+Telemetry is highly repetitive, so the log lines are stored in compressed
+segments, each holding the lines of a single board. The lines in a segment
+are exactly those of the .raw format ("{timestamp}\\t{telemetry}\\n"), and
+each line has a sequence number, counting the lines of the recording, by
+which the segments of the boards are merged back into the order in which
+the lines were added. Lines with the same timestamp (e.g., a sent command
+and the telemetry that followed it) so keep their order, and converting a
+.raw log (as written by TelemetryLogWriter) to a segment recording and back
+gives the same file. Lines that are not telemetry (e.g., sent commands) are
+stored in segments with board ''.
+
+File layout::
+
+    file header     MAGIC (8 bytes), format version (uint16)
+    segment         SEGMENT_HEADER, followed by the compressed payload
+    segment         ...
+
+Segment header fields (little-endian)::
+
+    sync        b'SEG\\0'
+    codec       0: none, 1: zlib, 2: lzma
+    board       3 ASCII bytes, NUL padded
+    t_start     first timestamp in the segment (ms)
+    t_end       last timestamp in the segment (ms)
+    count       number of lines
+    length      length of the compressed payload in bytes
+    crc32       CRC-32 of the compressed payload
+    seq_start   sequence number of the first line
+    seq_end     sequence number of the last line
+
+The payload, once decompressed, is the difference between the sequence
+number of each line and that of the line before it in the segment (uint32,
+little-endian; 0 for the first line), followed by the lines. The
+differences are small and repetitive (e.g., 4 when four boards take turns),
+so they compress well.
+Recordings of version 1, whose segments have no sequence numbers, can still
+be read, but lines of different boards with the same timestamp may then be
+returned in another order.
+
+A sidecar index (path + '.idx') lists the offset, board and time bounds of
+every segment, so that a time range can be located without reading the
+recording. The index is only an accelerator: segments that it does not cover
+(e.g., after a crash) are found by walking the segment headers, which only
+needs a seek per segment, and the index is then rewritten.
+
+"""
+# standard library imports
+import heapq
+import logging
+import lzma
+import os
+import struct
+import time
+import zlib
+
+from collections import namedtuple
+from itertools import accumulate, zip_longest
+
+# local imports
+from ._raw import iter_raw_log, telemetry_board
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'EDUCSEG\x00'
+VERSION = 2
+FILE_HEADER = struct.Struct('<8sH')
+
+SEGMENT_SYNC = b'SEG\x00'
+SEGMENT_HEADER = struct.Struct('<4sB3sqqIIIQQ')
+
+INDEX_MAGIC = b'EDUCIDX\x00'
+INDEX_HEADER = struct.Struct('<8sHQ')       # magic, version, covered size
+INDEX_RECORD = struct.Struct('<Q3sxqqIQQ')  # offset, board, t_start, t_end,
+                                            # count, seq_start, seq_end
+
+# version -> the segment header and index record of recordings of that
+# version. Version 1 had no sequence numbers.
+SEGMENT_HEADERS = {1: struct.Struct('<4sB3sqqIII'), VERSION: SEGMENT_HEADER}
+INDEX_RECORDS = {1: struct.Struct('<Q3sxqqI'), VERSION: INDEX_RECORD}
+
+# largest difference between the sequence numbers of consecutive lines of a
+# segment
+MAX_SEQ_STEP = 0xFFFFFFFF
+
+DEFAULT_LINE_FORMAT = "{timestamp}\t{telemetry}\n"
+
+CODEC_NONE = 'none'
+CODEC_ZLIB = 'zlib'
+CODEC_LZMA = 'lzma'
+
+CODEC_IDS = {CODEC_NONE: 0, CODEC_ZLIB: 1, CODEC_LZMA: 2}
+CODEC_NAMES = {v: k for k, v in CODEC_IDS.items()}
+
+SEGMENT_EXTENSION = '.ecs'
+INDEX_EXTENSION = '.idx'
+
+# seq_start and seq_end are None for recordings of version 1
+SegmentInfo = namedtuple(
+    'SegmentInfo',
+    ('offset', 'board', 't_start', 't_end', 'count', 'seq_start', 'seq_end')
+)
+
+
+class SegmentFormatError(Exception):
+    """Exception raised for a file that is not a valid segment recording."""
+
+
+def index_path(path):
+    """Return the path of the sidecar index of a segment recording."""
+    return path + INDEX_EXTENSION
+
+
+def is_segment_file(path):
+    """Return True if path starts with the segment recording header."""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _compress(data, codec, level):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 6 if level is None else level)
+    if codec == CODEC_LZMA:
+        return lzma.compress(data, preset=6 if level is None else level)
+    return data
+
+
+def _decompress(data, codec_id):
+    codec = CODEC_NAMES.get(codec_id)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    if codec == CODEC_NONE:
+        return data
+    raise SegmentFormatError(f'Unknown segment codec {codec_id}')
+
+
+def _encode_board(board):
+    return board.encode('ascii', errors='replace')[:3].ljust(3, b'\0')
+
+
+def _decode_board(board):
+    return board.rstrip(b'\0').decode('ascii', errors='replace')
+
+
+# ****************************************************************************
+# Writing
+# ****************************************************************************
+class _PendingSegment():
+    """Lines of one board waiting to be written as a segment."""
+    __slots__ = ('lines', 'seqs', 'nbytes', 't_start', 't_end', 'since')
+
+    def __init__(self, since):
+        self.lines = []
+        self.seqs = []
+        self.nbytes = 0
+        self.t_start = None
+        self.t_end = None
+        self.since = since
+
+
+class SegmentWriter():
+    """Appends telemetry to a segment recording and its index."""
+    def __init__(self, path, codec=CODEC_ZLIB, level=None,
+                 segment_lines=4096, segment_bytes=262144,
+                 segment_interval_s=60.0, line_format=DEFAULT_LINE_FORMAT):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        path : str
+            The recording. If it already exists, segments are appended.
+        codec : str
+            Compression of the segments: 'zlib', 'lzma' or 'none'
+        level : int
+            Compression level (zlib 0-9, lzma preset 0-9)
+        segment_lines : int
+            Most lines in a segment
+        segment_bytes : int
+            Most uncompressed bytes in a segment
+        segment_interval_s : float
+            Longest time lines wait before their segment is written, when
+            write_ready is called. Larger segments compress better, but more
+            data is lost if the process is killed.
+        line_format : str
+            Format of each stored line. Must be the .raw line format for the
+            recording to be converted back to .raw.
+
+        """
+        if codec not in CODEC_IDS:
+            errmsg = (f'Invalid codec {codec!r} '
+                      f'(must be one of {tuple(CODEC_IDS)})')
+            raise ValueError(errmsg)
+
+        self.path = path
+        self.codec = codec
+        self.level = level
+        self.segment_lines = segment_lines
+        self.segment_bytes = segment_bytes
+        self.segment_interval_s = segment_interval_s
+        self.line_format = line_format
+
+        self._pending = dict()      # board -> _PendingSegment
+
+        self.segments = 0
+        self.lines = 0
+        self.raw_bytes = 0
+
+        # sequence number of the next line
+        self._seq = 0
+
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(FILE_HEADER.pack(MAGIC, VERSION))
+            self._index = open(index_path(path), 'wb')
+            self._index.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, 0))
+        else:
+            # make sure the existing recording, and its index, are complete
+            # before appending to them. An incomplete last segment (e.g.,
+            # after a crash) is removed.
+            with SegmentReader(path) as reader:
+                if reader.version != VERSION:
+                    self._file.close()
+                    errmsg = (f'Cannot append to {path}, a segment recording '
+                              f'of version {reader.version}')
+                    raise SegmentFormatError(errmsg)
+                _end = reader.data_end
+                self._seq = 1 + max((s.seq_end for s in reader.segments),
+                                    default=-1)
+            if self._file.tell() > _end:
+                logger.warning(f"Truncating {path} to {_end} bytes")
+                self._file.truncate(_end)
+                self._file.seek(0, os.SEEK_END)
+            self._index = open(index_path(path), 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+        return False
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def tell(self):
+        return self._file.tell()
+
+    def add(self, timestamp, telemetry):
+        """Add a line, writing its board's segment if it is full."""
+        _board = telemetry_board(telemetry)
+        _line = self.line_format.format(timestamp=timestamp,
+                                        telemetry=telemetry).encode('utf-8')
+
+        _segment = self._pending.get(_board)
+        if (_segment is not None
+                and self._seq - _segment.seqs[-1] > MAX_SEQ_STEP):
+            self._write_segment(_board)
+            _segment = None
+        if _segment is None:
+            _segment = _PendingSegment(time.monotonic())
+            self._pending[_board] = _segment
+
+        _segment.lines.append(_line)
+        _segment.seqs.append(self._seq)
+        self._seq += 1
+        _segment.nbytes += len(_line)
+        if _segment.t_start is None:
+            _segment.t_start = timestamp
+        _segment.t_end = timestamp
+
+        if (len(_segment.lines) >= self.segment_lines
+                or _segment.nbytes >= self.segment_bytes):
+            self._write_segment(_board)
+
+    def write_ready(self, now=None):
+        """Write the segments whose lines have waited segment_interval_s."""
+        if now is None:
+            now = time.monotonic()
+        for _board, _segment in list(self._pending.items()):
+            if now - _segment.since >= self.segment_interval_s:
+                self._write_segment(_board)
+
+    def write_pending(self):
+        """Write all pending lines, however few."""
+        for _board in list(self._pending):
+            self._write_segment(_board)
+
+    def flush(self):
+        """Flush the segments written so far to the file."""
+        self._file.flush()
+        self._index.flush()
+
+    def close(self):
+        self.write_pending()
+        self.flush()
+        self._update_index_size()
+        self._file.close()
+        self._index.close()
+
+    def _write_segment(self, board):
+        _segment = self._pending.pop(board)
+        _n = len(_segment.lines)
+        _seq_start, _seq_end = _segment.seqs[0], _segment.seqs[-1]
+        _steps = struct.pack(f'<{_n}I', 0, *(
+            _seq - _previous for _previous, _seq
+            in zip(_segment.seqs, _segment.seqs[1:])
+        ))
+        _payload = _compress(_steps + b''.join(_segment.lines),
+                             self.codec, self.level)
+
+        _offset = self._file.tell()
+        self._file.write(SEGMENT_HEADER.pack(
+            SEGMENT_SYNC, CODEC_IDS[self.codec], _encode_board(board),
+            _segment.t_start, _segment.t_end, _n, len(_payload),
+            zlib.crc32(_payload), _seq_start, _seq_end
+        ))
+        self._file.write(_payload)
+
+        self._index.write(INDEX_RECORD.pack(
+            _offset, _encode_board(board), _segment.t_start, _segment.t_end,
+            _n, _seq_start, _seq_end
+        ))
+
+        self.segments += 1
+        self.lines += len(_segment.lines)
+        self.raw_bytes += _segment.nbytes
+
+    def _update_index_size(self):
+        """Record in the index how much of the recording it covers."""
+        self._file.flush()
+        _size = os.path.getsize(self.path)
+        self._index.flush()
+        with open(index_path(self.path), 'r+b') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, _size))
+
+
+# ****************************************************************************
+# Reading
+# ****************************************************************************
+class SegmentReader():
+    """Reads time ranges from a segment recording."""
+    def __init__(self, path):
+        """
+        Constructor. Loads the index of the recording at path, rebuilding it
+        if it is missing or out of date.
+
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+
+        _magic, _version = FILE_HEADER.unpack(
+            self._file.read(FILE_HEADER.size).ljust(FILE_HEADER.size, b'\0')
+        )
+        if _magic != MAGIC:
+            raise SegmentFormatError(f'{path} is not a segment recording')
+        if _version not in SEGMENT_HEADERS:
+            errmsg = f'Unsupported segment recording version {_version}'
+            raise SegmentFormatError(errmsg)
+        self.version = _version
+        self._header = SEGMENT_HEADERS[_version]
+        self._record = INDEX_RECORDS[_version]
+
+        self.segments = self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        return self.read()
+
+    @property
+    def t_start(self):
+        return min((s.t_start for s in self.segments), default=None)
+
+    @property
+    def t_end(self):
+        return max((s.t_end for s in self.segments), default=None)
+
+    @property
+    def boards(self):
+        return sorted({s.board for s in self.segments})
+
+    def read(self, t_start=None, t_end=None, boards=None):
+        """
+        Yield (timestamp, telemetry) lines in the order in which they were
+        added (time order, for a recording of live telemetry).
+
+        Parameters
+        ----------
+        t_start, t_end : int
+            Only lines with t_start <= timestamp <= t_end (in ms) are
+            returned. Only the segments that overlap the range are read.
+        boards : iterable of str
+            Only lines of these boards are returned ('' for lines that are
+            not telemetry)
+
+        """
+        if boards is not None:
+            boards = set(boards)
+
+        _segments = [
+            s for s in self.segments
+            if (t_start is None or s.t_end >= t_start)
+            and (t_end is None or s.t_start <= t_end)
+            and (boards is None or s.board in boards)
+        ]
+
+        # segments of each board are in time order, so only one segment per
+        # board is decompressed at a time
+        _by_board = dict()
+        for s in _segments:
+            _by_board.setdefault(s.board, []).append(s)
+
+        _streams = [self._read_segments(s, t_start, t_end)
+                    for s in _by_board.values()]
+        return (_line[1:] for _line in
+                heapq.merge(*_streams, key=lambda line: line[0]))
+
+    def _read_segments(self, segments, t_start, t_end):
+        """
+        Yield the (key, timestamp, telemetry) lines of segments, where key
+        is the sequence number of the line (its timestamp in recordings of
+        version 1).
+
+        """
+        for _segment in segments:
+            _seqs, _lines = self._read_lines(_segment)
+            for _seq, (_timestamp, _telemetry) in zip(_seqs, _lines):
+                if t_start is not None and _timestamp < t_start:
+                    continue
+                if t_end is not None and _timestamp > t_end:
+                    break
+                yield _seq, _timestamp, _telemetry
+
+    def read_segment(self, segment):
+        """Return the (timestamp, telemetry) lines of one segment."""
+        return self._read_lines(segment)[1]
+
+    def _read_lines(self, segment):
+        """
+        Return the sequence numbers (the timestamps in recordings of version
+        1) and the (timestamp, telemetry) lines of one segment.
+
+        """
+        self._file.seek(segment.offset)
+        _header = self._read_header()
+        if _header is None:
+            errmsg = f'Invalid segment at offset {segment.offset}'
+            raise SegmentFormatError(errmsg)
+
+        _codec, _length, _crc = _header[1], _header[6], _header[7]
+        _payload = self._file.read(_length)
+        if len(_payload) != _length or zlib.crc32(_payload) != _crc:
+            errmsg = f'Corrupted segment at offset {segment.offset}'
+            raise SegmentFormatError(errmsg)
+
+        _data = _decompress(_payload, _codec)
+        _steps = ()
+        if segment.seq_start is not None:
+            _steps = struct.unpack_from(f'<{segment.count}I', _data)
+            _data = _data[4 * segment.count:]
+
+        _lines = []
+        for _line in _data.decode('utf-8').splitlines():
+            _timestamp, _, _telemetry = _line.partition('\t')
+            _lines.append((int(_timestamp), _telemetry))
+
+        if segment.seq_start is None:
+            return [_line[0] for _line in _lines], _lines
+        return list(accumulate(_steps, initial=segment.seq_start))[1:], _lines
+
+    # ******************************
+    # index
+    # ******************************
+    def _read_header(self):
+        _data = self._file.read(self._header.size)
+        if len(_data) < self._header.size:
+            return None
+        _header = self._header.unpack(_data)
+        if _header[0] != SEGMENT_SYNC:
+            return None
+        return _header
+
+    def _load_index(self):
+        _size = os.fstat(self._file.fileno()).st_size
+
+        segments = []
+        _scan_from = FILE_HEADER.size
+        _covered = 0
+        _rebuild = False
+        try:
+            with open(index_path(self.path), 'rb') as f:
+                _magic, _version, _covered = INDEX_HEADER.unpack(
+                    f.read(INDEX_HEADER.size)
+                )
+                if _magic != INDEX_MAGIC or _version != self.version:
+                    raise SegmentFormatError('Invalid index')
+
+                _records = f.read()
+            _n = len(_records) // self._record.size
+            for _record in self._record.iter_unpack(
+                    _records[:_n * self._record.size]):
+                _offset, _board, _t_start, _t_end, _count, *_seqs = _record
+                segments.append(SegmentInfo(
+                    _offset, _decode_board(_board), _t_start, _t_end, _count,
+                    *(_seqs or (None, None))
+                ))
+        except (OSError, struct.error, SegmentFormatError):
+            logger.info(f"Rebuilding segment index for {self.path}")
+            segments = []
+            _rebuild = True
+
+        if segments:
+            # continue from the end of the last indexed segment, after
+            # checking that it is really there
+            _last = segments[-1]
+            self._file.seek(_last.offset)
+            _header = self._read_header()
+            _end = (None if _header is None
+                    else _last.offset + self._header.size + _header[6])
+            if _end is None or _end > _size:
+                logger.info(f"Rebuilding segment index for {self.path}")
+                segments = []
+                _rebuild = True
+            else:
+                _scan_from = _end
+
+        self.data_end = _scan_from
+        if _covered == _size and _scan_from >= _size:
+            return segments
+
+        # walk the headers of the segments not in the index. The index is
+        # only rewritten if it was missing any.
+        _new = self._scan(_scan_from, _size)
+        segments.extend(_new)
+        if _new:
+            _last = _new[-1]
+            self._file.seek(_last.offset)
+            self.data_end = (_last.offset + self._header.size
+                             + self._read_header()[6])
+        if _new or _rebuild:
+            self._write_index(segments, _size)
+        return segments
+
+    def _scan(self, offset, size):
+        segments = []
+        while offset < size:
+            self._file.seek(offset)
+            _header = self._read_header()
+            if (_header is None
+                    or offset + self._header.size + _header[6] > size):
+                logger.warning(
+                    f"Ignoring incomplete segment at offset {offset} "
+                    f"of {self.path}"
+                )
+                break
+            _, _, _board, _t_start, _t_end, _count, _length, _, *_seqs = (
+                _header
+            )
+            segments.append(SegmentInfo(
+                offset, _decode_board(_board), _t_start, _t_end, _count,
+                *(_seqs or (None, None))
+            ))
+            offset += self._header.size + _length
+        return segments
+
+    def _write_index(self, segments, size):
+        try:
+            with open(index_path(self.path), 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.version, size))
+                for s in segments:
+                    _seqs = () if s.seq_start is None else s[5:]
+                    f.write(self._record.pack(
+                        s.offset, _encode_board(s.board), s.t_start, s.t_end,
+                        s.count, *_seqs
+                    ))
+        except OSError:
+            errmsg = f"Could not write segment index for {self.path}"
+            logger.exception(errmsg, exc_info=True)
+
+
+# ****************************************************************************
+# Conversion
+# ****************************************************************************
+def raw_to_segments(raw_paths, path, **kwargs):
+    """
+    Convert one or more .raw logs (in order) into a segment recording.
+
+    Keyword arguments are passed to SegmentWriter. Returns the SegmentWriter,
+    closed, for its statistics.
+
+    """
+    if isinstance(raw_paths, str):
+        raw_paths = (raw_paths,)
+
+    with SegmentWriter(path, **kwargs) as writer:
+        for _raw_path in raw_paths:
+            for _timestamp, _telemetry in iter_raw_log(_raw_path):
+                writer.add(_timestamp, _telemetry)
+    return writer
+
+
+def segments_to_raw(path, raw_path, line_format=DEFAULT_LINE_FORMAT):
+    """
+    Convert a segment recording into a .raw log, with its lines in the order
+    in which they were added.
+
+    """
+    _n = 0
+    with SegmentReader(path) as reader, \
+            open(raw_path, 'w', encoding='utf-8') as f:
+        for _timestamp, _telemetry in reader.read():
+            f.write(line_format.format(timestamp=_timestamp,
+                                       telemetry=_telemetry))
+            _n += 1
+    return _n
+
+
+def segments_match_raw(path, raw_paths):
+    """
+    Return True if a segment recording holds exactly the lines of one or
+    more .raw logs (in order), as raw_to_segments would have stored them.
+
+    """
+    if isinstance(raw_paths, str):
+        raw_paths = (raw_paths,)
+
+    _raw_lines = (_line for _raw_path in raw_paths
+                  for _line in iter_raw_log(_raw_path))
+    with SegmentReader(path) as reader:
+        for _line, _raw_line in zip_longest(reader.read(), _raw_lines):
+            if _line != _raw_line:
+                return False
+    return True
@@ -0,0 +1,330 @@
+"""
+_writer.py
+
+Writes the telemetry and command log from a dedicated thread.
+
+Lines are handed to TelemetryLogWriter from any thread and returned from
+immediately. The writer thread formats them, and writes them in batches: a
+batch is flushed once it holds flush_bytes, or once its oldest line has
+waited flush_interval_s. After each flush, or only when a file is closed, the
+file may also be fsync'd to guarantee that the data has reached the disk.
+
+The log is either text, one "{timestamp}\t{telemetry}" line per packet
+('raw'), or compressed segments ('segments', see _segments.py). Segments are
+only written once full or once their lines have waited segment_interval_s, so
+the flush settings only apply to segments already written.
+
+Long sessions are split across several files by size or by duration. The
+first file is the given path; later files insert a sequence number before
+the extension (e.g., telemetry.raw, telemetry.001.raw, telemetry.002.raw).
+
+"""
+# standard library imports
+import logging
+import os
+import sys
+import time
+
+from collections import deque, namedtuple
+from threading import Thread, Event, Lock
+
+# local imports
+from ._segments import SegmentWriter
+
+logger = logging.getLogger(__name__)
+
+# fsync policies
+FSYNC_NEVER = 'never'
+FSYNC_ON_FLUSH = 'flush'
+FSYNC_ON_CLOSE = 'close'
+
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_ON_FLUSH, FSYNC_ON_CLOSE)
+
+# log formats
+LOG_FORMAT_RAW = 'raw'
+LOG_FORMAT_SEGMENTS = 'segments'
+
+LOG_FORMATS = (LOG_FORMAT_RAW, LOG_FORMAT_SEGMENTS)
+
+DEFAULT_LINE_FORMAT = "{timestamp}\t{telemetry}\n"
+
+LogWriterStats = namedtuple(
+    'LogWriterStats', ('lines', 'bytes', 'flushes', 'fsyncs', 'files')
+)
+
+
+def rotated_path(path, index):
+    """Return the path of the index'th file of a log starting at path."""
+    if index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.{index:03d}{ext}'
+
+
+class TelemetryLogWriter(Thread):
+    """Thread that batches, writes and rotates a telemetry log."""
+    def __init__(self, path, line_format=DEFAULT_LINE_FORMAT,
+                 flush_bytes=65536, flush_interval_s=1.0, fsync=FSYNC_NEVER,
+                 rotate_bytes=None, rotate_interval_s=None, echo=False,
+                 log_format=LOG_FORMAT_RAW, segment_options=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        path : str
+            The log file. Lines are appended if it already exists.
+        line_format : str
+            Format of each line, with fields timestamp and telemetry
+        flush_bytes : int
+            Size in bytes at which a batch of lines is written
+        flush_interval_s : float
+            Longest time in seconds a line waits before it is written
+        fsync : str
+            'never' leaves writing to disk to the operating system, 'flush'
+            fsyncs after every batch, and 'close' fsyncs each file when it is
+            closed.
+        rotate_bytes : int
+            Start a new file once the current one reaches this size
+        rotate_interval_s : float
+            Start a new file once the current one has been open this long
+        echo : bool
+            Also print each line to stdout
+        log_format : str
+            'raw' for a text log, or 'segments' for compressed segments
+        segment_options : dict
+            Keyword arguments for SegmentWriter (e.g., codec), when
+            log_format is 'segments'
+
+        """
+        if fsync not in FSYNC_POLICIES:
+            errmsg = (f'Invalid fsync policy {fsync!r} '
+                      f'(must be one of {FSYNC_POLICIES})')
+            raise ValueError(errmsg)
+
+        if log_format not in LOG_FORMATS:
+            errmsg = (f'Invalid log format {log_format!r} '
+                      f'(must be one of {LOG_FORMATS})')
+            raise ValueError(errmsg)
+
+        self.path = path
+        self.line_format = line_format
+        self.flush_bytes = flush_bytes
+        self.flush_interval_s = flush_interval_s
+        self.fsync = fsync
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval_s = rotate_interval_s
+        self.echo = echo
+        self.log_format = log_format
+        self.segment_options = dict(segment_options or {})
+
+        self.paths = []
+        self.running = False
+
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._lock = Lock()
+        self._wake = Event()
+
+        self._file = None
+        self._file_path = None
+        self._file_index = 0
+        self._file_opened = None
+        self._file_bytes = 0
+
+        self.lines = 0
+        self.bytes = 0
+        self.flushes = 0
+        self.fsyncs = 0
+
+        super().__init__(daemon=True)
+
+    ################
+    # context manager
+    ################
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+        return False
+
+    ################
+    # producer interface
+    ################
+
+    def write(self, timestamp, telemetry):
+        """
+        Queue one line to be written. telemetry may be str or bytes; it is
+        stripped of surrounding whitespace.
+
+        """
+        self.extend(((timestamp, telemetry),))
+
+    def extend(self, records):
+        """Queue a sequence of (timestamp, telemetry) lines to be written."""
+        records = list(records)
+        if not records:
+            return
+
+        _nbytes = sum(len(_telemetry) for _, _telemetry in records)
+        with self._lock:
+            self._queue.extend(records)
+            self._queued_bytes += _nbytes
+            _full = self._queued_bytes >= self.flush_bytes
+
+        if _full:
+            self._wake.set()
+
+    ################
+    # thread management
+    ################
+
+    def start(self):
+        self._open_file(time.monotonic())
+        self.running = True
+        super().start()
+
+    def close(self):
+        """Write everything queued, close the log and stop the thread."""
+        self.running = False
+        self._wake.set()
+        self.join()
+
+    def stats(self):
+        """Return the writer counters as a LogWriterStats."""
+        return LogWriterStats(lines   = self.lines     ,
+                              bytes   = self.bytes     ,
+                              flushes = self.flushes   ,
+                              fsyncs  = self.fsyncs    ,
+                              files   = len(self.paths) )
+
+    def run(self):
+        """Thread loop to format and write queued lines."""
+        batch = []
+        batch_bytes = 0
+        batch_since = None
+
+        while True:
+            _running = self.running
+            if batch_since is None:
+                _timeout = self.flush_interval_s
+            else:
+                _timeout = (batch_since + self.flush_interval_s
+                            - time.monotonic())
+            self._wake.wait(max(_timeout, 0))
+            self._wake.clear()
+
+            with self._lock:
+                _records, self._queue = self._queue, deque()
+                self._queued_bytes = 0
+
+            now = time.monotonic()
+            if _records and batch_since is None:
+                batch_since = now
+
+            for _record in self._decode(_records):
+                batch.append(_record)
+                batch_bytes += len(_record[1])
+
+            if batch and (not _running
+                          or batch_bytes >= self.flush_bytes
+                          or now - batch_since >= self.flush_interval_s):
+                self._flush(batch)
+                batch = []
+                batch_bytes = 0
+                batch_since = None
+
+            if not _running:
+                break
+
+            if self._rotation_due(now):
+                self._close_file()
+                self._file_index += 1
+                self._open_file(now)
+
+        self._close_file()
+        logger.info(f"TelemetryLogWriter.run has ended: {self.stats()}")
+
+    # ******************************
+    # writer thread
+    # ******************************
+    def _decode(self, records):
+        for _timestamp, _telemetry in records:
+            if isinstance(_telemetry, bytes):
+                _telemetry = _telemetry.decode('utf-8', errors='replace')
+            yield _timestamp, _telemetry.strip()
+
+    def _format(self, batch):
+        return ''.join(
+            self.line_format.format(timestamp=_timestamp, telemetry=_telemetry)
+            for _timestamp, _telemetry in batch
+        )
+
+    def _flush(self, batch):
+        _data = None
+        try:
+            if self.log_format == LOG_FORMAT_SEGMENTS:
+                for _timestamp, _telemetry in batch:
+                    self._file.add(_timestamp, _telemetry)
+                self._file.write_ready()
+            else:
+                _data = self._format(batch)
+                self._file.write(_data)
+
+            self._file.flush()
+            if self.fsync == FSYNC_ON_FLUSH:
+                os.fsync(self._file.fileno())
+                self.fsyncs += 1
+        except:
+            errmsg = f"Encountered Error while writing log {self._file_path}"
+            logger.exception(errmsg, exc_info=True)
+            return
+
+        _file_bytes = self._file.tell()
+        self.lines += len(batch)
+        self.bytes += _file_bytes - self._file_bytes
+        self.flushes += 1
+        self._file_bytes = _file_bytes
+
+        if self.echo:
+            sys.stdout.write(_data or self._format(batch))
+            sys.stdout.flush()
+
+    def _rotation_due(self, now):
+        if self.rotate_bytes is not None:
+            if self._file_bytes >= self.rotate_bytes:
+                return True
+        if self.rotate_interval_s is not None:
+            if now - self._file_opened >= self.rotate_interval_s:
+                return True
+        return False
+
+    def _open_file(self, now):
+        _path = rotated_path(self.path, self._file_index)
+        if self.log_format == LOG_FORMAT_SEGMENTS:
+            self._file = SegmentWriter(_path, line_format=self.line_format,
+                                       **self.segment_options)
+        else:
+            self._file = open(_path, 'a', encoding='utf-8')
+        self._file_path = _path
+        self._file_opened = now
+        self._file_bytes = self._file.tell()
+        self.paths.append(_path)
+        logger.info(f"Writing telemetry log to {_path}")
+
+    def _close_file(self):
+        try:
+            if self.log_format == LOG_FORMAT_SEGMENTS:
+                self._file.write_pending()
+            self._file.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._file.fileno())
+                self.fsyncs += 1
+        except:
+            errmsg = f"Encountered Error while closing log {self._file_path}"
+            logger.exception(errmsg, exc_info=True)
+        finally:
+            self._file.close()
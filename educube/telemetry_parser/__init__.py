@@ -1 +1,12 @@
 from ._telemetry_parser import parse_educube_telemetry
+from ._encode import (encode_telemetry, encode_projection, encode_delta,
+                      telemetry_content, telemetry_message, json_message,
+                      dumps, TelemetryEncoder, JSON_BACKEND)
+from ._lazy import (parse_educube_telemetry_lazy, LazyTelemetry,
+                    LazyBoardData)
+from ._batch import (parse_educube_telemetry_batch, board_columns,
+                     TelemetryBatch)
+from ._records import (parse_educube_record, record_from_values,
+                       record_class, TelemetryRecord)
+from ._binary import (BinaryTelemetryEncoder, BinarySchema,
+                      BinaryEncodingError)
@@ -1,5 +1,8 @@
 from collections import namedtuple
 
+from ._schema import (BoardSchema, Chip, Field, Fields, Struct, Apply,
+                      ANY, INT)
+
 ADC_FIELDS = ('SUN_SENSORS', #
               'SUN_DIR'    , #
               'MAGNO_TORQ' , #
@@ -66,3 +69,36 @@ def _parse_adc_telem(telem):
                        MPU_GYR     = mpu_gyr    , 
                        MPU_MAG     = mpu_mag     )
     return out
+
+
+# declared layout of ADC telemetry, e.g.
+# T|ADC|SOL,4,3,3,8|ANG,-90|MAG,1,0,0,0|WHL,3|MPU,ACC,-4.76,4.33,995.91|
+#       MPU,GYR,-0.21,-0.01,-0.08|MPU,MAG,-6057.53,-120.90,-2044.97
+ADC_SCHEMA = BoardSchema(
+    board = 'ADC',
+    chips = (
+        Chip('SOL', 4),
+        Chip('ANG', ANY),
+        Chip('MAG', 4),
+        Chip('WHL', ANY),
+        Chip('MPU', 4, key='ACC'),
+        Chip('MPU', 4, key='GYR'),
+        Chip('MPU', 4, key='MAG'),
+    ),
+    output = Struct(
+        ADCTelemetry,
+        Struct(SunSensor, *(Field('SOL', i) for i in range(4))),
+        Fields('ANG', columns=1),
+        Struct(MagTorqs,
+               Apply(_magnetorquer_sign,
+                     Field('MAG', 0, int), Field('MAG', 1, int), type=INT),
+               Apply(_magnetorquer_sign,
+                     Field('MAG', 2, int), Field('MAG', 3, int), type=INT)),
+        Fields('WHL', columns=1),
+        Struct(MPUAcc, *(Field('MPU_ACC', i) for i in (1, 2, 3))),
+        Struct(MPUGyr, *(Field('MPU_GYR', i) for i in (1, 2, 3))),
+        Struct(MPUMag, *(Field('MPU_MAG', i) for i in (1, 2, 3))),
+    ),
+    # packets that do not follow the layout
+    fallback = _parse_adc_telem,
+)
@@ -0,0 +1,158 @@
+"""
+_batch.py
+
+Parses many telemetry strings at once into column arrays.
+
+parse_educube_telemetry builds a hierarchy of namedtuples for every packet,
+which is convenient for the web interface but slow for thousands of packets.
+parse_educube_telemetry_batch instead groups the packets by board and writes
+the fields of each group straight into preallocated columns, one per field,
+named by their path in the parsed telemetry (e.g., 'MPU_GYR.X',
+'panel1.temperature.A', 'INA.66.bus_V'). The columns and the function
+reading them from a packet are compiled from the board schemas (see
+compile_columns). The columns are NumPy arrays if NumPy is installed,
+otherwise array.array (numbers) and lists (text).
+
+Numeric fields (including the INT and BOOL columns of the schemas) are
+float64, with NaN where a value is missing (e.g., the truncated panel 2
+temperatures of EXP telemetry). A packet that cannot be parsed -- as by
+parse_educube_telemetry, e.g. with missing chip telemetry, or a non-numeric
+value in a numeric field -- is not dropped: it keeps its row, with NaN and
+'' values, and is marked as invalid in the batch's validity mask.
+
+"""
+# standard library imports
+import math
+
+from array import array
+from collections import namedtuple
+
+# local imports
+from ._schema import compile_columns, FLOAT, TEXT
+from ._telemetry_parser import BOARD_SCHEMAS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NAN = math.nan
+
+# the rows of one board: index is the position of each row in the lines
+# given to the parser, and valid is True for the rows parsed successfully
+TelemetryBatch = namedtuple(
+    'TelemetryBatch', ('board', 'index', 'time', 'valid', 'columns')
+)
+
+
+# ****************************************************************************
+# board columns, compiled from the schemas
+# ****************************************************************************
+COLUMN_PARSERS = {
+        schema.board : compile_columns(schema) for schema in BOARD_SCHEMAS
+    }
+
+
+# ****************************************************************************
+# columns
+# ****************************************************************************
+def _allocate(column_type, n):
+    if column_type == TEXT:
+        return [''] * n
+    return array('d', (NAN,)) * n
+
+
+def _finish(column, column_type, use_numpy):
+    """Convert a column to its returned type."""
+    if not use_numpy:
+        return column
+    if column_type == TEXT:
+        return np.array(column, dtype=str)
+    return np.frombuffer(column, dtype=np.float64)
+
+
+# ****************************************************************************
+# parser
+# ****************************************************************************
+def board_columns(board):
+    """Return the (name, type) of the columns of a board's batches."""
+    return tuple((_name, TEXT if _type == TEXT else FLOAT)
+                 for _name, _type in COLUMN_PARSERS[board].columns)
+
+
+def parse_educube_telemetry_batch(timestamps, lines, use_numpy=None):
+    """
+    Parse telemetry strings into a TelemetryBatch of columns per board.
+
+    Parameters
+    ----------
+    timestamps : sequence of int
+        The UNIX time (in ms) at which each packet was received
+    lines : sequence of str
+        The telemetry strings, e.g. 'T|ADC|SOL,...'
+    use_numpy : bool
+        Return NumPy arrays (default: if NumPy is installed) rather than
+        array.array and lists
+
+    Returns a dict of board identifier to TelemetryBatch. The rows of each
+    batch are in the order of the lines. Lines with no recognised board
+    (e.g., logged commands) are returned in a batch for board '', with no
+    columns and every row invalid.
+
+    """
+    if use_numpy is None:
+        use_numpy = np is not None
+    elif use_numpy and np is None:
+        raise ImportError('NumPy is not installed')
+
+    # group the lines by board
+    _groups = dict()
+    for _i, _line in enumerate(lines):
+        _type, _, _rest = _line.strip().partition('|')
+        _board, _, _chips = _rest.partition('|')
+        if _type != 'T' or not _chips or _board not in COLUMN_PARSERS:
+            _board = ''
+        _group = _groups.get(_board)
+        if _group is None:
+            _group = _groups[_board] = []
+        _group.append((_i, _chips))
+
+    batches = dict()
+    for _board, _group in _groups.items():
+        _n = len(_group)
+        _index = array('q', (_i for _i, _ in _group))
+        _time = array('q', (timestamps[_i] for _i, _ in _group))
+        _valid = array('b', (0,)) * _n
+        _columns = dict()
+
+        if _board:
+            _schema = board_columns(_board)
+            _row_function = COLUMN_PARSERS[_board].row
+            _lists = [_allocate(_type, _n) for _, _type in _schema]
+
+            for _row, (_, _chips) in enumerate(_group):
+                try:
+                    _values = _row_function(_chips.split('|'))
+                except Exception:
+                    # corrupted packet: the row keeps its default values
+                    continue
+                for _column, _value in zip(_lists, _values):
+                    _column[_row] = _value
+                _valid[_row] = 1
+
+            _columns = {
+                _name: _finish(_column, _type, use_numpy)
+                for (_name, _type), _column in zip(_schema, _lists)
+            }
+
+        if use_numpy:
+            _index = np.frombuffer(_index, dtype=np.int64)
+            _time = np.frombuffer(_time, dtype=np.int64)
+            _valid = np.frombuffer(_valid, dtype=np.int8).astype(bool)
+
+        batches[_board] = TelemetryBatch(board   = _board  ,
+                                         index   = _index  ,
+                                         time    = _time   ,
+                                         valid   = _valid  ,
+                                         columns = _columns )
+    return batches
@@ -0,0 +1,190 @@
+"""
+_bench.py
+
+Benchmarks of the telemetry parsers and encoders, on simulated telemetry.
+
+Prints the tables quoted in the docstrings of _schema.py, _encode.py,
+_binary.py and _records.py:
+
+    python -m educube.telemetry_parser._bench [-n PACKETS] [--seed SEED]
+
+The packets are made by the simulator's model of the boards
+(SimulatedEduCube), with a seeded random generator, so the sizes are
+repeatable; times are the best of several runs, per packet. Needs the
+simulator, so POSIX only.
+
+"""
+# standard library imports
+import json
+import random
+import sys
+import time
+
+# third party imports
+import click
+
+# local imports
+from ._encode import (encode_projection, encode_telemetry, json_message,
+                      telemetry_message, dumps, JSON_BACKEND)
+from ._binary import BinaryTelemetryEncoder
+from ._records import parse_educube_record
+from ._telemetry_parser import (BOARD_PARSERS, BOARD_SCHEMAS,
+                                parse_educube_telemetry)
+from ._util import serialise
+
+BOARDS = tuple(_schema.board for _schema in BOARD_SCHEMAS)
+
+# the fields of the web interface's telemetry messages (all but the string)
+MESSAGE_FIELDS = ('board', 'data', 'device', 'time', 'type')
+
+REPEATS = 10
+
+
+def simulated_telemetry(n, seed):
+    """Return n telemetry strings of each board, as a dict by board."""
+    from educube.simulator import SimulatedEduCube
+
+    _cube = SimulatedEduCube(rng=random.Random(seed))
+    return {_board: [_cube.telemetry(_board) for _ in range(n)]
+            for _board in BOARDS}
+
+
+def time_per_item(function, items):
+    """Return the best time of function over items, in us per item."""
+    _best = float('inf')
+    for _ in range(REPEATS):
+        _start = time.perf_counter()
+        for _item in items:
+            function(_item)
+        _best = min(_best, time.perf_counter() - _start)
+    return _best / len(items) * 1e6
+
+
+def deep_size(obj, seen=None):
+    """Return the size of obj and of the objects it holds, in bytes."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    _size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        _size += sum(deep_size(_item, seen) for _item in obj)
+    elif isinstance(obj, dict):
+        _size += sum(deep_size(_key, seen) + deep_size(_value, seen)
+                     for _key, _value in obj.items())
+    return _size
+
+
+def _mean(values):
+    return sum(values) / len(values)
+
+
+# ****************************************************************************
+# benchmarks
+# ****************************************************************************
+def bench_parse(packets):
+    """Compiled schema parsers against the fallback (dict) parsers."""
+    click.echo('Parsing, per packet (_schema.py):\n')
+    click.echo('    board   fallback   compiled')
+    for _schema in BOARD_SCHEMAS:
+        _chips = [_string.split('|')[2:]
+                  for _string in packets[_schema.board]]
+        _fallback = time_per_item(_schema.fallback, _chips)
+        _compiled = time_per_item(BOARD_PARSERS[_schema.board], _chips)
+        click.echo(f'    {_schema.board}    {_fallback:6.1f} us  '
+                   f'{_compiled:6.1f} us')
+
+
+def _serialise_message(telemetry):
+    return json.dumps({'msgtype': 'telemetry',
+                       'msgcontent': serialise(telemetry)})
+
+
+def _json_message(telemetry):
+    return json_message('telemetry', json.dumps(encode_telemetry(telemetry),
+                                                separators=(',', ':')))
+
+
+def bench_encode(packets):
+    """serialise + json against TelemetryEncoder, with json and orjson."""
+    click.echo('\nWebSocket telemetry message, per packet (_encode.py):\n')
+    _orjson = JSON_BACKEND == 'orjson'
+    click.echo('    board   serialise + json   encoder + json'
+               + ('   encoder + orjson' if _orjson else ''))
+    for _board in BOARDS:
+        _telemetry = [parse_educube_telemetry(0, _string)
+                      for _string in packets[_board]]
+        _line = (f'    {_board}      '
+                 f'{time_per_item(_serialise_message, _telemetry):6.1f} us'
+                 f'        '
+                 f'{time_per_item(_json_message, _telemetry):6.1f} us')
+        if _orjson:
+            _line += (f'        '
+                      f'{time_per_item(telemetry_message, _telemetry):6.1f}'
+                      f' us')
+        click.echo(_line)
+    if not _orjson:
+        click.echo('    (orjson is not installed)')
+
+
+def bench_binary(packets):
+    """JSON messages against binary frames: size and time."""
+    click.echo(f'\nTelemetry message size and time, per packet (_binary.py, '
+               f'JSON dumped with {JSON_BACKEND}):\n')
+    click.echo('    board         JSON              binary')
+    _encoder = BinaryTelemetryEncoder()
+    for _board in BOARDS:
+        _telemetry = [parse_educube_telemetry(0, _string)
+                      for _string in packets[_board]]
+
+        def _json(telemetry):
+            return json_message(
+                'telemetry',
+                dumps(encode_projection(telemetry, MESSAGE_FIELDS)), seq=1
+            )
+
+        def _frame(telemetry):
+            return _encoder.encode(telemetry, MESSAGE_FIELDS, 1)[1]
+
+        _json_size = _mean([len(_json(_t).encode('utf-8'))
+                            for _t in _telemetry])
+        _frame_size = _mean([len(_frame(_t)) for _t in _telemetry])
+        _json_time = time_per_item(_json, _telemetry)
+        _frame_time = time_per_item(_frame, _telemetry)
+        click.echo(f'    {_board}     {_json_size:5.0f} B {_json_time:5.1f} '
+                   f'us   {_frame_size:5.0f} B {_frame_time:5.1f} us')
+
+
+def bench_records(packets):
+    """Memory of a TelemetryRecord against that of a Telemetry."""
+    click.echo('\nMemory per packet (_records.py):\n')
+    click.echo('    board   TelemetryRecord   Telemetry   string')
+    for _board in BOARDS:
+        _strings = packets[_board]
+        _record = _mean([parse_educube_record(0, _s)._footprint()
+                         for _s in _strings])
+        _telemetry = _mean([deep_size(parse_educube_telemetry(0, _s))
+                            for _s in _strings])
+        _string = _mean([sys.getsizeof(_s) for _s in _strings])
+        click.echo(f'    {_board}      {_record:5.0f} bytes     '
+                   f'{_telemetry:5.0f} bytes  {_string:4.0f} bytes')
+
+
+@click.command()
+@click.option('-n', '--packets', type=click.IntRange(min=1), default=2000,
+              help='Simulated packets per board')
+@click.option('--seed', type=int, default=1)
+def main(packets, seed):
+    """Time the telemetry parsers and encoders on simulated telemetry."""
+    _packets = simulated_telemetry(packets, seed)
+    click.echo(f'{packets} simulated packets per board, Python '
+               f'{sys.version.split()[0]}\n')
+    bench_parse(_packets)
+    bench_encode(_packets)
+    bench_binary(_packets)
+    bench_records(_packets)
+
+
+if __name__ == '__main__':
+    main()
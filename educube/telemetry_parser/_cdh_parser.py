@@ -1,6 +1,11 @@
+import re
+
 from collections import namedtuple
 from datetime import datetime as dt
 
+from ._schema import (BoardSchema, Chip, Field, Struct, Lookup, INT, BOOL,
+                      TEXT)
+
 CDH_FIELDS = ('GPS_DATE'      , #
               'GPS_FIX'       , #
               'GPS_FIX_DEGMIN', #
@@ -88,3 +93,78 @@ def _parse_cdh_telem(telem):
                        HOT_PLUG       = hotplug        )
     return out
 
+
+
+# ****************************************************************************
+# schema
+# ****************************************************************************
+
+# the GPS date as matched by strptime('%y/%m/%dT%H:%M:%S')
+GPS_DATE_PATTERN = re.compile(
+    r'(\d\d)/(1[0-2]|0[1-9]|[1-9])/(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])'
+    r'T(2[0-3]|[0-1]\d|\d):([0-5]\d|\d):(6[0-1]|[0-5]\d|\d)',
+    re.IGNORECASE
+)
+
+_last_gps_date = (None, None)
+
+
+def gps_date(value):
+    """
+    Reformat the GPS date as '%Y/%m/%d  %H:%M:%S', or return None if it is
+    not a valid date. Equivalent to strptime followed by strftime, but
+    several times faster; consecutive packets often share the same date, so
+    the last result is reused.
+
+    """
+    global _last_gps_date
+    if value == _last_gps_date[0]:
+        return _last_gps_date[1]
+
+    _formatted = None
+    _match = GPS_DATE_PATTERN.fullmatch(value)
+    if _match is not None:
+        _y, _m, _d, _H, _M, _S = map(int, _match.groups())
+        _y += 2000 if _y < 69 else 1900
+        try:
+            # validates the day of the month and the seconds
+            dt(_y, _m, _d, _H, _M, _S)
+        except ValueError:
+            pass
+        else:
+            _formatted = (f'{_y:04d}/{_m:02d}/{_d:02d}  '
+                          f'{_H:02d}:{_M:02d}:{_S:02d}')
+
+    _last_gps_date = (value, _formatted)
+    return _formatted
+
+
+def _gps_degrees(value):
+    return float(value)/1e7
+
+
+# declared layout of CDH telemetry, e.g.
+# T|CDH|GPS,16/10/26T20:24:31,535093200,-65237100,120,40000000,3|SEP,1,0,0,0,1
+CDH_SCHEMA = BoardSchema(
+    board = 'CDH',
+    chips = (
+        Chip('GPS', 6),
+        Chip('SEP', 5),
+    ),
+    output = Struct(
+        CDHTelemetry,
+        Field('GPS', 0, gps_date, TEXT),
+        Struct(GPSFix, Field('GPS', 1, _gps_degrees),
+                       Field('GPS', 2, _gps_degrees)),
+        Struct(GPSFix, Field('GPS', 1, _gps_degrees),
+                       Field('GPS', 2, _gps_degrees)),
+        Struct(GPSMeta, Field('GPS', 3), Field('GPS', 4, type=INT),
+                        Field('GPS', 5, type=INT),
+                        Lookup(GPS_STATUS, Field('GPS', 5), 'No Fix')),
+        Struct(SepStatus, Field('SEP', 0, type=INT),
+                          Lookup(SEPARATION_STATUS, Field('SEP', 0))),
+        Struct(HotPlug, *(Field('SEP', i, type=BOOL) for i in (1, 2, 3, 4))),
+    ),
+    # packets that do not follow the layout
+    fallback = _parse_cdh_telem,
+)
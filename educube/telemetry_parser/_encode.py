@@ -0,0 +1,264 @@
+"""
+_encode.py
+
+Fast conversion of telemetry to JSON.
+
+serialise (in _util.py) walks a packet recursively, testing every node for
+Iterable and _asdict. TelemetryEncoder instead generates an encoding function
+for each namedtuple type (ADCTelemetry, INATelem, ...) the first time it
+sees the type, which unpacks the tuple and builds the dict of its fields in
+one expression. For example, for MPUGyr (fields X, Y and Z):
+
+    def encode_MPUGyr(obj):
+        v0, v1, v2 = obj
+        return {'X': v0 if v0.__class__ in SCALARS else encode(v0),
+                'Y': v1 if v1.__class__ in SCALARS else encode(v1),
+                'Z': v2 if v2.__class__ in SCALARS else encode(v2)}
+
+Lists and tuples are encoded as lists, and other objects with an _asdict
+method (e.g., LazyTelemetry) through their dict. The result is dumped with
+orjson if it is installed, otherwise with the json module. (orjson writes
+non-finite floats, e.g. from a corrupted GPS fix, as null rather than as the
+Infinity and NaN that JSON.parse rejects.)
+
+Time to encode a telemetry WebSocket message, per packet, on the simulator's
+telemetry (CPython 3.11), as printed by
+python -m educube.telemetry_parser._bench (times vary from machine to machine,
+and from run to run; the ratios less so):
+
+    board   serialise + json   encoder + json   encoder + orjson
+    ADC          34 us              15 us              7 us
+    CDH          33 us              23 us              8 us
+    EPS         118 us              48 us             33 us
+    EXP          75 us              30 us             13 us
+
+"""
+# standard library imports
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+
+# types encoded as they are
+SCALARS = frozenset((str, int, float, bool, type(None)))
+
+
+def _encode_scalar(obj):
+    return obj
+
+
+class TelemetryEncoder():
+    """Converts telemetry into JSON-able dicts, lists and scalars."""
+    def __init__(self):
+        self._encoders = {_type: _encode_scalar for _type in SCALARS}
+        self._encoders[list] = self._encode_list
+        self._encoders[tuple] = self._encode_list
+        self._encoders[dict] = self._encode_dict
+
+    def encode(self, obj):
+        """Return obj as dicts, lists and scalars."""
+        _encoder = self._encoders.get(obj.__class__)
+        if _encoder is None:
+            _encoder = self._encoders[obj.__class__] = self._compile(
+                obj.__class__
+            )
+        return _encoder(obj)
+
+    def _encode_list(self, obj):
+        _encode = self.encode
+        return [_v if _v.__class__ in SCALARS else _encode(_v) for _v in obj]
+
+    def _encode_dict(self, obj):
+        _encode = self.encode
+        return {_k: _v if _v.__class__ in SCALARS else _encode(_v)
+                for _k, _v in obj.items()}
+
+    def _compile(self, cls):
+        """Return the encoding function of a type."""
+        if issubclass(cls, tuple) and hasattr(cls, '_fields'):
+            return self._compile_namedtuple(cls)
+        if hasattr(cls, '_asdict'):
+            return lambda obj: self._encode_dict(obj._asdict())
+        if issubclass(cls, (list, tuple)):
+            return self._encode_list
+        if issubclass(cls, dict):
+            return self._encode_dict
+        if issubclass(cls, (str, int, float)):
+            return _encode_scalar
+        raise TypeError(f'Cannot encode {cls.__name__} telemetry')
+
+    def _compile_namedtuple(self, cls):
+        _fields = cls._fields
+        _name = f'encode_{cls.__name__}'
+        if not _fields:
+            return lambda obj: {}
+
+        _vars = [f'v{i}' for i in range(len(_fields))]
+        _items = ',\n'.join(
+            f'        {_field!r}: {_var} if {_var}.__class__ in SCALARS '
+            f'else encode({_var})'
+            for _field, _var in zip(_fields, _vars)
+        )
+        _source = (f'def {_name}(obj):\n'
+                   f'    {", ".join(_vars)}, = obj\n'
+                   f'    return {{\n{_items}\n    }}\n')
+        logger.debug('Compiled encoder of %s:\n%s', cls.__name__, _source)
+
+        _namespace = {'SCALARS': SCALARS, 'encode': self.encode}
+        exec(compile(_source, f'<{_name}>', 'exec'), _namespace)
+        return _namespace[_name]
+
+
+# shared encoder, which keeps the functions of every type it has seen
+ENCODER = TelemetryEncoder()
+
+
+def encode_telemetry(telemetry):
+    """Return telemetry (e.g., a Telemetry) as dicts, lists and scalars."""
+    return ENCODER.encode(telemetry)
+
+
+def encode_projection(telemetry, fields):
+    """
+    Return only some fields of telemetry, as dicts, lists and scalars.
+
+    fields are attribute paths, e.g. 'time' or 'data.MPU_GYR', and the
+    result holds the same paths: {'time': ..., 'data': {'MPU_GYR': ...}}.
+    Fields that telemetry does not have (e.g., of another board) are left
+    out. With LazyTelemetry, only the fields given are parsed.
+
+    """
+    return project(telemetry, fields, ENCODER.encode)
+
+
+def project(telemetry, fields, convert=None):
+    """
+    Return only some fields of telemetry, as encode_projection does, but
+    with each value (that is not a scalar) passed to convert, if given,
+    rather than encoded.
+
+    """
+    _result = dict()
+    for _path in fields:
+        if '.' not in _path:
+            try:
+                _value = getattr(telemetry, _path)
+            except AttributeError:
+                continue
+            _result[_path] = (_value if convert is None
+                              or _value.__class__ in SCALARS
+                              else convert(_value))
+            continue
+
+        *_parents, _name = _path.split('.')
+        _value = telemetry
+        _target = _result
+        try:
+            for _parent in _parents:
+                _value = getattr(_value, _parent)
+            _value = getattr(_value, _name)
+        except AttributeError:
+            continue
+
+        for _parent in _parents:
+            _target = _target.setdefault(_parent, {})
+        _target[_name] = (_value if convert is None
+                          or _value.__class__ in SCALARS
+                          else convert(_value))
+    return _result
+
+
+class _Keyframe(Exception):
+    """Raised when encoded telemetry changed in structure, not just value."""
+
+
+# returned by _delta for values that did not change
+_UNCHANGED = object()
+
+
+def _delta(previous, current):
+    """Return the patch from previous to current, or _UNCHANGED."""
+    if current.__class__ is dict:
+        if previous.__class__ is not dict or previous.keys() != current.keys():
+            raise _Keyframe()
+        _patch = dict()
+        for _name, _value in current.items():
+            _change = _delta(previous[_name], _value)
+            if _change is not _UNCHANGED:
+                _patch[_name] = _change
+        return _patch if _patch else _UNCHANGED
+
+    if (current.__class__ is list and previous.__class__ is list
+            and len(previous) == len(current)):
+        _patch = dict()
+        for i, (_old, _value) in enumerate(zip(previous, current)):
+            _change = _delta(_old, _value)
+            if _change is not _UNCHANGED:
+                _patch[str(i)] = _change
+        return _patch if _patch else _UNCHANGED
+
+    if previous.__class__ is dict:
+        raise _Keyframe()
+    if previous.__class__ is current.__class__ and previous == current:
+        return _UNCHANGED
+    return current
+
+
+def encode_delta(previous, current):
+    """
+    Return the changes from one encoded packet to the next (as returned by
+    encode_telemetry or encode_projection), as a patch: a dict holding the
+    values that changed, at their paths. For example, if only the time and
+    the bus voltage of the first INA changed:
+
+        {'time': 1792208036511, 'data': {'INA': {'0': {'bus_V': '6.59'}}}}
+
+    Dicts are patched key by key, and lists of the same length index by
+    index (with the index as key); other values, and lists whose length
+    changed, are replaced. Returns None if the packets differ in structure
+    (e.g., a dict with other keys), which a patch cannot express.
+
+    """
+    try:
+        _patch = _delta(previous, current)
+    except _Keyframe:
+        return None
+    return dict() if _patch is _UNCHANGED else _patch
+
+
+def dumps(obj):
+    """Return obj (dicts, lists and scalars) as a compact JSON string."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def json_message(msgtype, content_json, **fields):
+    """
+    Return a JSON WebSocket message, {"msgtype": ..., "msgcontent": ...},
+    given the JSON of its content. Encoded content can so be reused, e.g.
+    a list of packets as '[' + ','.join(packets) + ']'. Any other fields
+    (e.g., seq=12) are added to the message.
+
+    """
+    _fields = ''.join(f'"{_name}":{dumps(_value)},'
+                      for _name, _value in fields.items())
+    return (f'{{"msgtype":{dumps(msgtype)},{_fields}'
+            f'"msgcontent":{content_json}}}')
+
+
+def telemetry_content(telemetry):
+    """Return the JSON of a telemetry packet, as sent to the web interface."""
+    return dumps(encode_telemetry(telemetry))
+
+
+def telemetry_message(telemetry, msgtype='telemetry'):
+    """Return the JSON WebSocket message carrying telemetry."""
+    return json_message(msgtype, telemetry_content(telemetry))
@@ -1,5 +1,9 @@
 from collections import namedtuple
 
+from ._schema import (BoardSchema, Chip, Repeat, Field, Struct, Apply,
+                      Lookup, ForEach, Const, BOOL, NO_COLUMN)
+from ._util import ina_power
+
 EPS_FIELDS = ('INA'        , #
               'DS2438'     , #
               'DS18B20_A'  , #
@@ -84,7 +88,7 @@ def _parse_eps_telem(telem):
     ds18b20_b_telem = DS18B20(_chip_telem.get('DC', [None])[0])
 
     # need error handling here???? not trivial to achieve using get. EAFP??? 
-    _charging_val = _chip_telem.get('C', None) 
+    _charging_val = (_chip_telem.get('C') or [None])[0]
     charging_status = (True if _charging_val == '1' 
                        else False if _charging_val == '0'
                        else None                         )
@@ -95,3 +99,42 @@ def _parse_eps_telem(telem):
                        DS18B20_B = ds18b20_b_telem,
                        CHARGING  = charging_status )
     return out
+
+
+def _charging_status(value):
+    return True if value == '1' else False if value == '0' else None
+
+
+# declared layout of EPS telemetry, e.g.
+# T|EPS|I,66,6.58,17.00|I,67,4.95,118.20|...|I,64,1.11,-0.10|
+#       DA,25.72,6.93,975.00|DB,24.10|DC,23.80|C,0
+EPS_SCHEMA = BoardSchema(
+    board = 'EPS',
+    chips = (
+        Repeat(Chip('I', 3, name='INA'), distinct=0),
+        Chip('DA', 3),
+        Chip('DB', 1),
+        Chip('DC', 1),
+        Chip('C', 1),
+    ),
+    output = Struct(
+        EPSTelemetry,
+        ForEach('INA', Struct(
+            INATelem,
+            Lookup(EPS_INA_NAME, Field('INA', 0), None, NO_COLUMN),
+            Field('INA', 0, type=NO_COLUMN),
+            Const(None),
+            Field('INA', 1),
+            Field('INA', 2),
+            Apply(ina_power, Field('INA', 1), Field('INA', 2)),
+            Const(1),
+            Lookup(EPS_INA_COMMAND_ID, Field('INA', 0), None, NO_COLUMN),
+        ), key='address', keys=tuple(EPS_INA_NAME)),
+        Struct(DS2438, Field('DA', 0), Field('DA', 1), Field('DA', 2)),
+        Struct(DS18B20, Field('DB', 0)),
+        Struct(DS18B20, Field('DC', 0)),
+        Field('C', 0, _charging_status, BOOL),
+    ),
+    # packets that do not follow the layout
+    fallback = _parse_eps_telem,
+)
@@ -45,6 +45,11 @@ The telemetry parts consist of:
 # standard library imports
 from collections import namedtuple
 
+# local imports
+from ._schema import (BoardSchema, Chip, Field, Struct, Apply, Const,
+                      NO_COLUMN)
+from ._util import ina_power
+
 
 EXP_FIELDS = (
     'panel1', # solar black
@@ -143,7 +148,7 @@ def _parse_exp_telem(telem):
 
         # handle the panel power status
         try:
-            therm_pwr, = _panel_telem['therm_']
+            therm_pwr, = _panel_telem['THERM_']
         except (KeyError, ValueError): 
             # either THERM_{panel} is missing from the packet or it is missing
             # its value
@@ -171,6 +176,54 @@ def _parse_exp_telem(telem):
     )
 
 
+def _exp_panel(panel, address):
+    """Output expression of one panel."""
+    _ina = f'I{address}'
+    return Struct(
+        EXPPanelTelemetry,
+        Field(f'THERM_P{panel}', 0),
+        Struct(INATelem,
+               Const(EXP_INA_NAME[address]),
+               Field(_ina, 0, type=NO_COLUMN),
+               Field(_ina, 1),
+               Field(_ina, 2),
+               Field(_ina, 3),
+               Apply(ina_power, Field(_ina, 2), Field(_ina, 3)),
+               Const(None),
+               Const(None)),
+        Struct(EXPTemperatureTelemetry,
+               *(Field(f'P{panel}{sensor}', 0) for sensor in 'ABC')),
+    )
+
+
+# declared layout of EXP telemetry, e.g.
+# T|EXP|THERM_P1,0|THERM_P2,0|I,64,-0.09,0.00,-1.00|I,67,-0.08,0.00,-0.20|
+#       P1A,20.69|P1B,20.81|P1C,20.88|P2A,20.94|P2B,21.06|P2C,21.13
+# The panel 2 temperatures are often truncated (see above).
+EXP_SCHEMA = BoardSchema(
+    board = 'EXP',
+    chips = (
+        Chip('THERM_P1', 1),
+        Chip('THERM_P2', 1),
+        Chip('I', 4, key='64', name='I64'),
+        Chip('I', 4, key='67', name='I67'),
+        Chip('P1A', 1),
+        Chip('P1B', 1),
+        Chip('P1C', 1),
+        Chip('P2A', 1, optional=True),
+        Chip('P2B', 1, optional=True),
+        Chip('P2C', 1, optional=True),
+    ),
+    output = Struct(
+        EXPTelemetry,
+        _exp_panel(1, '64'),
+        _exp_panel(2, '67'),
+    ),
+    # packets that do not follow the layout
+    fallback = _parse_exp_telem,
+)
+
+
 
 
 #    therm_pwr  = Panels(P1 = _chip_telem.get('THERM_P1', [None])[0],
@@ -0,0 +1,295 @@
+"""
+_lazy.py
+
+Telemetry that is parsed when it is read, rather than when it is received.
+
+parse_educube_telemetry parses every field of every packet, although the web
+interface only shows the tab of one board and the telemetry log only needs
+the raw string. parse_educube_telemetry_lazy instead returns a LazyTelemetry,
+which keeps the raw packet and reads no more than its type and board. Its
+data is a LazyBoardData: the packet is split and its layout checked when a
+field (e.g., data.MPU_GYR) is first read, and each field is built from the
+split parts when it is first read, then cached. Packets that do not follow
+their board's schema are parsed whole by the schema's fallback parser, and
+when every field is read at once (e.g., by _asdict) before any has been read
+alone, the packet is parsed whole by the board's parser, which is faster than
+field by field.
+
+LazyTelemetry has the same fields as Telemetry, and _serialised() and
+_as_JSON() (which parse every field). As parsing is deferred, a corrupted
+packet is not dropped when it is received: reading a field that cannot be
+parsed raises a TelemetryParserException. _parsed() returns the equivalent
+Telemetry, or None, as parse_educube_telemetry would have.
+
+"""
+# standard library imports
+import logging
+
+# local imports
+from ._schema import compile_lazy_schema
+from ._telemetry_parser import (BOARD_PARSERS, BOARD_SCHEMAS,
+                                TELEMETRY_FIELDS, Telemetry,
+                                TelemetryParserException)
+from ._encode import encode_telemetry, dumps
+from ._util import remove_value_none
+
+LOG = logging.getLogger(__name__)
+
+# look up table for the lazy parsers of each board, compiled from the schemas
+LAZY_PARSERS = {
+        schema.board : compile_lazy_schema(schema) for schema in BOARD_SCHEMAS
+    }
+
+
+class LazyBoardData():
+    """
+    The board telemetry of a packet, parsed field by field on first access.
+
+    Behaves like the namedtuple returned by the board's parser (e.g.,
+    ADCTelemetry) for attribute access, iteration and _asdict.
+
+    """
+    __slots__ = ('_parser', '_string', '_split', '_values')
+
+    def __init__(self, parser, telemetry_str):
+        """
+        Parameters
+        ----------
+        parser : LazyParser
+            The compiled lazy parser of the board
+        telemetry_str : str
+            The whole telemetry string, e.g. 'T|ADC|SOL,...'
+
+        """
+        self._parser = parser
+        self._string = telemetry_str
+        self._split = None          # split chip parts, once the layout is
+        self._values = dict()       # checked; field name -> parsed value
+
+    @property
+    def _fields(self):
+        return self._parser.cls._fields
+
+    def __getattr__(self, name):
+        # only called for names that are not slots or methods
+        if name.startswith('_') or name not in self._parser.extractors:
+            raise AttributeError(
+                f"{self._parser.cls.__name__!r} has no field {name!r}"
+            )
+        return self._field(name)
+
+    def _field(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+
+        if self._split is None:
+            self._split_chips()
+            if name in self._values:
+                return self._values[name]
+
+        try:
+            _value = self._parser.extractors[name](self._split)
+        except Exception as e:
+            raise TelemetryParserException(
+                f"Could not parse {self._parser.board} field {name} of "
+                f"telemetry packet: {self._string}"
+            ) from e
+
+        self._values[name] = _value
+        return _value
+
+    def _split_chips(self):
+        _chips = self._string.strip().split('|')[2:]
+        _split = self._parser.split(_chips)
+        if _split is not None:
+            self._split = _split
+            return
+
+        # the packet does not follow the layout: parse it all at once
+        try:
+            _parsed = self._parser.fallback(_chips)
+        except Exception as e:
+            raise TelemetryParserException(
+                f"Could not parse telemetry packet: {self._string}"
+            ) from e
+        self._values = dict(zip(_parsed._fields, _parsed))
+        self._split = ()
+
+    def _parse_all(self):
+        """Parse every field, at once if none has been parsed yet."""
+        if len(self._values) == len(self._fields):
+            return
+        if self._split is not None:
+            for _name in self._fields:
+                self._field(_name)
+            return
+
+        _chips = self._string.strip().split('|')[2:]
+        try:
+            _parsed = BOARD_PARSERS[self._parser.board](_chips)
+        except Exception as e:
+            raise TelemetryParserException(
+                f"Could not parse telemetry packet: {self._string}"
+            ) from e
+        self._values = dict(zip(_parsed._fields, _parsed))
+        self._split = ()
+
+    def _asdict(self):
+        """Parse every field, and return them as a dict."""
+        self._parse_all()
+        return {_name: self._values[_name] for _name in self._fields}
+
+    def _parsed(self):
+        """Parse every field, and return the board's namedtuple."""
+        self._parse_all()
+        return self._parser.cls(**self._values)
+
+    def __iter__(self):
+        self._parse_all()
+        return (self._values[_name] for _name in self._fields)
+
+    def __repr__(self):
+        _parsed = ', '.join(f'{_name}={_value!r}'
+                            for _name, _value in self._values.items())
+        return f'<lazy {self._parser.cls.__name__}({_parsed})>'
+
+
+class LazyTelemetry():
+    """
+    A telemetry packet whose data is parsed on first access.
+
+    Has the fields of Telemetry -- time, type, board, string, data and device
+    -- and its methods _asdict, _serialised and _as_JSON.
+
+    """
+    __slots__ = ('time', 'type', 'board', 'raw', 'device', '_string',
+                 '_data')
+    _fields = TELEMETRY_FIELDS
+
+    def __init__(self, time, type, board, raw, device=None):
+        """
+        Parameters
+        ----------
+        time : int
+            The UNIX timestamp (in ms) at which the telemetry was received
+        type : str
+            The telemetry type, e.g. 'T'
+        board : str
+            The board identifier, e.g. 'ADC'
+        raw : bytes or str
+            The telemetry packet as received
+        device
+            Identifier of the EduCube the telemetry was received from
+
+        """
+        self.time = time
+        self.type = type
+        self.board = board
+        self.raw = raw
+        self.device = device
+        self._string = None
+        self._data = None
+
+    @property
+    def string(self):
+        """The telemetry string, decoded on first access."""
+        if self._string is None:
+            _raw = self.raw
+            self._string = (_raw.decode('utf-8') if isinstance(_raw, bytes)
+                            else _raw)
+        return self._string
+
+    @property
+    def data(self):
+        """The board telemetry, a LazyBoardData."""
+        if self._data is None:
+            self._data = LazyBoardData(LAZY_PARSERS[self.board], self.string)
+        return self._data
+
+    def __iter__(self):
+        return (getattr(self, _name) for _name in self._fields)
+
+    def __repr__(self):
+        return (f'LazyTelemetry(time={self.time!r}, board={self.board!r}, '
+                f'raw={self.raw!r}, device={self.device!r})')
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    def _parsed(self):
+        """
+        Parse every field, and return the equivalent Telemetry, or None if
+        the packet cannot be parsed.
+
+        """
+        try:
+            _data = self.data._parsed()
+        except (TelemetryParserException, UnicodeDecodeError):
+            errmsg = f"Could not parse telemetry packet: {self.raw!r}"
+            LOG.exception(errmsg, exc_info=True)
+            return None
+
+        return Telemetry(
+            time   = self.time  ,
+            type   = self.type  ,
+            board  = self.board ,
+            string = self.string,
+            data   = _data      ,
+            device = self.device
+        )
+
+    def _serialised(self, remove_null=False):
+        """Convert to dictionaries, parsing every field."""
+        _serialised = encode_telemetry(self)
+
+        if remove_null:
+            _serialised = remove_value_none(_serialised)
+
+        return _serialised
+
+    def _as_JSON(self, remove_null=False):
+        """Convert to a JSON string."""
+        return dumps(self._serialised(remove_null=remove_null))
+
+
+def parse_educube_telemetry_lazy(timestamp, telemetry, device=None):
+    """
+    Return a LazyTelemetry for a telemetry packet, without parsing its data.
+
+    Only the type and board are read: returns None if the packet has no
+    board telemetry or the board is not recognised. Other errors are only
+    found when the data is read.
+
+    Parameters
+    ----------
+    timestamp : int
+        The UNIX timestamp (in milliseconds) at which the telemetry was
+        received
+    telemetry : bytes or str
+        The telemetry packet, as received or decoded
+    device
+        Identifier of the EduCube the telemetry was received from (optional)
+
+    """
+    _sep = b'|' if isinstance(telemetry, bytes) else '|'
+    _type, _, _rest = telemetry.strip().partition(_sep)
+    _board, _found, _ = _rest.partition(_sep)
+    if not _found:
+        LOG.warning("Empty telemetry")
+        return None
+
+    if isinstance(telemetry, bytes):
+        _type = _type.decode('utf-8', errors='replace')
+        _board = _board.decode('utf-8', errors='replace')
+
+    if _board not in LAZY_PARSERS:
+        LOG.warning("Unrecognised board ID: %s - ignoring packet", _board)
+        return None
+
+    return LazyTelemetry(time   = timestamp,
+                         type   = _type    ,
+                         board  = _board   ,
+                         raw    = telemetry,
+                         device = device    )
@@ -0,0 +1,293 @@
+"""
+_records.py
+
+Compact, typed telemetry records.
+
+Telemetry keeps the values of a packet as strings in a hierarchy of
+namedtuples, together with the whole telemetry string: convenient for the
+web interface, but large for a long history, and every user converts the
+same values to numbers again. A TelemetryRecord instead holds the values of
+one packet as real numbers, packed with a fixed struct layout per board:
+
+    float  'd'   e.g. bus_V, MPU axes, sun sensors, latitude
+    int    'q'   e.g. MAGNO_TORQ signs, GPS_META.ALT_CM, SEPARATION.ID
+    bool   '?'   e.g. HOT_PLUG flags, CHARGING
+    text         CDH only: GPS_DATE and the status names, kept in a tuple
+
+The fields, and their types, are the columns compiled from the board
+schemas (see compile_columns), as for the batch parser: e.g. 'MPU_GYR.X',
+'INA.66.bus_V', read with record['MPU_GYR.X'] or record.get(...). Values
+missing from the packet (e.g., an INA that did not report) are None. The
+telemetry string is only kept if asked for.
+
+Memory per packet on the simulator's telemetry (64-bit CPython 3.11), as
+given by _footprint() for a record without its string, and as the total size
+of the objects of a Telemetry (which always keeps its string), as printed by
+python -m educube.telemetry_parser._bench:
+
+    board   TelemetryRecord   Telemetry
+    ADC       277 bytes       1609 bytes
+    CDH       452 bytes       1297 bytes
+    EPS       470 bytes       5924 bytes
+    EXP       269 bytes       1945 bytes
+
+Keeping the string adds its size, about 120-290 bytes.
+
+"""
+# standard library imports
+import logging
+import math
+import struct
+import sys
+
+# local imports
+from ._batch import COLUMN_PARSERS
+from ._schema import FLOAT, INT, BOOL, TEXT
+
+LOG = logging.getLogger(__name__)
+
+# struct format of each numeric field type
+_FORMATS = {FLOAT: 'd', INT: 'q', BOOL: '?'}
+
+# bitmask of the numeric fields present, followed by their values
+_MASK_FORMAT = 'Q'
+_MAX_NUMERIC_FIELDS = 64
+
+
+class TelemetryRecord():
+    """
+    The typed values of a telemetry packet. There is a subclass per board
+    (see record_class), with the board's layout as class attributes.
+
+    """
+    __slots__ = ('time', 'device', 'string', '_packed', '_text')
+
+    board = None
+    _fields = ()            # field names, in order
+    _types = {}             # field name -> type
+    _struct = None          # struct.Struct of the mask and numeric fields
+    _numeric = {}           # field name -> (bit, struct.Struct, offset)
+    _text_index = {}        # field name -> position in _text
+
+    def __init__(self, time, packed, text=(), device=None, string=None):
+        """
+        Use record_from_values or parse_educube_record to create records.
+
+        Parameters
+        ----------
+        time : int
+            The UNIX timestamp (in ms) at which the telemetry was received
+        packed : bytes
+            The presence mask and numeric values, packed with _struct
+        text : tuple of str
+            The text values
+        device
+            Identifier of the EduCube the telemetry was received from
+        string : str
+            The telemetry string, if kept
+
+        """
+        self.time = time
+        self.device = device
+        self.string = string
+        self._packed = packed
+        self._text = text
+
+    def __getitem__(self, name):
+        _numeric = self._numeric.get(name)
+        if _numeric is not None:
+            _bit, _field_struct, _offset = _numeric
+            if not self._mask() & _bit:
+                return None
+            return _field_struct.unpack_from(self._packed, _offset)[0]
+        try:
+            return self._text[self._text_index[name]]
+        except KeyError:
+            raise KeyError(f'{self.board} records have no field {name!r}') \
+                from None
+
+    def get(self, name, default=None):
+        """Return the value of a field, or default if it is missing."""
+        try:
+            _value = self[name]
+        except KeyError:
+            return default
+        return default if _value is None else _value
+
+    def _mask(self):
+        return struct.unpack_from('<' + _MASK_FORMAT, self._packed)[0]
+
+    def _asdict(self):
+        """Return the values of all fields as a dict of name to value."""
+        _mask, *_numbers = self._struct.unpack(self._packed)
+        _values = dict()
+        _numbers = iter(_numbers)
+        for _name in self._fields:
+            _numeric = self._numeric.get(_name)
+            if _numeric is None:
+                _values[_name] = self._text[self._text_index[_name]]
+            else:
+                _value = next(_numbers)
+                _values[_name] = _value if _mask & _numeric[0] else None
+        return _values
+
+    def __iter__(self):
+        return iter(self._asdict().values())
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        return (type(self) is type(other)
+                and (self.time, self.device, self._packed, self._text) ==
+                    (other.time, other.device, other._packed, other._text))
+
+    def __repr__(self):
+        return (f'{type(self).__name__}(time={self.time!r}, '
+                f'device={self.device!r}, {self._asdict()!r})')
+
+    def _footprint(self):
+        """
+        Return the memory used by the record in bytes: the object, its
+        packed values, text and timestamp, and the string if it was kept.
+        The device, usually shared by many records, is not counted; text
+        values are, even when they are shared lookup table strings.
+
+        """
+        _size = (sys.getsizeof(self) + sys.getsizeof(self._packed)
+                 + sys.getsizeof(self.time))
+        if self._text:
+            _size += sys.getsizeof(self._text)
+            _size += sum(sys.getsizeof(_s) for _s in self._text
+                         if _s is not None)
+        if self.string is not None:
+            _size += sys.getsizeof(self.string)
+        return _size
+
+
+def _build_record_class(board):
+    _columns = COLUMN_PARSERS[board].columns
+    _types = dict(_columns)
+
+    _numeric_names = [_name for _name, _type in _types.items()
+                      if _type != TEXT]
+    if len(_numeric_names) > _MAX_NUMERIC_FIELDS:
+        raise ValueError(f'Too many numeric fields for a {board} record')
+
+    _format = '<' + _MASK_FORMAT + ''.join(_FORMATS[_types[_name]]
+                                           for _name in _numeric_names)
+    _numeric = dict()
+    _offset = struct.calcsize('<' + _MASK_FORMAT)
+    for _bit, _name in enumerate(_numeric_names):
+        _field_struct = struct.Struct('<' + _FORMATS[_types[_name]])
+        _numeric[_name] = (1 << _bit, _field_struct, _offset)
+        _offset += _field_struct.size
+
+    _text_names = [_name for _name, _type in _types.items()
+                   if _type == TEXT]
+
+    return type(f'{board}Record', (TelemetryRecord,), {
+        '__slots__'   : ()                                             ,
+        'board'       : board                                          ,
+        '_fields'     : tuple(_name for _name, _ in _columns)          ,
+        '_types'      : _types                                         ,
+        '_struct'     : struct.Struct(_format)                         ,
+        '_numeric'    : _numeric                                       ,
+        '_text_index' : {_name: i for i, _name in enumerate(_text_names)},
+    })
+
+
+# look up table of the record class of each board
+RECORD_CLASSES = {_board: _build_record_class(_board)
+                  for _board in COLUMN_PARSERS}
+
+
+def record_class(board):
+    """Return the TelemetryRecord subclass of a board."""
+    return RECORD_CLASSES[board]
+
+
+def _convert(value, field_type):
+    if field_type == TEXT:
+        return value or None
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if field_type == INT:
+        if value != int(value):
+            raise ValueError(f'Not an integer: {value!r}')
+        return int(value)
+    if field_type == BOOL:
+        if value not in (0, 1):
+            raise ValueError(f'Not a boolean: {value!r}')
+        return bool(value)
+    return float(value)
+
+
+def record_from_values(board, timestamp, values, device=None, string=None):
+    """
+    Return the record of a board from the values of its fields, in the
+    order of its fields (e.g., a row of the batch parser). Missing values
+    are None, or NaN. Raises ValueError (or struct.error) for values that do
+    not fit their field's type, e.g. 2 in a bool field.
+
+    """
+    _cls = RECORD_CLASSES[board]
+    _types = _cls._types
+    _mask = 0
+    _numbers = []
+    _text = []
+    for _name, _value in zip(_cls._fields, values):
+        _type = _types[_name]
+        _value = _convert(_value, _type)
+        if _type == TEXT:
+            _text.append(_value)
+            continue
+        if _value is None:
+            _value = False if _type == BOOL else 0
+        else:
+            _mask |= _cls._numeric[_name][0]
+        _numbers.append(_value)
+
+    return _cls(time   = timestamp                       ,
+                packed = _cls._struct.pack(_mask, *_numbers),
+                text   = tuple(_text)                    ,
+                device = device                          ,
+                string = string                           )
+
+
+def parse_educube_record(timestamp, telemetry_str, device=None,
+                         keep_string=False):
+    """
+    Parse a telemetry string into a TelemetryRecord.
+
+    Parameters
+    ----------
+    timestamp : int
+        The UNIX timestamp (in milliseconds) at which the telemetry was
+        received
+    telemetry_str : str
+        The telemetry string, e.g. 'T|ADC|SOL,...'
+    device
+        Identifier of the EduCube the telemetry was received from (optional)
+    keep_string : bool
+        Keep the telemetry string in the record
+
+    Returns None if the telemetry cannot be parsed.
+
+    """
+    _type, _, _rest = telemetry_str.strip().partition('|')
+    _board, _, _chips = _rest.partition('|')
+    if _type != 'T' or not _chips or _board not in RECORD_CLASSES:
+        LOG.warning("Not board telemetry: %r", telemetry_str)
+        return None
+
+    try:
+        _values = COLUMN_PARSERS[_board].row(_chips.split('|'))
+        return record_from_values(
+            _board, timestamp, _values, device=device,
+            string=telemetry_str if keep_string else None
+        )
+    except Exception:
+        errmsg = f"Could not parse telemetry packet: {telemetry_str}"
+        LOG.exception(errmsg, exc_info=True)
+        return None
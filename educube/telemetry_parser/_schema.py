@@ -0,0 +1,610 @@
+"""
+_schema.py
+
+Declarative board telemetry schemas, compiled into specialised parsers.
+
+A board's telemetry is a sequence of chip parts, "ID,value,value,...",
+separated by '|'. A BoardSchema writes down the layout of these parts once:
+
+    chips   the chip parts in the order the firmware sends them: Chip (one
+            part), Repeat (any number of consecutive parts of the same kind)
+    output  an expression building the parsed telemetry from the values of
+            the chips: Field, Fields, Struct, Apply, Lookup, ForEach, Const
+
+compile_schema turns a schema into Python source for a parse function and
+compiles it once, at import time. The generated function splits each part
+once, checks the chip ids and numbers of values in place, and builds the
+output directly from the split parts. For example,
+
+    BoardSchema(
+        board  = 'XYZ',
+        chips  = (Chip('ACC', 3), Chip('TMP', 1, optional=True)),
+        output = Struct(XYZTelemetry,
+                        Struct(Acc, Field('ACC', 0), Field('ACC', 1),
+                               Field('ACC', 2)),
+                        Field('TMP', 0, convert=float))
+    )
+
+compiles to (roughly)
+
+    def parse_XYZ(chips):
+        if not 1 <= len(chips) <= 2:
+            return fallback(chips)
+        c0 = chips[0].split(',')
+        if c0[0] != 'ACC' or len(c0) != 4:
+            return fallback(chips)
+        c1 = chips[1].split(',') if len(chips) > 1 else None
+        if c1 is not None and (c1[0] != 'TMP' or len(c1) != 2):
+            return fallback(chips)
+        return XYZTelemetry(Acc(c0[1], c0[2], c0[3]),
+                            float(c1[1]) if c1 is not None else None)
+
+Packets that do not follow the declared layout (e.g., with chips reordered
+or corrupted in transmission) are passed to the schema's fallback parser,
+which is expected to be more tolerant, or rejected with a ValueError if it
+has none. Time to parse a packet of the simulator (CPython 3.11), as printed
+by python -m educube.telemetry_parser._bench:
+
+    board   fallback   compiled
+    ADC       13 us       6 us
+    CDH       22 us       6 us
+    EPS       47 us      20 us
+    EXP       16 us       9 us
+
+compile_lazy_schema compiles the same schema in pieces, for LazyTelemetry: a
+function checking the layout and returning the split parts, and one function
+per field of the output building that field alone from the split parts.
+
+compile_columns compiles the schema into flat columns, for the batch parser
+and TelemetryRecord. Each Field, Apply and Lookup of the output is a column,
+named by its path in the output (e.g., 'MPU_GYR.X'), with the type given in
+the expression: FLOAT (the default of Field and Apply), INT, BOOL or TEXT
+(the default of Lookup), or NO_COLUMN to leave it out. Fields gives columns
+to its first values, and ForEach to the items of the keys it is given (e.g.,
+'INA.66.bus_V'). Packets that do not follow the layout are parsed by the
+fallback parser, and the columns read from its output.
+
+"""
+# standard library imports
+import itertools
+import logging
+import math
+
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# marks a Chip with any number of values, or a Lookup without a default
+ANY = None
+REQUIRED = object()
+
+# column types of the output expressions
+FLOAT = 'float'
+INT = 'int'
+BOOL = 'bool'
+TEXT = 'text'
+NO_COLUMN = None
+
+
+# ****************************************************************************
+# schema
+# ****************************************************************************
+class Chip(namedtuple('Chip', ('id', 'nvalues', 'key', 'name', 'optional'),
+                      defaults=(ANY, None, False))):
+    """
+    One chip part, "id,value,...".
+
+    nvalues is the number of values after the id, or ANY. key, if given, is
+    the required first value (e.g., 'ACC' in "MPU,ACC,x,y,z"); it counts as
+    one of the values. name is how Field refers to the chip (default: the id,
+    followed by the key if there is one). Optional chips may only be
+    followed by other optional chips; when missing, their Fields are None.
+
+    """
+    @property
+    def ref(self):
+        if self.name is not None:
+            return self.name
+        return self.id if self.key is None else f'{self.id}_{self.key}'
+
+
+class Repeat(namedtuple('Repeat', ('chip', 'distinct'), defaults=(None,))):
+    """
+    Any number of consecutive chips like chip. distinct, if given, is the
+    index of a value that must differ between them (e.g., an address).
+
+    """
+    @property
+    def ref(self):
+        return self.chip.ref
+
+
+class BoardSchema(namedtuple('BoardSchema',
+                             ('board', 'chips', 'output', 'fallback'),
+                             defaults=(None,))):
+    """The layout of a board's telemetry (see the module docstring)."""
+
+
+# output expressions
+class Field(namedtuple('Field', ('chip', 'index', 'convert', 'type'),
+                       defaults=(None, FLOAT))):
+    """
+    The index'th value of a chip, optionally passed to convert. type is
+    that of its column (see compile_columns).
+
+    """
+
+
+class Fields(namedtuple('Fields', ('chip', 'start', 'columns', 'type'),
+                        defaults=(0, 0, FLOAT))):
+    """
+    The values of a chip from start on, as a list. The first columns values
+    are columns of the given type, named by their position.
+
+    """
+
+
+class Struct(namedtuple('Struct', ('cls', 'args'))):
+    """cls(*args), e.g. a namedtuple."""
+    def __new__(cls, struct_cls, *args):
+        return super().__new__(cls, struct_cls, args)
+
+
+class Apply(namedtuple('Apply', ('function', 'args', 'type'))):
+    """function(*args), a column of the given type."""
+    def __new__(cls, function, *args, type=FLOAT):
+        return super().__new__(cls, function, args, type)
+
+
+class Lookup(namedtuple('Lookup', ('table', 'arg', 'default', 'type'),
+                        defaults=(REQUIRED, TEXT))):
+    """
+    table[arg], or table.get(arg, default) if a default is given; a column
+    of the given type.
+
+    """
+
+
+class ForEach(namedtuple('ForEach', ('chip', 'item', 'key', 'keys'),
+                         defaults=(None, ()))):
+    """
+    A list of item, evaluated for each chip of a Repeat. item may have
+    columns for each of keys, the values of its field key (e.g., the known
+    addresses of a chip); other keys are an error.
+
+    """
+
+
+class Const(namedtuple('Const', ('value',))):
+    """A constant value."""
+
+
+# ****************************************************************************
+# compiler
+# ****************************************************************************
+class _Compiler():
+    """Generates the source of a schema's parse function."""
+    def __init__(self, schema):
+        self.schema = schema
+        self.namespace = dict()
+        self._names = dict()
+        self._counter = itertools.count()
+        self.lines = []
+
+        self.chips = dict()         # ref -> (variable, chip, optional)
+        self.repeat = None          # (ref, chip) of the Repeat
+
+        # statement run when a packet does not follow the layout
+        self.fail = 'return fallback(chips)'
+
+    def constant(self, value):
+        """Return the name under which value is available to the source."""
+        _key = id(value)
+        if _key not in self._names:
+            _name = getattr(value, '__name__', 'const').lstrip('_')
+            _name = f'_{_name}_{next(self._counter)}'
+            self._names[_key] = _name
+            self.namespace[_name] = value
+        return self._names[_key]
+
+    def emit(self, line, indent=1):
+        self.lines.append('    ' * indent + line)
+
+    # ******************************
+    # layout checks
+    # ******************************
+    def _check(self, var, chip):
+        """Return the condition that split part var matches chip."""
+        _conditions = [f'{var}[0] != {chip.id!r}']
+        if chip.nvalues is not ANY:
+            _conditions.append(f'len({var}) != {chip.nvalues + 1}')
+        elif chip.key is not None:
+            _conditions.append(f'len({var}) < 2')
+        if chip.key is not None:
+            _conditions.append(f'{var}[1] != {chip.key!r}')
+        return ' or '.join(_conditions)
+
+    def layout(self):
+        _chips = self.schema.chips
+        _repeats = [i for i, c in enumerate(_chips) if isinstance(c, Repeat)]
+        _optional = [i for i, c in enumerate(_chips)
+                     if isinstance(c, Chip) and c.optional]
+
+        if len(_repeats) > 1 or (_repeats and _optional):
+            raise ValueError('A schema may have one Repeat, or optional '
+                             'chips, but not both')
+        if _optional and _optional != list(range(_optional[0],
+                                                 len(_chips))):
+            raise ValueError('Only the last chips may be optional')
+
+        if _repeats:
+            self._layout_repeat(_repeats[0])
+        else:
+            self._layout_fixed(len(_chips) - len(_optional))
+
+    def _layout_fixed(self, n_required):
+        _chips = self.schema.chips
+        self.emit('n = len(chips)')
+        self.emit(f'if not {n_required} <= n <= {len(_chips)}:')
+        self.emit(self.fail, 2)
+
+        for i, chip in enumerate(_chips):
+            _var = f'c{i}'
+            self.chips[chip.ref] = (_var, chip, chip.optional)
+            if chip.optional:
+                self.emit(f"{_var} = chips[{i}].split(',') if n > {i} "
+                          f"else None")
+                self.emit(f'if {_var} is not None and '
+                          f'({self._check(_var, chip)}):')
+            else:
+                self.emit(f"{_var} = chips[{i}].split(',')")
+                self.emit(f'if {self._check(_var, chip)}:')
+            self.emit(self.fail, 2)
+
+    def _layout_repeat(self, position):
+        _chips = self.schema.chips
+        _before = _chips[:position]
+        _after = _chips[position + 1:]
+        _repeat = _chips[position]
+
+        self.emit('n = len(chips)')
+        self.emit(f'n_repeat = n - {len(_before) + len(_after)}')
+        self.emit('if n_repeat < 0:')
+        self.emit(self.fail, 2)
+
+        for i, chip in enumerate(_before):
+            self._emit_fixed(f'b{i}', f'{i}', chip)
+
+        # the repeated chips
+        _ref = _repeat.ref
+        self.repeat = (_ref, _repeat.chip)
+        _start = len(_before)
+        _end = 'n_repeat' if not _start else f'{_start} + n_repeat'
+        self.emit(f"r = [c.split(',') for c in chips[{_start}:{_end}]]")
+        self.emit('for c in r:')
+        self.emit(f'if {self._check("c", _repeat.chip)}:', 2)
+        self.emit(self.fail, 3)
+        if _repeat.distinct is not None:
+            _index = _repeat.distinct + 1
+            self.emit(f'if len({{c[{_index}] for c in r}}) != n_repeat:')
+            self.emit(self.fail, 2)
+
+        for i, chip in enumerate(_after):
+            self._emit_fixed(f'a{i}', f'{_end} + {i}', chip)
+
+    def _emit_fixed(self, var, index, chip):
+        self.chips[chip.ref] = (var, chip, False)
+        self.emit(f"{var} = chips[{index}].split(',')")
+        self.emit(f'if {self._check(var, chip)}:')
+        self.emit(self.fail, 2)
+
+    # ******************************
+    # output
+    # ******************************
+    def expression(self, node, item=None):
+        """Return the source of an output expression."""
+        if isinstance(node, Field):
+            _var, _optional = self._chip_var(node.chip, item)
+            _source = f'{_var}[{node.index + 1}]'
+            if node.convert is not None:
+                _source = f'{self.constant(node.convert)}({_source})'
+            if _optional:
+                _source = f'({_source} if {_var} is not None else None)'
+            return _source
+
+        if isinstance(node, Fields):
+            _var, _optional = self._chip_var(node.chip, item)
+            _source = f'{_var}[{node.start + 1}:]'
+            if _optional:
+                _source = f'({_source} if {_var} is not None else None)'
+            return _source
+
+        if isinstance(node, (Struct, Apply)):
+            _callable = node.cls if isinstance(node, Struct) else node.function
+            _args = ', '.join(self.expression(a, item) for a in node.args)
+            return f'{self.constant(_callable)}({_args})'
+
+        if isinstance(node, Lookup):
+            _table = self.constant(node.table)
+            _arg = self.expression(node.arg, item)
+            if node.default is REQUIRED:
+                return f'{_table}[{_arg}]'
+            return f'{_table}.get({_arg}, {self.constant(node.default)})'
+
+        if isinstance(node, ForEach):
+            if self.repeat is None or self.repeat[0] != node.chip:
+                raise ValueError(f'ForEach of unknown Repeat {node.chip!r}')
+            _item = self.expression(node.item, item=node.chip)
+            return f'[{_item} for c in r]'
+
+        if isinstance(node, Const):
+            return self.constant(node.value)
+
+        raise TypeError(f'Unknown schema expression {node!r}')
+
+    def _chip_var(self, ref, item):
+        if ref == item:
+            return 'c', False
+        try:
+            _var, _, _optional = self.chips[ref]
+        except KeyError:
+            raise ValueError(f'Unknown chip {ref!r}') from None
+        return _var, _optional
+
+    def source(self):
+        self.layout()
+        self.emit(f'return {self.expression(self.schema.output)}')
+        _name = f'parse_{self.schema.board}'
+        return '\n'.join([f'def {_name}(chips):'] + self.lines) + '\n'
+
+    def lazy_source(self):
+        """
+        Return the source of a split function, which checks the layout and
+        returns the split chip parts (or None), and of one function per
+        field of the output, which builds the field from the split parts.
+
+        """
+        _output = self.schema.output
+        if not (isinstance(_output, Struct)
+                and len(getattr(_output.cls, '_fields', ())) ==
+                    len(_output.args)):
+            raise ValueError('Lazy parsing needs a namedtuple output')
+
+        self.fail = 'return None'
+        self.layout()
+        _vars = [_var for _var, _, _ in self.chips.values()]
+        if self.repeat is not None:
+            _vars.append('r')
+        _unpack = ', '.join(_vars) + ','
+        self.emit(f'return ({_unpack})')
+
+        _board = self.schema.board
+        _functions = ['\n'.join([f'def split_{_board}(chips):']
+                                 + self.lines)]
+        for i, _arg in enumerate(_output.args):
+            _functions.append(
+                f'def field_{_board}_{i}(v):\n'
+                f'    {_unpack} = v\n'
+                f'    return {self.expression(_arg)}'
+            )
+        return '\n\n'.join(_functions) + '\n'
+
+
+    # ******************************
+    # columns
+    # ******************************
+    def columns(self, node, path, access, output, item=None, guards=None):
+        """
+        Yield the columns of an output expression, as (name, type, source,
+        plain, output source): the source of the value from the split parts
+        (plain if it is a value of a required chip, never None), and from
+        the parsed output, whose source is access. Statements they need are
+        appended to self.lines and output. guards, if given, are the
+        variables of each source that make the value None when they are.
+
+        """
+        if isinstance(node, Struct):
+            _fields = getattr(node.cls, '_fields', None)
+            if _fields is None or len(_fields) != len(node.args):
+                raise ValueError('Columns need namedtuple outputs')
+            for i, (_name, _arg) in enumerate(zip(_fields, node.args)):
+                yield from self.columns(_arg, path + (_name,),
+                                        f'{access}[{i}]', output, item,
+                                        guards)
+
+        elif isinstance(node, Fields):
+            _item = self.constant(_value_at)
+            for i in range(node.columns):
+                yield self._column(
+                    path + (str(i),), node.type,
+                    f'{_item}({self.expression(node, item)}, {i})', False,
+                    f'{_item}({access}, {i})', guards
+                )
+
+        elif isinstance(node, ForEach):
+            yield from self._foreach_columns(node, path, access, output)
+
+        elif isinstance(node, (Field, Apply, Lookup)):
+            if node.type is NO_COLUMN:
+                return
+            _plain = False
+            if isinstance(node, Field) and node.convert is None:
+                _plain = not self._chip_var(node.chip, item)[1]
+            yield self._column(path, node.type, self.expression(node, item),
+                               _plain, access, guards)
+
+    def _column(self, path, column_type, source, plain, access, guards):
+        if guards is not None:
+            _guard, _output_guard = guards
+            source = f'({source} if {_guard} is not None else None)'
+            access = f'({access} if {_output_guard} is not None else None)'
+            plain = False
+        return ('.'.join(path), column_type, source, plain, access)
+
+    def _foreach_columns(self, node, path, access, output):
+        if not node.keys:
+            return
+        if self.repeat is None or self.repeat[0] != node.chip:
+            raise ValueError(f'ForEach of unknown Repeat {node.chip!r}')
+        if not isinstance(node.item, Struct):
+            raise ValueError('Keyed ForEach needs a Struct item')
+
+        # the items by key, from the split parts and from the output
+        _n = next(self._counter)
+        _key = node.item.cls._fields.index(node.key)
+        _keys = self.constant(frozenset(node.keys))
+        _error = f'raise KeyError({f"Unknown {node.chip} key"!r})'
+        _key_source = self.expression(node.item.args[_key], item=node.chip)
+        self.emit(f'k{_n} = {{{_key_source}: c for c in r}}')
+        self.emit(f'if not k{_n}.keys() <= {_keys}:')
+        self.emit(_error, 2)
+        output.append(f'    o{_n} = {{x[{_key}]: x for x in {access}}}')
+        output.append(f'    if not o{_n}.keys() <= {_keys}:')
+        output.append(f'        {_error}')
+
+        for i, _value in enumerate(node.keys):
+            _var = f'k{_n}_{i}'
+            _output_var = f'o{_n}_{i}'
+            self.emit(f'{_var} = k{_n}.get({_value!r})')
+            output.append(f'    {_output_var} = o{_n}.get({_value!r})')
+
+            # the fields of the item refer to the chip of this key
+            self.chips[node.chip] = (_var, self.repeat[1], False)
+            try:
+                yield from self.columns(node.item, path + (str(_value),),
+                                        _output_var, output,
+                                        guards=(_var, _output_var))
+            finally:
+                del self.chips[node.chip]
+
+    def columns_source(self):
+        """
+        Return the columns, as (name, type), and the source of a row
+        function, which returns the values of the columns of a packet, and of
+        the function returning them from a parsed output.
+
+        """
+        _output = []
+        self.layout()
+        _columns = list(self.columns(self.schema.output, (), 't', _output))
+
+        _num = self.constant(_number)
+        _row, _output_row = [], []
+        for _, _type, _source, _plain, _access in _columns:
+            if _type == TEXT:
+                _row.append(f'({_source} or \'\')')
+                _output_row.append(f'({_access} or \'\')')
+            else:
+                _row.append(f'float({_source})' if _plain
+                            else f'{_num}({_source})')
+                _output_row.append(f'{_num}({_access})')
+
+        _board = self.schema.board
+        self.emit(f'return ({", ".join(_row)},)')
+        _source = '\n\n'.join([
+            '\n'.join([f'def row_{_board}(chips):'] + self.lines),
+            '\n'.join([f'def output_row_{_board}(t):'] + _output
+                      + [f'    return ({", ".join(_output_row)},)']),
+            f'def fallback(chips):\n'
+            f'    return output_row_{_board}(parse_fallback(chips))',
+        ]) + '\n'
+        return tuple((_name, _type) for _name, _type, *_ in _columns), _source
+
+
+def _number(value):
+    """Return a column value as a float, NaN if it is missing."""
+    return math.nan if value is None else float(value)
+
+
+def _value_at(values, index):
+    """Return values[index], or None if values is missing or too short."""
+    if values is None or len(values) <= index:
+        return None
+    return values[index]
+
+
+def _reject(board):
+    def reject(chips):
+        raise ValueError(f'{board} telemetry does not follow its schema')
+    return reject
+
+
+def compile_schema(schema):
+    """
+    Return the parse function of a BoardSchema. It takes the chip parts of
+    a packet (the telemetry string split on '|', after the type and board).
+
+    """
+    _compiler = _Compiler(schema)
+    _source = _compiler.source()
+    logger.debug(f'Compiled {schema.board} schema:\n{_source}')
+
+    _namespace = dict(_compiler.namespace)
+    _namespace['fallback'] = schema.fallback or _reject(schema.board)
+    exec(compile(_source, f'<{schema.board} schema>', 'exec'), _namespace)
+
+    _function = _namespace[f'parse_{schema.board}']
+    _function.source = _source
+    return _function
+
+
+# the parts of a schema compiled for lazy parsing: split(chips) returns the
+# split chip parts, or None if the packet does not follow the layout, and
+# extractors[name](split) returns the named field of the output
+LazyParser = namedtuple(
+    'LazyParser',
+    ('board', 'cls', 'split', 'extractors', 'fallback', 'source')
+)
+
+
+def compile_lazy_schema(schema):
+    """
+    Return a LazyParser for a BoardSchema whose output is a namedtuple, so
+    that each field of the output can be parsed on its own.
+
+    """
+    _compiler = _Compiler(schema)
+    _source = _compiler.lazy_source()
+    logger.debug('Compiled lazy %s schema:\n%s', schema.board, _source)
+
+    _namespace = dict(_compiler.namespace)
+    exec(compile(_source, f'<lazy {schema.board} schema>', 'exec'),
+         _namespace)
+
+    _cls = schema.output.cls
+    return LazyParser(
+        board      = schema.board                                  ,
+        cls        = _cls                                          ,
+        split      = _namespace[f'split_{schema.board}']           ,
+        extractors = {_name: _namespace[f'field_{schema.board}_{i}']
+                      for i, _name in enumerate(_cls._fields)}     ,
+        fallback   = schema.fallback or _reject(schema.board)      ,
+        source     = _source                                       ,
+    )
+
+
+# a schema compiled into columns: columns gives the (name, type) of each
+# column, and row(chips) returns the values of the columns of a packet
+# (floats, NaN if missing, and strings, '' if missing)
+ColumnParser = namedtuple('ColumnParser',
+                          ('board', 'columns', 'row', 'source'))
+
+
+def compile_columns(schema):
+    """
+    Return a ColumnParser for a BoardSchema whose output is a namedtuple.
+    The row function raises an exception if the packet cannot be parsed.
+
+    """
+    _compiler = _Compiler(schema)
+    _columns, _source = _compiler.columns_source()
+    logger.debug('Compiled %s columns:\n%s', schema.board, _source)
+
+    _namespace = dict(_compiler.namespace)
+    _namespace['parse_fallback'] = schema.fallback or _reject(schema.board)
+    exec(compile(_source, f'<{schema.board} columns>', 'exec'), _namespace)
+
+    return ColumnParser(board   = schema.board                       ,
+                        columns = _columns                           ,
+                        row     = _namespace[f'row_{schema.board}']  ,
+                        source  = _source                            )
@@ -10,30 +10,34 @@ objects.
 
 # standard library imports
 from collections import namedtuple
-import json
 import logging
 
 # local imports
-from ._adc_parser import _parse_adc_telem
-from ._cdh_parser import _parse_cdh_telem
-from ._eps_parser import _parse_eps_telem
-from ._exp_parser import _parse_exp_telem
-from ._util import serialise, remove_value_none
+from ._adc_parser import ADC_SCHEMA
+from ._cdh_parser import CDH_SCHEMA
+from ._eps_parser import EPS_SCHEMA
+from ._exp_parser import EXP_SCHEMA
+from ._schema import compile_schema
+from ._encode import encode_telemetry, dumps
+from ._util import remove_value_none
 
 # set up logging
 LOG = logging.getLogger(__name__)
 
-# look up table for board parser functions
+# the declared telemetry layout of each board (see _schema.py), from which
+# the parsers, lazy parsers and batch columns are compiled. A schema's
+# fallback parser, which handles packets that do not follow the layout, is
+# written by hand.
+BOARD_SCHEMAS = (ADC_SCHEMA, CDH_SCHEMA, EPS_SCHEMA, EXP_SCHEMA)
+
+# look up table for board parser functions, compiled from the schemas
 BOARD_PARSERS = {
-        "ADC" : _parse_adc_telem,
-        "CDH" : _parse_cdh_telem,
-        "EPS" : _parse_eps_telem,
-        "EXP" : _parse_exp_telem,
+        schema.board : compile_schema(schema) for schema in BOARD_SCHEMAS
     }
 
-TELEMETRY_FIELDS = ('time', 'type', 'board', 'string', 'data')
+TELEMETRY_FIELDS = ('time', 'type', 'board', 'string', 'data', 'device')
 
-class Telemetry(namedtuple('Telemetry', TELEMETRY_FIELDS)):
+class Telemetry(namedtuple('Telemetry', TELEMETRY_FIELDS, defaults=(None,))):
     """Container for information about a Telemetry packet
 
     Extends namedtuple with methods to simplify conversion to JSON. 
@@ -46,7 +50,7 @@ class Telemetry(namedtuple('Telemetry', TELEMETRY_FIELDS)):
 
     def _serialised(self, remove_null=False):
         """Convert all namedtuple attributes to dictionaries."""
-        _serialised = serialise(self)
+        _serialised = encode_telemetry(self)
         
         if remove_null:
             _serialised = remove_value_none(_serialised)
@@ -55,14 +59,14 @@ class Telemetry(namedtuple('Telemetry', TELEMETRY_FIELDS)):
         
     def _as_JSON(self, remove_null=False):
         """Convert to a JSON string."""
-        return json.dumps(self._serialise(remove_null=remove_null))
+        return dumps(self._serialised(remove_null=remove_null))
 
 
 class TelemetryParserException(Exception):
     """An exception to be thrown if trying to handle Bad Telemetry."""
 
 
-def parse_educube_telemetry(timestamp, telemetry_str):
+def parse_educube_telemetry(timestamp, telemetry_str, device=None):
     """Extract EduCube telemetry from a telemetry string.
     
     Returns a Telemetry object, which is a hierarchy of namedtuples,
@@ -77,10 +81,13 @@ def parse_educube_telemetry(timestamp, telemetry_str):
 
     telemetry_str
         the board telemetry as a (unicode) string
+
+    device
+        identifier of the EduCube the telemetry was received from (optional)
     
     """
 
-    LOG.info(f"Parsing telemetry str: {telemetry_str!r}")
+    LOG.info("Parsing telemetry str: %r", telemetry_str)
 
     # separate telemetry parts and check for empty telemetry
     _telem_parts = telemetry_str.strip().split("|")
@@ -116,9 +123,10 @@ def parse_educube_telemetry(timestamp, telemetry_str):
         type   = _telem_type      ,
         board  = _telem_board     ,
         string = telemetry_str    ,
-        data   = _parsed_telemetry
+        data   = _parsed_telemetry,
+        device = device
     )
-    LOG.debug(f'Parsed telemetry: {telemetry_tuple!r}')
+    LOG.debug("Parsed telemetry: %r", telemetry_tuple)
     return telemetry_tuple
 
 
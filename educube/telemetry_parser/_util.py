@@ -45,3 +45,7 @@ def remove_value_none(d):
         elif val is not None:
             _dict[key] = val
     return _dict
+
+def ina_power(bus_V, current_mA):
+    """Power of an INA chip, in mW, as a string with two decimals."""
+    return '{:.2f}'.format(float(bus_V) * float(current_mA))
@@ -0,0 +1,770 @@
+"""
+educube/web/_broadcast.py
+
+Sends the telemetry received from the EduCube to the web interface.
+
+There is one TelemetryBroadcaster per web application. It registers as a
+telemetry listener of the connection, which calls it (from whichever thread
+receives the telemetry) when new packets are buffered. The broadcaster then
+schedules itself on the IOLoop with add_callback, drains the buffer once,
+and writes each packet to every open WebSocket. Wake-ups that arrive before
+the scheduled callback has run are merged into it, so a burst of packets
+costs one callback.
+
+Clients may subscribe to only some boards, and to only some fields of their
+telemetry (e.g., the web interface wants the data of the board it shows, but
+only the time of the others, for their status indicators). Packets are
+parsed lazily, and encoded once per distinct set of fields subscribed to, so
+clients with the same subscription share the work, and fields that no client
+subscribed to are never parsed. Clients that have not subscribed are sent
+every board, with every field but the telemetry string (DEFAULT_FIELDS).
+
+Each WebSocket has a ClientQueue, which only writes to the socket once the
+previous writes have been flushed to the network, so a slow client (e.g., on
+bad Wi-Fi) cannot make Tornado buffer unbounded output. Messages wait in the
+queue meanwhile. When the queue is over its limit (of messages or bytes),
+it is conflated: only the newest telemetry of each board is kept, so a slow
+client sees fewer updates, but current ones, while the serial connection and
+the other clients are unaffected. Each queue counts its sent and dropped
+messages and its lag.
+
+The broadcaster also keeps the latest packet of each board of each EduCube
+that can be parsed (a corrupted packet does not replace it). A newly opened
+WebSocket is sent this snapshot in a single 'snapshot' message, whose
+content is the list of packets, so the web interface shows every board at
+once rather than after its next packet. A client that subscribes is sent a
+snapshot of the boards it subscribed to, unless it asks not to be.
+
+Every telemetry message carries a sequence number, seq, which increases by
+one with each message broadcast, and the broadcaster keeps the latest
+messages in a bounded replay window. The snapshot carries the seq of the
+last message and the stream, an identifier of this broadcaster (which
+changes when the server restarts). A client that reconnects after losing
+its WebSocket may ask to resume its stream after the last seq it received:
+it is then sent the messages it missed from the replay window, or, if they
+are no longer all in the window, a new snapshot. Clients can also tell from
+the seq when messages were dropped (e.g., conflated by their queue, or of
+boards they did not subscribe to). A client may give its subscriptions when
+its WebSocket is opened, so that its snapshot, or the messages replayed to
+it, are of the boards and fields it subscribed to, and it need not subscribe
+again (which would send it another snapshot). Once no client has been
+connected for RESUME_TIMEOUT_S, telemetry is counted but no longer kept for
+replay.
+
+Most fields barely change from one packet to the next, so clients may ask
+for delta mode. A packet is then sent as a 'telemetry_delta' message, whose
+content holds only the values that changed since the previous packet of its
+board (see encode_delta) and whose base is the seq of that packet, if the
+client was sent it. Every DEFAULT_KEYFRAME_INTERVAL packets of a board, and
+whenever the client may not have the base (e.g., after a snapshot, or when
+conflation dropped it), the full 'telemetry' message is sent instead. Deltas
+are computed once per distinct set of fields, like full messages.
+
+Clients may also ask for binary telemetry: each packet is then sent as a
+binary frame holding only its values, in the order of a schema that the
+client is sent (as a 'binary_schema' message) before the first frame that
+uses it (see educube.telemetry_parser._binary). Frames are packed once per
+distinct set of fields, and are sent instead of deltas. Telemetry that
+cannot be packed, snapshots and replayed messages are sent as JSON.
+
+"""
+# standard library imports
+import logging
+import threading
+import time
+import uuid
+
+from collections import deque, namedtuple
+from itertools import islice
+
+# third party imports
+import tornado.ioloop
+import tornado.websocket
+
+# local imports
+from educube.telemetry_parser import (BinaryEncodingError,
+                                      BinaryTelemetryEncoder, dumps,
+                                      encode_delta, encode_projection,
+                                      json_message)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_MESSAGES = 256
+DEFAULT_QUEUE_BYTES = 1024 * 1024
+
+# number of telemetry messages kept for resuming clients
+DEFAULT_REPLAY_WINDOW = 2048
+
+# time after the last client disconnects during which the telemetry is still
+# encoded into the replay window, for it to resume
+RESUME_TIMEOUT_S = 120
+
+# the fields of the telemetry sent to clients that have not subscribed: all
+# but the telemetry string, which the web interface does not use
+DEFAULT_FIELDS = ('board', 'data', 'device', 'time', 'type')
+
+# subscribes to every board
+ALL_BOARDS = '*'
+
+# number of deltas of a board sent to a client between full messages
+DEFAULT_KEYFRAME_INTERVAL = 20
+
+# queued : messages waiting to be written
+# sent, dropped : messages written, or conflated away
+# lag_ms : time from queueing to flushing of the last messages written
+# max_lag_ms : the largest lag_ms so far
+ClientStats = namedtuple(
+    'ClientStats',
+    ('queued', 'queued_bytes', 'sent', 'dropped', 'lag_ms', 'max_lag_ms')
+)
+
+
+# ****************************************************************************
+# per-client send queue
+# ****************************************************************************
+class ClientQueue():
+    """Bounded queue of the messages waiting to be sent to one WebSocket."""
+    def __init__(self, socket, ioloop, max_messages=DEFAULT_QUEUE_MESSAGES,
+                 max_bytes=DEFAULT_QUEUE_BYTES):
+        """
+        Parameters
+        ----------
+        socket : tornado.websocket.WebSocketHandler
+            The WebSocket to write to
+        ioloop : tornado.ioloop.IOLoop
+            The IOLoop of the web server
+        max_messages, max_bytes : int
+            Queue sizes above which the queue is conflated
+
+        """
+        self.socket = socket
+        self.ioloop = ioloop
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+        self._queue = deque()       # (key, message, time queued, keyframe)
+        self._bytes = 0
+        self._flushing = False      # True while writes are not yet flushed
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.lag_ms = 0.0
+        self.max_lag_ms = 0.0
+
+        # board (or ALL_BOARDS) -> the fields of its telemetry that are sent,
+        # or None if it is not sent
+        self.subscriptions = {ALL_BOARDS: DEFAULT_FIELDS}
+
+        # whether telemetry may be sent as deltas, and, for each (device,
+        # board), the fields and seq of the last packet sent and the number
+        # of deltas sent since its last full message
+        self.delta = False
+        self.keyframe_interval = DEFAULT_KEYFRAME_INTERVAL
+        self.last_sent = dict()
+
+        # whether telemetry is sent as binary frames, and the ids of the
+        # binary schemas sent
+        self.binary = False
+        self.schemas_sent = set()
+
+    def fields_of(self, board):
+        """Return the fields sent of a board's telemetry, or None."""
+        _subscriptions = self.subscriptions
+        return _subscriptions.get(board, _subscriptions.get(ALL_BOARDS))
+
+    def can_delta(self, key, fields, base):
+        """
+        Return True if a packet may be sent as a delta from the packet base
+        (the previous one of its board): the client was last sent base, with
+        the same fields, and is not due a full message.
+
+        """
+        _last = self.last_sent.get(key)
+        return (self.delta and _last is not None
+                and _last[:2] == (fields, base)
+                and _last[2] < self.keyframe_interval)
+
+    def record_sent(self, key, fields, seq, delta=False):
+        """Record the packet sent last of a board, for can_delta."""
+        _deltas = self.last_sent[key][2] + 1 if delta else 0
+        self.last_sent[key] = (fields, seq, _deltas)
+
+    def put(self, message, key=None, keyframe=None):
+        """
+        Queue a message, and write it if the socket is not still flushing.
+
+        Messages with the same key (e.g., the telemetry of one board) may be
+        conflated: when the queue is over its limits, only the newest of
+        them is kept. Messages with no key are never dropped. A delta, which
+        needs the message before it, is given with keyframe, the equivalent
+        full message, which is sent instead if older messages are dropped.
+
+        """
+        if self.closed:
+            return
+        self._queue.append((key, message, time.monotonic(), keyframe))
+        self._bytes += len(message)
+
+        if self._flushing:
+            if (len(self._queue) > self.max_messages
+                    or self._bytes > self.max_bytes):
+                self._conflate()
+        else:
+            self._write_queued()
+
+    def stats(self):
+        return ClientStats(queued       = len(self._queue),
+                           queued_bytes = self._bytes     ,
+                           sent         = self.sent       ,
+                           dropped      = self.dropped    ,
+                           lag_ms       = self.lag_ms     ,
+                           max_lag_ms   = self.max_lag_ms  )
+
+    def close(self):
+        self.closed = True
+        self._queue.clear()
+        self._bytes = 0
+
+    def _conflate(self):
+        """Keep the newest message of each key (and all without a key)."""
+        _kept = []
+        _seen = set()
+        _conflated = set()          # keys of which messages are dropped
+        for _item in reversed(self._queue):
+            _key = _item[0]
+            if _key is not None:
+                if _key in _seen:
+                    _conflated.add(_key)
+                    continue
+                _seen.add(_key)
+            _kept.append(_item)
+
+        # a delta is useless once the message before it is dropped: its
+        # full message is sent instead
+        _kept = deque(
+            (_key, _keyframe, _queued, None)
+            if _keyframe is not None and _key in _conflated
+            else (_key, _message, _queued, _keyframe)
+            for _key, _message, _queued, _keyframe in reversed(_kept)
+        )
+
+        _dropped = len(self._queue) - len(_kept)
+        if not self.dropped and _dropped:
+            logger.info("WebSocket client is falling behind: conflating "
+                        "its telemetry")
+        self.dropped += _dropped
+        self._queue = _kept
+        self._bytes = sum(len(_item[1]) for _item in _kept)
+
+    def _write_queued(self):
+        """Write all queued messages, and wait for them to be flushed."""
+        if not self._queue:
+            return
+
+        _oldest = self._queue[0][2]
+        _future = None
+        try:
+            while self._queue:
+                _message = self._queue.popleft()[1]
+                _future = self.socket.write_message(
+                    _message, binary=isinstance(_message, bytes)
+                )
+                self.sent += 1
+        except tornado.websocket.WebSocketClosedError:
+            self.close()
+            return
+        self._bytes = 0
+
+        if _future is None:
+            return
+        self._flushing = True
+        self.ioloop.add_future(_future,
+                               lambda f: self._on_flushed(f, _oldest))
+
+    def _on_flushed(self, future, oldest):
+        self._flushing = False
+        if future.exception() is not None:
+            # the socket was closed
+            self.close()
+            return
+
+        self.lag_ms = (time.monotonic() - oldest) * 1000
+        self.max_lag_ms = max(self.max_lag_ms, self.lag_ms)
+        self._write_queued()
+
+
+# ****************************************************************************
+# broadcaster
+# ****************************************************************************
+class _Packet():
+    """A broadcast telemetry packet, and its JSON for each set of fields."""
+    __slots__ = ('seq', 'key', 'telemetry', '_encoded', '_contents')
+
+    def __init__(self, seq, telemetry):
+        self.seq = seq
+        self.key = (telemetry.device, telemetry.board)
+        self.telemetry = telemetry
+        self._encoded = dict()      # fields -> dict, or None if not encoded
+        self._contents = dict()     # fields -> JSON, or None if not encoded
+
+    def encoded(self, fields):
+        """
+        Return some fields as dicts, lists and scalars, or None if they
+        cannot be parsed.
+
+        """
+        try:
+            return self._encoded[fields]
+        except KeyError:
+            pass
+
+        try:
+            _encoded = encode_projection(self.telemetry, fields)
+        except:
+            errmsg = ("Error encountered while converting the following "
+                      "telemetry to JSON: \n"
+                      "    {t}".format(t=self.telemetry)                )
+            logger.exception(errmsg, exc_info=True)
+            _encoded = None
+
+        self._encoded[fields] = _encoded
+        return _encoded
+
+    def forget_encoded(self):
+        """Free the encoded fields, once no delta will be made from them."""
+        self._encoded.clear()
+
+    def content(self, fields):
+        """Return the JSON of some fields, or None if they cannot be parsed."""
+        try:
+            return self._contents[fields]
+        except KeyError:
+            pass
+
+        _encoded = self.encoded(fields)
+        _content = None if _encoded is None else dumps(_encoded)
+        self._contents[fields] = _content
+        return _content
+
+    def message(self, fields):
+        """Return the telemetry message with some fields, or None."""
+        _content = self.content(fields)
+        if _content is None:
+            return None
+        return json_message('telemetry', _content, seq=self.seq)
+
+    def delta_message(self, fields, previous):
+        """
+        Return the telemetry_delta message with the changes of some fields
+        since the previous packet of the board, or None if the change cannot
+        be sent as a delta. The delta always has the board and device.
+
+        """
+        _previous = previous.encoded(fields)
+        _current = self.encoded(fields)
+        if _previous is None or _current is None:
+            return None
+        _delta = encode_delta(_previous, _current)
+        if _delta is None:
+            return None
+
+        _delta['device'], _delta['board'] = self.key
+        return json_message('telemetry_delta', dumps(_delta), seq=self.seq,
+                            base=previous.seq)
+
+    def frame(self, fields, encoder):
+        """
+        Return the BinarySchema and the binary frame of some fields, packed
+        by encoder, or None if they cannot be packed (or parsed).
+
+        """
+        try:
+            return encoder.encode(self.telemetry, fields, self.seq)
+        except BinaryEncodingError:
+            logger.debug("Sending telemetry as JSON, as it cannot be packed",
+                         exc_info=True)
+        except:
+            errmsg = ("Error encountered while packing the following "
+                      "telemetry: \n"
+                      "    {t}".format(t=self.telemetry)              )
+            logger.exception(errmsg, exc_info=True)
+        return None
+
+
+def _names(names, what):
+    """Check that names (of boards or fields) is a list of strings."""
+    if (isinstance(names, str)
+            or not all(isinstance(_name, str) for _name in names)):
+        raise ValueError(f"{what} must be a list of strings: {names!r}")
+    return names
+
+
+class TelemetryBroadcaster():
+    """Sends newly received telemetry to every open WebSocket."""
+    def __init__(self, educube_connection, ioloop=None,
+                 replay_window=DEFAULT_REPLAY_WINDOW):
+        """
+        Constructor. Registers with the connection as a telemetry listener.
+
+        Parameters
+        ----------
+        educube_connection : EduCubeConnection or EduCubeConnectionManager
+            The connection whose telemetry is sent
+        ioloop : tornado.ioloop.IOLoop
+            The IOLoop of the web server (default: the current IOLoop)
+        replay_window : int
+            Number of telemetry messages kept for resuming clients
+
+        """
+        self.educube = educube_connection
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self.clients = dict()       # socket -> ClientQueue
+
+        # (device, board) -> the latest packet
+        self.latest = dict()
+
+        # sequence number of the last packet, and the last packets
+        self.stream = uuid.uuid4().hex[:16]
+        self.seq = 0
+        self.window = deque(maxlen=replay_window)
+
+        # packs the telemetry of binary clients, keeping the schemas
+        self.binary_encoder = BinaryTelemetryEncoder()
+
+        # time.monotonic() at which the last client disconnected
+        self._idle_since = None
+
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+        self.educube.add_telemetry_listener(self.wake)
+
+    def close(self):
+        """Stop listening for telemetry."""
+        self.educube.remove_telemetry_listener(self.wake)
+
+    @property
+    def sockets(self):
+        return set(self.clients)
+
+    def add_socket(self, socket, resume=None, subscriptions=()):
+        """
+        Start sending to a socket, beginning with the snapshot, or with the
+        messages missed by a resuming client.
+
+        Parameters
+        ----------
+        socket : tornado.websocket.WebSocketHandler
+            The newly opened WebSocket
+        resume : (str, int)
+            The stream and the seq of the last message received by the
+            client, if it is resuming its stream
+        subscriptions : list of (boards, fields)
+            The client's subscriptions, made in order as by subscribe (but
+            without their snapshots) before the snapshot or the missed
+            messages are sent, which then have the fields subscribed to
+
+        Returns True if the stream was resumed, False if a snapshot was sent.
+        Raises ValueError, and does not add the socket, if the subscriptions
+        are invalid.
+
+        """
+        _client = ClientQueue(socket, self.ioloop)
+        for _boards, _fields in subscriptions:
+            self._subscribe(_client, _boards, _fields)
+        self.clients[socket] = _client
+
+        _missed = None if resume is None else self.replay(*resume)
+        if _missed is None:
+            _client.put(self.snapshot_message(_client))
+        else:
+            for _packet in _missed:
+                _fields = _client.fields_of(_packet.telemetry.board)
+                if _fields is None:
+                    continue
+                _message = _packet.message(_fields)
+                if _message is not None:
+                    _client.record_sent(_packet.key, _fields, _packet.seq)
+                    _client.put(_message, key=_packet.key)
+
+        if _client.closed:
+            self.clients.pop(socket, None)
+        return _missed is not None
+
+    def subscribe(self, socket, boards=None, fields=None, snapshot=True):
+        """
+        From now on, send a socket the telemetry of some boards, with some
+        of its fields; then send it a snapshot of those boards, if snapshot
+        is True.
+
+        Parameters
+        ----------
+        socket : tornado.websocket.WebSocketHandler
+            The subscribing WebSocket
+        boards : list of str
+            The boards subscribed to, e.g. ['ADC']. If None, every board is
+            subscribed to, replacing the earlier subscriptions.
+        fields : list of str
+            The fields sent, as attribute paths of the telemetry, e.g.
+            ['time', 'board', 'data.MPU_GYR'] (default: DEFAULT_FIELDS)
+
+        Raises ValueError if boards or fields are not lists of strings.
+
+        """
+        _client = self.clients.get(socket)
+        if _client is None:
+            return
+
+        self._subscribe(_client, boards, fields)
+        if not snapshot:
+            return
+
+        # the snapshot replaces the client's telemetry of those boards, so
+        # the next packet of each is sent in full
+        _client.last_sent = {_key: _last
+                             for _key, _last in _client.last_sent.items()
+                             if boards is not None and _key[1] not in boards}
+        _client.put(self.snapshot_message(_client, boards))
+
+    def _subscribe(self, client, boards, fields):
+        # clients with the same fields, in any order, share their JSON
+        _fields = (DEFAULT_FIELDS if fields is None
+                   else tuple(sorted(set(_names(fields, 'fields')))))
+        if boards is None:
+            client.subscriptions = {ALL_BOARDS: _fields}
+        else:
+            client.subscriptions.update(
+                dict.fromkeys(_names(boards, 'boards'), _fields)
+            )
+
+    def unsubscribe(self, socket, boards=None):
+        """
+        Stop sending a socket the telemetry of some boards, or of every
+        board if boards is None.
+
+        """
+        _client = self.clients.get(socket)
+        if _client is None:
+            return
+
+        if boards is None:
+            _client.subscriptions = dict()
+        else:
+            _client.subscriptions.update(
+                dict.fromkeys(_names(boards, 'boards'), None)
+            )
+
+    def set_delta(self, socket, enabled=True, keyframe_interval=None):
+        """
+        Send a socket its telemetry as deltas, or not: each packet as the
+        changes since the previous packet of its board, with a full message
+        every keyframe_interval packets of each board (default:
+        DEFAULT_KEYFRAME_INTERVAL).
+
+        """
+        _client = self.clients.get(socket)
+        if _client is None:
+            return
+
+        _client.delta = bool(enabled)
+        if keyframe_interval is not None:
+            if (not isinstance(keyframe_interval, int)
+                    or keyframe_interval < 1):
+                raise ValueError(f"Invalid keyframe interval: "
+                                 f"{keyframe_interval!r}")
+            _client.keyframe_interval = keyframe_interval
+
+    def set_binary(self, socket, enabled=True):
+        """
+        Send a socket its telemetry as binary frames, or not (see
+        educube.telemetry_parser._binary).
+
+        """
+        _client = self.clients.get(socket)
+        if _client is None:
+            return
+        _client.binary = bool(enabled)
+
+    def replay(self, stream, seq):
+        """
+        Return the packets broadcast after seq, or None if some are no
+        longer in the replay window (or the stream is not this one).
+
+        """
+        if stream != self.stream or seq > self.seq or seq < 0:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.window or self.window[0].seq > seq + 1:
+            return None
+        return list(islice(self.window, seq + 1 - self.window[0].seq, None))
+
+    def snapshot_message(self, client=None, boards=None):
+        """
+        Return the message with the latest packet of each board, with the
+        fields client subscribed to (default: every board, with
+        DEFAULT_FIELDS), and only of boards, if given. Packets that cannot be
+        parsed are left out.
+
+        """
+        _contents = []
+        for _packet in self.latest.values():
+            _board = _packet.telemetry.board
+            if boards is not None and _board not in boards:
+                continue
+            _fields = (DEFAULT_FIELDS if client is None
+                       else client.fields_of(_board))
+            if _fields is None:
+                continue
+            _content = _packet.content(_fields)
+            if _content is not None:
+                _contents.append(_content)
+
+        _packets = ','.join(_contents)
+        return json_message('snapshot', f'[{_packets}]',
+                            stream=self.stream, seq=self.seq)
+
+    def remove_socket(self, socket):
+        """Stop sending to a socket. Returns its final ClientStats."""
+        _client = self.clients.pop(socket, None)
+        if _client is None:
+            return None
+        _client.close()
+        if not self.clients:
+            self._idle_since = time.monotonic()
+        return _client.stats()
+
+    def stats(self):
+        """Return the ClientStats of each open socket."""
+        return {_socket: _client.stats()
+                for _socket, _client in self.clients.items()}
+
+    def wake(self):
+        """
+        Schedule a broadcast of the buffered telemetry. May be called from
+        any thread.
+
+        """
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.ioloop.add_callback(self.broadcast)
+
+    def broadcast(self):
+        """Send all newly received telemetry to every open WebSocket."""
+        # telemetry received from now on needs another broadcast
+        with self._lock:
+            self._scheduled = False
+
+        # the buffer is drained even with no WebSocket open, as draining it
+        # also writes the telemetry log. Packets are parsed lazily: only the
+        # fields sent to some client, or kept for the snapshot, are parsed,
+        # when they are encoded. Packets with no recognised board are
+        # returned as None.
+        _telemetry_packets = [
+            t for t in self.educube.parse_telemetry(lazy=True)
+            if t is not None
+        ]
+        if not _telemetry_packets:
+            return
+
+        # unless a client may still resume, packets are counted but not kept
+        _replayable = bool(self.clients) or self._resumable()
+        if not _replayable:
+            self.window.clear()
+
+        for _telemetry in _telemetry_packets:
+            self.seq += 1
+            _packet = _Packet(self.seq, _telemetry)
+            _previous = self.latest.get(_packet.key)
+            if _replayable:
+                self.window.append(_packet)
+            self.send_packet(_packet, _previous)
+
+            # a packet that cannot be parsed does not replace the latest
+            # packet of its board, which is still sent in snapshots
+            if _packet.encoded(DEFAULT_FIELDS) is None:
+                continue
+            self.latest[_packet.key] = _packet
+            if _previous is not None:
+                _previous.forget_encoded()
+
+    def _resumable(self):
+        """Return True if a disconnected client may still resume."""
+        return (self._idle_since is not None
+                and time.monotonic() - self._idle_since < RESUME_TIMEOUT_S)
+
+    def send_packet(self, packet, previous=None):
+        """
+        Queue a telemetry packet for every WebSocket subscribed to its
+        board, encoding it once for each distinct set of fields. Clients in
+        delta mode are sent the changes since previous, the packet before
+        it of the same board, when they were sent previous. Binary clients
+        are sent a binary frame, preceded by its schema if they do not have
+        it yet.
+
+        """
+        _board = packet.telemetry.board
+        _messages = dict()          # fields -> message
+        _deltas = dict()            # fields -> delta message
+        _frames = dict()            # fields -> (BinarySchema, frame)
+        for _socket, _client in list(self.clients.items()):
+            _fields = _client.fields_of(_board)
+            if _fields is None:
+                continue
+
+            if _client.binary:
+                if _fields not in _frames:
+                    _frames[_fields] = packet.frame(_fields,
+                                                    self.binary_encoder)
+                if _frames[_fields] is not None:
+                    _schema, _frame = _frames[_fields]
+                    if _schema.id not in _client.schemas_sent:
+                        _client.schemas_sent.add(_schema.id)
+                        self._put(_socket, _client, _schema.message, None)
+                    _client.record_sent(packet.key, _fields, packet.seq)
+                    self._put(_socket, _client, _frame, packet.key)
+                    continue
+
+            if _fields not in _messages:
+                _messages[_fields] = packet.message(_fields)
+            _message = _messages[_fields]
+            if _message is None:
+                continue
+
+            _delta = None
+            if (previous is not None
+                    and _client.can_delta(packet.key, _fields, previous.seq)):
+                if _fields not in _deltas:
+                    _deltas[_fields] = packet.delta_message(_fields, previous)
+                _delta = _deltas[_fields]
+
+            _client.record_sent(packet.key, _fields, packet.seq,
+                                delta=_delta is not None)
+            if _delta is None:
+                self._put(_socket, _client, _message, packet.key)
+            else:
+                self._put(_socket, _client, _delta, packet.key,
+                          keyframe=_message)
+
+    def send(self, message, key=None):
+        """
+        Queue a message for every open WebSocket. Messages with the same key
+        may be conflated for slow clients (see ClientQueue.put).
+
+        """
+        for _socket, _client in list(self.clients.items()):
+            self._put(_socket, _client, message, key)
+
+    def _put(self, socket, client, message, key, keyframe=None):
+        try:
+            client.put(message, key=key, keyframe=keyframe)
+        except:
+            errmsg = ("Error encountered while sending the following "
+                      "telemetry message over websockets: \n"
+                      "    {t}".format(t=message))
+            logger.exception(errmsg, exc_info=True)
+        if client.closed:
+            self.remove_socket(socket)
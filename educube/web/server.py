@@ -23,6 +23,8 @@ import tornado.ioloop
 import tornado.httpserver
 import tornado.websocket
 
+from ._broadcast import TelemetryBroadcaster
+
 logger = logging.getLogger(__name__)
 
 
@@ -39,12 +41,27 @@ TEMPLATE_PATH = os.path.join(dirname, 'templates')
 # Main Tornado Application
 # ****************************************************************************
 class EduCubeWebApplication(tornado.web.Application):
-    def __init__(self, educube_connection, port):
+    def __init__(self, educube_connection, port, compression_level=None):
+        """
+        Parameters
+        ----------
+        educube_connection : EduCubeConnection or EduCubeConnectionManager
+            The connection whose telemetry is served
+        port : int
+            The port of the web server
+        compression_level : int
+            The zlib level (0-9) at which WebSocket messages are compressed,
+            for clients that support it (permessage-deflate), or None not to
+            compress them
+
+        """
         handlers = [
             (r"/", MainHandler,
-             {'websocket_port' : port}),
+             {'websocket_port' : port,
+              'devices'        : tuple(educube_connection.devices)}),
             (r"/socket", EduCubeServerSocket, 
-             {'educube_connection' : educube_connection}),
+             {'educube_connection' : educube_connection,
+              'compression_level'  : compression_level }),
         ]
         settings = {
             "template_path": TEMPLATE_PATH,
@@ -55,21 +72,33 @@ class EduCubeWebApplication(tornado.web.Application):
                     .format(json.dumps(settings, indent=2)))
         tornado.web.Application.__init__(self, handlers, **settings)
 
+        # one broadcaster, woken by the connection when telemetry arrives,
+        # sends the telemetry to every WebSocket
+        self.broadcaster = TelemetryBroadcaster(educube_connection)
+
 
 # ****************************************************************************
 # Request Handlers
 # ****************************************************************************
 class MainHandler(tornado.web.RequestHandler):
     """."""
-    def initialize(self, websocket_port):
+    def initialize(self, websocket_port, devices=()):
         self.websocket_port = websocket_port
+        self.devices = devices
 #    def __init__(self, websocket_port, **kwargs):
 #        self.websocket_port = websocket_port
 #        super().__init__(**kwargs)
 
     def get(self):
+        # when several EduCubes are served, each browser page shows one of
+        # them, chosen with the 'device' query argument
+        default_device = self.devices[0] if self.devices else None
+        device = self.get_argument('device', default_device)
+
         self.render("educube.html", 
-                    port=self.websocket_port)
+                    port=self.websocket_port,
+                    device=device,
+                    devices=self.devices)
 
 
 class EduCubeServerSocket(tornado.websocket.WebSocketHandler):
@@ -77,30 +106,60 @@ class EduCubeServerSocket(tornado.websocket.WebSocketHandler):
     WebSocket handler to send telemetry & receive commands from web interface.
 
     """
-    _sockets = set()
-
-    def __init__(self, application, request, educube_connection, **kwargs):
+    def __init__(self, application, request, educube_connection,
+                 compression_level=None, **kwargs):
         self.educube = educube_connection
+        self.compression_level = compression_level
 
         tornado.websocket.WebSocketHandler.__init__(
             self, application, request, **kwargs
             )
 
-        # Startup periodic calls -- callback_time in milliseconds
-        self.loop = tornado.ioloop.PeriodicCallback(
-            callback = self.put_updated_telemetry,
-            callback_time = 500
-            )
-        self.loop.start()
+    def get_compression_options(self):
+        # compression costs CPU for every message, on the server and in the
+        # browser, so it is off unless a level is given
+        if self.compression_level is None:
+            return None
+        return {'compression_level' : self.compression_level}
 
     def open(self):
-        self._sockets.add(self)
-        logger.info("WebSocket opened")
+        # a reconnecting client may ask to resume its telemetry stream
+        # after the last message it received, with the query arguments
+        # 'stream' and 'seq'
+        _resume = None
+        _stream = self.get_argument('stream', None)
+        _seq = self.get_argument('seq', None)
+        if _stream is not None and _seq is not None:
+            try:
+                _resume = (_stream, int(_seq))
+            except ValueError:
+                logger.warning("Invalid seq to resume from: {}".format(_seq))
+
+        # a client may also give its subscriptions, as the JSON list of the
+        # contents of its subscribe messages, so that the snapshot or the
+        # replayed messages are of what it subscribed to
+        _subscriptions_json = self.get_argument('subscriptions', '[]')
+        _broadcaster = self.application.broadcaster
+        try:
+            _subscriptions = [
+                (_content.get('boards'), _content.get('fields'))
+                for _content in json.loads(_subscriptions_json)
+            ]
+            _resumed = _broadcaster.add_socket(self, _resume, _subscriptions)
+        except (AttributeError, TypeError, ValueError):
+            errmsg = ('Invalid subscriptions:\n       {s}'
+                      .format(s=_subscriptions_json)      )
+            logger.exception(errmsg, exc_info=True)
+            _resumed = _broadcaster.add_socket(self, _resume)
+
+        logger.info("WebSocket opened{}".format(
+            " (stream resumed)" if _resumed else ""
+        ))
         print("WebSocket opened")
 
     def on_close(self):
-        self._sockets.remove(self)
-        logger.info("WebSocket closed")
+        _stats = self.application.broadcaster.remove_socket(self)
+        logger.info("WebSocket closed: {}".format(_stats))
         print("WebSocket closed")
 
     def on_message(self, message):
@@ -112,10 +171,59 @@ class EduCubeServerSocket(tornado.websocket.WebSocketHandler):
 
             { 'msgtype' : <msgtype>, 'msgcontent' : <msgcontent> }
 
-        The only allowed <msgtype> is 'command'. For a command, <msgcontent>
-        should be a JavaScript style object, with fields:
+        The allowed <msgtype>s are 'command', 'subscribe', 'unsubscribe',
+        'delta' and 'binary'. For a command, <msgcontent> should be a
+        JavaScript style object, with fields:
             { 'board'    : <board>   , 'command' : <command>, 
               'settings' : <settings>                        }
+        and optionally 'device', identifying the EduCube when several are
+        connected, and 'id', which is returned in the command result.
+
+        Commands are queued and transmitted by the connection, so this returns
+        immediately. Once the command has been written (or has failed), a
+        message is sent back to this WebSocket:
+
+            { 'msgtype'    : 'command_result',
+              'msgcontent' : { 'id' : <id>, 'ok' : <bool>,
+                               'command' : <command>, 'error' : <error> } }
+
+        Until it subscribes, a WebSocket is sent the telemetry of every board.
+        To receive only some boards, and only some fields of their telemetry,
+        send
+            { 'msgtype'    : 'subscribe',
+              'msgcontent' : { 'boards' : <boards>, 'fields' : <fields>,
+                               'snapshot' : <bool> } }
+        where <boards> is a list of boards (e.g. ['ADC']), or null for every
+        board, which replaces the earlier subscriptions, and <fields> is a
+        list of attribute paths of the telemetry (e.g. ['time', 'board',
+        'data.MPU_GYR']), or null for all fields but the telemetry string.
+        The WebSocket is then sent a snapshot of those boards, unless
+        'snapshot' (optional) is false. 'unsubscribe' takes
+        { 'boards' : <boards> }, null unsubscribing from every board. The
+        subscriptions may also be given when the WebSocket is opened, as the
+        query argument 'subscriptions': the JSON list of the <msgcontent>s
+        of the subscribe messages, which are made in order, before the
+        snapshot (or the replay of a resumed stream) is sent.
+
+        To receive telemetry as deltas, send
+            { 'msgtype'    : 'delta',
+              'msgcontent' : { 'enabled'           : <bool>,
+                               'keyframe_interval' : <n>     } }
+        ('keyframe_interval' is optional). A packet is then sent, when its
+        board's previous packet was, as only the values that changed:
+            { 'msgtype' : 'telemetry_delta', 'seq' : <seq>, 'base' : <seq>,
+              'msgcontent' : { 'board' : <board>, 'device' : <device>,
+                               <changed values, at their paths> } }
+        where 'base' is the seq of the previous packet, and lists are
+        patched index by index, e.g. { 'data' : { 'INA' : { '0' : ... } } }.
+
+        To receive telemetry as binary frames, send
+            { 'msgtype' : 'binary', 'msgcontent' : { 'enabled' : <bool> } }
+        Each frame holds the values of a packet in the order of a schema,
+        which is sent before the first frame that uses it:
+            { 'msgtype'    : 'binary_schema',
+              'msgcontent' : { 'id' : <id>, 'layout' : <layout> } }
+        (see educube.telemetry_parser._binary, and static/js/binary.js).
          
         """
 
@@ -130,55 +238,101 @@ class EduCubeServerSocket(tornado.websocket.WebSocketHandler):
             return 
 
         if msg['msgtype'] == 'command':
+            _command = dict(msg['msgcontent'])
+            _id = _command.pop('id', None)
 
             try:
-                self.educube.process_command(**msg['msgcontent'])
-            except:
+                future = self.educube.process_command(**_command)
+            except Exception as exc:
                 errmsg = ('Exception encountered while processing command '
                           +'with arguments:\n       {msg}'.format(msg=msg))
                 logger.exception(errmsg, exc_info=True)
+                self.send_command_result(_id, error=str(exc))
                 return
 
-        else:
-            logger.warning('Unknown msgtype: {}'.format(msg['msgtype']))
+            if future is None:
+                self.send_command_result(_id, error='Unknown command')
+                return
 
+            tornado.ioloop.IOLoop.current().add_future(
+                future, lambda f: self._command_done(_id, f)
+            )
 
-    def put_updated_telemetry(self):
-        _telemetry_packets = self.educube.parse_telemetry()
-
-        # when an error is encountered in parsing the data,
-        # educube.parse_telemetry() returns None. This then causes another
-        # error when turning to JSON, so first we need to filter out None.
-        _telemetry_packets = (t for t in _telemetry_packets if t is not None)
-
-        for _telemetry in _telemetry_packets:
-            # convert telemetry to JSON
-            try: 
-                _telemetry_json = json.dumps({
-                    'msgtype'    : 'telemetry'             , 
-                    'msgcontent' : _telemetry._serialised()
-                })
-            except:
-                errmsg = ("Error encountered while converting the following "
-                          "telemetry to JSON: \n"
-                          "    {t}".format(t=_telemetry)                     )
+        elif msg['msgtype'] in ('subscribe', 'unsubscribe'):
+            _content = msg.get('msgcontent') or {}
+            _broadcaster = self.application.broadcaster
+            try:
+                if msg['msgtype'] == 'subscribe':
+                    _broadcaster.subscribe(
+                        self,
+                        boards   = _content.get('boards')        ,
+                        fields   = _content.get('fields')        ,
+                        snapshot = _content.get('snapshot', True),
+                    )
+                else:
+                    _broadcaster.unsubscribe(self,
+                                             boards = _content.get('boards'))
+            except (AttributeError, TypeError, ValueError):
+                errmsg = ('Invalid {t} message:\n       {msg}'
+                          .format(t=msg['msgtype'], msg=msg)   )
                 logger.exception(errmsg, exc_info=True)
-                continue
 
-            # send telemetry over websocket
+        elif msg['msgtype'] == 'delta':
+            _content = msg.get('msgcontent') or {}
             try:
-                logger.debug("Updating telemetry: {}"\
-                             .format(_telemetry_json))
-                for _socket in self._sockets:
-                    _socket.write_message(_telemetry_json)
-            except:
-                errmsg = ("Error encountered while sending the following "
-                          "telemetry message over websockets: \n"
-                          "    {t}".format(t=_telemetry_json))
+                self.application.broadcaster.set_delta(
+                    self,
+                    enabled           = _content.get('enabled', True)     ,
+                    keyframe_interval = _content.get('keyframe_interval'),
+                )
+            except (AttributeError, ValueError):
+                errmsg = ('Invalid delta message:\n       {msg}'
+                          .format(msg=msg)                   )
                 logger.exception(errmsg, exc_info=True)
-                continue
 
-        
+        elif msg['msgtype'] == 'binary':
+            _content = msg.get('msgcontent') or {}
+            try:
+                self.application.broadcaster.set_binary(
+                    self, enabled=_content.get('enabled', True)
+                )
+            except AttributeError:
+                errmsg = ('Invalid binary message:\n       {msg}'
+                          .format(msg=msg)                    )
+                logger.exception(errmsg, exc_info=True)
+
+        else:
+            logger.warning('Unknown msgtype: {}'.format(msg['msgtype']))
+
+    def _command_done(self, command_id, future):
+        """Report the outcome of a transmitted command."""
+        if future.cancelled():
+            self.send_command_result(command_id, error='Command cancelled')
+            return
+
+        exc = future.exception()
+        if exc is not None:
+            self.send_command_result(command_id, error=str(exc))
+        else:
+            self.send_command_result(command_id, command=future.result())
+
+    def send_command_result(self, command_id, command=None, error=None):
+        """Send the result of a command back to the web interface."""
+        _result_json = json.dumps({
+            'msgtype'    : 'command_result',
+            'msgcontent' : {
+                'id'      : command_id   ,
+                'ok'      : error is None,
+                'command' : command      ,
+                'error'   : error        ,
+            }
+        })
+
+        try:
+            self.write_message(_result_json)
+        except tornado.websocket.WebSocketClosedError:
+            logger.debug("WebSocket closed before command result was sent")
+
 
 # ****************************************************************************
 # Message parser
@@ -251,11 +405,13 @@ class EduCubeServerSocket(tornado.websocket.WebSocketHandler):
 # ****************************************************************************
 # Main input
 # ****************************************************************************
-def run(educube_connection, port):
+def run(educube_connection, port, compression_level=None):
     """
     Start and run the IOLoop, given an EduCubeConnection object to handle.
+    WebSocket messages are compressed at compression_level (0-9), if given.
     """
-    application = EduCubeWebApplication(educube_connection, port)
+    application = EduCubeWebApplication(educube_connection, port,
+                                        compression_level=compression_level)
     http_server = tornado.httpserver.HTTPServer(application)
     http_server.listen(port)
 
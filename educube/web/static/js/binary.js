@@ -0,0 +1,71 @@
+// Decodes the binary telemetry frames sent to clients that ask for them with
+// a 'binary' message (see educube/telemetry_parser/_binary.py).
+//
+// A frame holds only the values of a packet, in the order of a layout that
+// the server sends first, in a 'binary_schema' message:
+//     { 'id' : <id>, 'layout' : <layout> }
+// A layout is a value's type code ("s" string, "f" number, "b" boolean, "n"
+// null), { "k" : [keys], "v" : [layouts] } for an object, or
+// { "l" : [layouts] } for an array. A frame is a header (uint8 frame type,
+// uint8 flags, uint16 schema id, float64 seq, little-endian) followed by the
+// values as UTF-8 text separated by the unit separator (nothing for nulls).
+
+var BINARY_FRAME_TELEMETRY = 1;
+var BINARY_HEADER_BYTES = 12;
+var BINARY_SEPARATOR = "\x1f";
+
+function BinaryTelemetryDecoder() {
+    var _layouts = {};      // schema id -> layout
+    var _text = new TextDecoder("utf-8");
+
+    function _build(layout, values){
+        if (typeof layout === "string"){
+            if (layout === "n"){
+                return null;
+            }
+            var _value = values.items[values.next++];
+            if (layout === "f"){
+                return Number(_value);
+            } else if (layout === "b"){
+                return _value === "1";
+            }
+            return _value;
+        }
+        if (layout.l){
+            return layout.l.map(function (item){
+                return _build(item, values);
+            });
+        }
+        var _object = {};
+        for (var i = 0; i < layout.k.length; i++){
+            _object[layout.k[i]] = _build(layout.v[i], values);
+        }
+        return _object;
+    };
+
+    this.add_schema = function (schema){
+        _layouts[schema.id] = schema.layout;
+    };
+
+    // returns { telemetry : <packet>, seq : <seq> }, or null if the frame
+    // cannot be decoded (e.g., its schema was not received)
+    this.decode = function (buffer){
+        var _header = new DataView(buffer, 0, BINARY_HEADER_BYTES);
+        if (_header.getUint8(0) !== BINARY_FRAME_TELEMETRY){
+            console.log("WARNING: Unrecognised binary frame type: "
+                        +_header.getUint8(0));
+            return null;
+        }
+        var _layout = _layouts[_header.getUint16(2, true)];
+        if (_layout === undefined){
+            console.log("WARNING: Binary frame of unknown schema: "
+                        +_header.getUint16(2, true));
+            return null;
+        }
+
+        var _body = _text.decode(new Uint8Array(buffer, BINARY_HEADER_BYTES));
+        var _values = { items : _body.split(BINARY_SEPARATOR), next : 0 };
+        return { telemetry : _build(_layout, _values),
+                 seq       : _header.getFloat64(4, true) };
+    };
+};
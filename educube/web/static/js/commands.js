@@ -4,9 +4,12 @@
 //    console.log("Attached command handlers");
 //});
 
-function CommandHandler(websocket) {
+function CommandHandler(websocket, device) {
     var self = this;
     this.websocket = websocket;
+    this.device = (device === undefined) ? null : device;
+    // each command is numbered, so its result can be matched to it
+    this.next_id = 1;
 
     this.send_command = function (command, board, settings) {
         var cmd_packet = {
@@ -15,8 +18,12 @@ function CommandHandler(websocket) {
                 command  : command,
                 board    : board,
                 settings : settings,
+                id       : self.next_id++,
      	    }
      	};
+        if (self.device !== null){
+            cmd_packet.msgcontent.device = self.device;
+        }
      
         console.log("Sending cmd_packet:")
         try {
@@ -216,6 +223,22 @@ function CommandHandler(websocket) {
 //}
 
 
+//////////////////////////////////////////////////////////////////////////////
+// handle_command_result
+// 
+// Called when the server reports whether a command was sent to EduCube.
+//////////////////////////////////////////////////////////////////////////////
+function handle_command_result(result) {
+    if (result.ok) {
+        console.log("Command "+result.id+" sent: "+result.command);
+    } else {
+        console.log("Command "+result.id+" failed: "+result.error);
+        provide_notice({"message": "Command failed: "+result.error,
+                        "type": "error"});
+    }
+}
+
+
 //////////////////////////////////////////////////////////////////////////////
 // provide_notice
 // 
@@ -4,8 +4,50 @@
 /* 
 /* 
 /****/
-function EduCubeClientSocket(port) {
+var STATUS_FIELDS = ['time', 'type', 'board', 'device'];
+
+function EduCubeClientSocket(port, device) {
     var websocket_address = "ws://localhost:"+port+"/socket";
+    // device identifies which EduCube this page shows when the server is
+    // connected to several. It is null for a single EduCube.
+    device = (device === undefined) ? null : device;
+
+    // the telemetry shown: the data of the board whose tab is shown, and
+    // only the time of the others, for their status indicators
+    function _subscriptions(){
+        var _contents = [{'boards' : null, 'fields' : STATUS_FIELDS}];
+
+        var _pane = $('.tab-content .tab-pane.active').attr('id') || '';
+        if (_pane.indexOf('board_') === 0){
+            _contents.push({
+                'boards' : [_pane.substr('board_'.length).toUpperCase()],
+                'fields' : null
+            });
+        }
+        return _contents;
+    };
+
+    // subscribe again when another tab is shown. The status fields are
+    // already shown, so only the board of the tab needs a snapshot.
+    function _subscribe(socket){
+        _subscriptions().forEach(function (content){
+            content.snapshot = (content.boards !== null);
+            socket.send(JSON.stringify({
+                'msgtype'    : 'subscribe',
+                'msgcontent' : content
+            }));
+        });
+    };
+
+    // on each (re)connection, ask for telemetry as binary frames if the
+    // browser can decode them, otherwise as deltas. The subscriptions are
+    // given when the websocket is opened (see setup_websocket).
+    function _on_open(socket){
+        socket.send(JSON.stringify({
+            'msgtype'    : socket.binary ? 'binary' : 'delta',
+            'msgcontent' : {'enabled' : true}
+        }));
+    };
 
     function _client_setup(){
 	console.log("EduCube JavaScript setup");
@@ -21,10 +63,17 @@ function EduCubeClientSocket(port) {
 	//        gps_map.updateSize();
         console.log('Creating GPSMap -- DONE');
 
-        telemetryhandler = new TelemetryHandler(gps_map);
+        telemetryhandler = new TelemetryHandler(gps_map, device);
         socket           = setup_websocket(websocket_address,
-                                           telemetryhandler  );
-        commandhandler   = new CommandHandler(socket);
+                                           telemetryhandler ,
+                                           _on_open         ,
+                                           _subscriptions    );
+        commandhandler   = new CommandHandler(socket, device);
+
+        // resubscribe whenever another board's tab is shown
+        $('a[data-toggle="tab"]').on('shown.bs.tab', function (){
+            _subscribe(socket);
+        });
     
 
         console.log("EduCube JavaScript setup complete.");
@@ -11,17 +11,91 @@
 // Note: if additional msgtypes are added, then this will have to be extended!
 // 
 
-function setup_websocket(websocket_address, telemetryhandler) {
+//
+// Each telemetry message carries a sequence number, seq. When the websocket
+// is lost, it is reopened after a delay, asking the server to resume the
+// stream after the last seq received: the server then sends the missed
+// messages, or a new snapshot if it no longer has them all. Gaps in the seq
+// are expected: the messages of boards not subscribed to are not sent.
+//
+// Binary telemetry frames, sent when the client asks for them, are decoded
+// with the schemas received in 'binary_schema' messages (see binary.js).
+//
+// on_open (optional) is called with the returned object whenever the
+// websocket is (re)opened, e.g. to choose delta or binary telemetry.
+//
+// subscriptions (optional) is called whenever the websocket is (re)opened,
+// and returns the contents of the subscribe messages of the telemetry
+// wanted. They are sent with the request that opens the websocket, so that
+// the snapshot, or the missed messages of a resumed stream, are of the
+// boards and fields subscribed to, and need not be sent again on opening.
+//
+// Returns an object whose send method writes to the current websocket.
+
+var RECONNECT_DELAY_MS = 1000;
+var RECONNECT_MAX_DELAY_MS = 16000;
+
+function setup_websocket(websocket_address, telemetryhandler, on_open,
+                         subscriptions) {
     console.log("websocket_address : "+websocket_address);
-    websocket = new WebSocket(websocket_address);
+    var websocket = null;
+    var stream = null;      // identifies the server's telemetry stream
+    var last_seq = null;    // seq of the last telemetry message received
+    var reconnect_delay = RECONNECT_DELAY_MS;
+    var binary_decoder = window.TextDecoder ? new BinaryTelemetryDecoder()
+                                            : null;
+    var handle = {
+        send : function (data){ websocket.send(data); },
+        // whether binary telemetry frames can be decoded
+        binary : binary_decoder !== null,
+    };
+
+    function _track_seq(seq){
+        if (last_seq !== null && seq !== last_seq + 1){
+            console.log("Skipped telemetry messages "
+                        +(last_seq + 1)+" to "+(seq - 1));
+        }
+        last_seq = seq;
+    };
 
     function _message_handler (event){
+        if (event.data instanceof ArrayBuffer){
+            var _decoded = binary_decoder.decode(event.data);
+            if (_decoded !== null){
+                _track_seq(_decoded.seq);
+                telemetryhandler.handle_received_telemetry(_decoded.telemetry,
+                                                           _decoded.seq);
+            }
+            return;
+        }
+
         _message = JSON.parse(event.data);
 	//        console.log('Message received: %o' _message);
         console.log('Message received: '+event.data);
     
         if (_message.msgtype === 'telemetry'){
-            telemetryhandler.handle_received_telemetry(_message.msgcontent);
+            _track_seq(_message.seq);
+            telemetryhandler.handle_received_telemetry(_message.msgcontent,
+                                                       _message.seq);
+        } else if (_message.msgtype === 'telemetry_delta'){
+            // the changes since the packet of the same board with seq base
+            _track_seq(_message.seq);
+            telemetryhandler.handle_received_delta(_message.msgcontent,
+                                                   _message.seq,
+                                                   _message.base);
+        } else if (_message.msgtype === 'snapshot'){
+            // the latest packet of each board, sent when the stream cannot
+            // be resumed, or of the boards just subscribed to
+            stream = _message.stream;
+            last_seq = _message.seq;
+            _message.msgcontent.sort(function (a, b){ return a.time - b.time; });
+            _message.msgcontent.forEach(function (telemetry){
+                telemetryhandler.handle_received_telemetry(telemetry);
+            });
+        } else if (_message.msgtype === 'binary_schema'){
+            binary_decoder.add_schema(_message.msgcontent);
+        } else if (_message.msgtype === 'command_result'){
+            handle_command_result(_message.msgcontent);
         } else {
             console.log('WARNING: Unrecognised msgtype: '+_message.msgtype);
         }
@@ -29,21 +103,46 @@ function setup_websocket(websocket_address, telemetryhandler) {
 
     function _on_open() {
         console.log("websocket: open");
+        reconnect_delay = RECONNECT_DELAY_MS;
+        if (on_open){
+            on_open(handle);
+        }
     };
 
     function _on_close() {
-        console.log("websocket: closed");
-	// alerts the user that EduCube is no longer connected.
-	// TODO: tidy up the web interface?
-        // TODO: replace system alert box with custom formatted box? 
-	alert("The websocket connection was closed by the server");
+        console.log("websocket: closed; reconnecting in "
+                    +reconnect_delay+" ms");
+        provide_notice({"message": "Connection to EduCube lost, "
+                                   +"reconnecting...",
+                        "type"   : "error"});
+        setTimeout(_connect, reconnect_delay);
+        reconnect_delay = Math.min(2*reconnect_delay, RECONNECT_MAX_DELAY_MS);
+    };
+
+    function _connect() {
+        var _query = [];
+        if (stream !== null){
+            _query.push("stream="+encodeURIComponent(stream),
+                        "seq="+last_seq);
+        }
+        if (subscriptions){
+            _query.push("subscriptions="
+                        +encodeURIComponent(JSON.stringify(subscriptions())));
+        }
+        var _address = websocket_address;
+        if (_query.length){
+            _address += "?"+_query.join("&");
+        }
+        websocket = new WebSocket(_address);
+        websocket.binaryType = "arraybuffer";
+        websocket.onmessage = _message_handler;
+        websocket.onopen = _on_open;
+        websocket.onclose = _on_close;
     };
 
-    websocket.onmessage = _message_handler;
-    websocket.onopen = _on_open;
-    websocket.onclose = _on_close;
+    _connect();
 
-    return websocket
+    return handle;
 };
 
 //function handle_received_telemetry(packet) {
@@ -1,10 +1,45 @@
 var UCD = { lon : -6.2236, lat : 53.3083 };
 
-function TelemetryHandler(gps_map) {
+// merges the changes of a telemetry delta into a stored packet: objects are
+// merged key by key (arrays index by index), other values replaced
+function merge_delta(target, delta){
+    for (var key in delta){
+        var value = delta[key];
+        if (value !== null && typeof value === "object"
+                && !Array.isArray(value)
+                && target[key] !== null && typeof target[key] === "object"){
+            merge_delta(target[key], value);
+        } else {
+            target[key] = value;
+        }
+    }
+};
+
+function TelemetryHandler(gps_map, device) {
     var _telemetry_store = {};
+    var _telemetry_seqs = {};   // seq of the stored packet of each board
 
-    this.handle_received_telemetry = function (telemetry) {
-        if (telemetry && telemetry.type == "T"){
+    this.handle_received_telemetry = function (telemetry, seq) {
+        // ignore telemetry from other EduCubes served by the same server
+        if (telemetry && device !== null && telemetry.device !== device){
+            return;
+        }
+        if (telemetry){
+            // packets of a snapshot have no seq
+            _telemetry_seqs[telemetry.board] = (seq === undefined) ? null
+                                                                   : seq;
+        }
+        if (telemetry && telemetry.type == "T" && !("data" in telemetry)){
+            // only the time of a board that is not shown, for its status
+            // indicator: the data last received is kept
+            var _stored = _telemetry_store[telemetry.board];
+            if (_stored){
+                _stored.time = telemetry.time;
+            } else {
+                _telemetry_store[telemetry.board] = telemetry;
+            }
+            update_telemetry_indicators();
+        } else if (telemetry && telemetry.type == "T"){
             console.log("Handling telemetry from board: " + telemetry.board);
             _telemetry_store[telemetry.board] = telemetry;
     
@@ -37,6 +72,22 @@ function TelemetryHandler(gps_map) {
         }
     };
 
+    // a delta holds the values of a packet that changed since the packet
+    // of the same board with seq base, which must be the one stored
+    this.handle_received_delta = function (delta, seq, base) {
+        if (device !== null && delta.device !== device){
+            return;
+        }
+        var _stored = _telemetry_store[delta.board];
+        if (!_stored || _telemetry_seqs[delta.board] !== base){
+            console.log("WARNING: ignoring "+delta.board+" telemetry delta "
+                        +seq+": packet "+base+" was not received");
+            return;
+        }
+        merge_delta(_stored, delta);
+        this.handle_received_telemetry(_stored, seq);
+    };
+
     function update_telemetry_indicators(){
         function _update_indicator(board, board_dom){
             var _status_html = $('#tmpl-telem_status').tmpl({
@@ -0,0 +1,63 @@
+"""
+Tests of the snapshot kept by educube.web._broadcast.TelemetryBroadcaster.
+
+"""
+# standard library imports
+import asyncio
+import json
+
+# local imports
+from educube.telemetry_parser import parse_educube_telemetry_lazy
+from educube.web._broadcast import TelemetryBroadcaster
+
+EPS_GOOD = (b'T|EPS|I,66,6.58,17.00|I,67,4.95,118.20|I,68,5.00,10.00|'
+            b'I,69,5.00,10.00|I,70,5.00,10.00|I,71,5.00,10.00|'
+            b'I,72,5.00,10.00|I,64,1.11,-0.10|DA,25.72,6.93,975.00|'
+            b'DB,24.10|DC,23.80|C,0')
+
+# the same packet, cut short in the middle of a chip
+EPS_CORRUPTED = b'T|EPS|I,66,6.58,17.00|I,67,4.9'
+
+
+class FakeConnection():
+    """Stands in for an EduCubeConnection, with a buffer of raw packets."""
+    def __init__(self):
+        self.buffer = []
+
+    def add_telemetry_listener(self, listener):
+        pass
+
+    def remove_telemetry_listener(self, listener):
+        pass
+
+    def parse_telemetry(self, lazy=False):
+        _buffer, self.buffer = self.buffer, []
+        return [parse_educube_telemetry_lazy(_time, _raw)
+                for _time, _raw in _buffer]
+
+
+def snapshot(broadcaster):
+    return json.loads(broadcaster.snapshot_message())['msgcontent']
+
+
+def test_corrupted_packet_keeps_snapshot():
+    async def run():
+        _connection = FakeConnection()
+        _broadcaster = TelemetryBroadcaster(_connection)
+
+        _connection.buffer.append((1, EPS_GOOD))
+        _broadcaster.broadcast()
+        _connection.buffer.append((2, EPS_CORRUPTED))
+        _broadcaster.broadcast()
+
+        _packets = snapshot(_broadcaster)
+        assert [_packet['time'] for _packet in _packets] == [1]
+        assert _packets[0]['data']['DS2438']['temp'] == '25.72'
+        assert _broadcaster.seq == 2
+
+        # the next good packet replaces it
+        _connection.buffer.append((3, EPS_GOOD))
+        _broadcaster.broadcast()
+        assert [_packet['time'] for _packet in snapshot(_broadcaster)] == [3]
+
+    asyncio.run(run())